@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Compare the speed of two builds of the accelerator extensions.
+
+usage: pgo_bench.py [--workload FILE] [--loops N] [--repeat N]
+                    BASELINE OPTIMIZED
+
+BASELINE and OPTIMIZED are directories holding the built extensions,
+typically the build/lib.* directory of a build made without
+_PYTHON_PGO_EXTENSIONS and one made with it.  Each workload of the
+training script (pgo_training.py by default, see its WORKLOADS) is timed
+in a fresh interpreter that has the directory first on sys.path; the
+runs of the two builds are interleaved and the best of --repeat runs is
+kept.  Workloads whose extension isn't loaded from the directory are
+reported as such rather than timed against the wrong build.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Run in the interpreter under test: time each workload of the script
+# argv[2] with the extensions of directory argv[1], print JSON.
+RUNNER = """\
+import sys, os, json, runpy, time
+libdir = sys.argv[1]
+sys.path.insert(0, libdir)
+workloads = runpy.run_path(sys.argv[2], run_name='pgo_workload')['WORKLOADS']
+loops = int(sys.argv[3])
+results = {}
+for name, work in workloads.items():
+    try:
+        work(1)
+    except ImportError as exc:
+        results[name] = 'import error: %s' % exc
+        continue
+    module = sys.modules.get(name)
+    path = getattr(module, '__file__', None) or ''
+    if os.path.dirname(os.path.abspath(path)) != os.path.abspath(libdir):
+        results[name] = 'not loaded from %s' % libdir
+        continue
+    start = time.perf_counter()
+    work(loops)
+    results[name] = time.perf_counter() - start
+print(json.dumps(results))
+"""
+
+def run(libdir, workload, loops):
+    out = subprocess.run([sys.executable, '-c', RUNNER, libdir, workload,
+                          str(loops)], check=True, stdout=subprocess.PIPE,
+                         universal_newlines=True).stdout
+    return json.loads(out.splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n', 1)[0])
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser.add_argument('--workload',
+                        default=os.path.join(here, 'pgo_training.py'),
+                        help='script defining WORKLOADS')
+    parser.add_argument('--loops', type=int, default=500,
+                        help='iterations of each workload per run')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs of each build, the best one is kept')
+    parser.add_argument('baseline')
+    parser.add_argument('optimized')
+    args = parser.parse_args()
+
+    builds = (args.baseline, args.optimized)
+    best = {build: {} for build in builds}
+    for _ in range(args.repeat):
+        for build in builds:
+            for name, value in run(build, args.workload, args.loops).items():
+                old = best[build].get(name)
+                if isinstance(value, float) and isinstance(old, float):
+                    value = min(value, old)
+                best[build][name] = value
+
+    print('%-14s %12s %12s %8s' % ('extension', 'baseline', 'optimized',
+                                   'speedup'))
+    for name in best[args.baseline]:
+        before = best[args.baseline][name]
+        after = best[args.optimized].get(name)
+        if isinstance(before, float) and isinstance(after, float):
+            print('%-14s %11.4fs %11.4fs %7.2fx' % (name, before, after,
+                                                     before / after))
+        else:
+            print('%-14s %s' % (name, before if not isinstance(before, float)
+                                else after))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Training workload for the profile-guided optimization of extensions.
+
+setup.py runs this script against the instrumented builds of the
+extensions named by _PYTHON_PGO_EXTENSIONS (see PyBuildExt.pgo_train()),
+with their build directory first on sys.path, followed by the one of the
+other extensions; another script can be used by naming it in
+_PYTHON_PGO_TRAINING.  pgo_bench.py times the same workloads to compare
+two builds.
+
+usage: pgo_training.py [loops] [extension ...]
+
+WORKLOADS maps the name of each accelerator extension to a function
+exercising it through its pure Python front end, run 'loops' times.  The
+workloads of the extensions named, all of them by default, are run; the
+exit status is 1 if one of them has no workload or didn't get imported,
+since the front ends fall back to pure Python and the profile would be
+missing it.
+"""
+
+import sys
+
+def work_json(loops):
+    import json
+    doc = {'id': 12345, 'name': 'widget éè', 'price': 19.99,
+           'tags': ['a', 'b', 'c'] * 5, 'nested': [{'x': i, 'y': str(i)}
+                                                   for i in range(50)],
+           'flag': True, 'none': None}
+    for _ in range(loops):
+        text = json.dumps(doc)
+        json.loads(text)
+        json.dumps(doc, sort_keys=True, indent=2)
+
+def work_pickle(loops):
+    import pickle
+    obj = {'ints': list(range(200)), 'floats': [i / 3 for i in range(100)],
+           'strs': ['item%d' % i for i in range(100)],
+           'tuples': [(i, str(i), i * 1.5) for i in range(100)],
+           'nested': {'a': {'b': {'c': [1, 2, 3]}}}}
+    for _ in range(loops):
+        for protocol in (2, pickle.HIGHEST_PROTOCOL):
+            pickle.loads(pickle.dumps(obj, protocol))
+
+def work_decimal(loops):
+    import decimal
+    D = decimal.Decimal
+    values = [D(i) / D(7) for i in range(1, 100)]
+    for _ in range(loops):
+        total = D(0)
+        for value in values:
+            total += value * D('1.0825')
+            total = total.quantize(D('0.01'))
+        str(total)
+        D(2).sqrt()
+
+def work_heapq(loops):
+    import heapq
+    import random
+    data = [random.random() for _ in range(1000)]
+    for _ in range(loops):
+        heap = list(data)
+        heapq.heapify(heap)
+        for value in data[:200]:
+            heapq.heappushpop(heap, value)
+        heapq.nsmallest(10, data)
+        [heapq.heappop(heap) for _ in range(200)]
+
+def work_bisect(loops):
+    import bisect
+    data = list(range(0, 20000, 2))
+    for _ in range(loops):
+        for value in range(0, 20000, 7):
+            bisect.bisect_left(data, value)
+            bisect.bisect_right(data, value)
+        items = []
+        for value in range(500, 0, -1):
+            bisect.insort(items, value)
+
+def work_datetime(loops):
+    import datetime
+    start = datetime.datetime(2020, 1, 1, 12, 30)
+    step = datetime.timedelta(hours=7, minutes=13)
+    for _ in range(loops):
+        moment = start
+        for _ in range(100):
+            moment += step
+            moment.isoformat()
+            moment.weekday()
+        datetime.datetime.strptime('2021-03-04 05:06:07', '%Y-%m-%d %H:%M:%S')
+        datetime.date.fromisoformat('2021-03-04')
+
+def work_asyncio(loops):
+    import asyncio
+    async def worker(queue):
+        while True:
+            item = await queue.get()
+            queue.task_done()
+            if item is None:
+                return
+    async def main():
+        queue = asyncio.Queue()
+        tasks = [asyncio.ensure_future(worker(queue)) for _ in range(10)]
+        for i in range(500):
+            await queue.put(i)
+        for _ in tasks:
+            await queue.put(None)
+        await asyncio.gather(*tasks)
+    for _ in range(max(loops // 10, 1)):
+        asyncio.run(main())
+
+def work_elementtree(loops):
+    import xml.etree.ElementTree as ET
+    root = ET.Element('root')
+    for i in range(100):
+        child = ET.SubElement(root, 'item', id=str(i))
+        child.text = 'value %d' % i
+    text = ET.tostring(root)
+    for _ in range(loops):
+        tree = ET.fromstring(text)
+        tree.findall('item')
+        ET.tostring(tree)
+
+WORKLOADS = {
+    '_json': work_json,
+    '_pickle': work_pickle,
+    '_decimal': work_decimal,
+    '_heapq': work_heapq,
+    '_bisect': work_bisect,
+    '_datetime': work_datetime,
+    '_asyncio': work_asyncio,
+    '_elementtree': work_elementtree,
+}
+
+def main():
+    args = sys.argv[1:]
+    loops = int(args.pop(0)) if args and args[0].isdigit() else 200
+    missed = []
+    for name in args or WORKLOADS:
+        work = WORKLOADS.get(name)
+        if work is None:
+            print('no workload for %s' % name, file=sys.stderr)
+            missed.append(name)
+            continue
+        try:
+            work(loops)
+        except ImportError as exc:
+            print('skipping %s: %s' % (name, exc), file=sys.stderr)
+            missed.append(name)
+            continue
+        if name not in sys.modules:
+            print('skipping %s: not imported by its workload' % name,
+                  file=sys.stderr)
+            missed.append(name)
+    if missed:
+        sys.exit('incomplete training, missing: %s' % ', '.join(missed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""Benchmark the build driver in setup.py against a synthetic environment.
+
+usage: setup_bench.py [--setup setup.py] [--dirs N] [--files N]
+                      [--extensions N] [--jobs N] [--delay SECONDS]
+                      [--results FILE]
+
+A temporary tree is filled with include and library directories holding
+thousands of files, several versions of the BerkeleyDB, SQLite and Tcl/Tk
+headers and libraries, and stub sources for hundreds of extensions.  The
+compiler is replaced by a shell script that records its command line,
+sleeps for --delay seconds and creates its output files, so that only
+the work done by setup.py itself is measured:
+
+  find_file, find_library_file, add_dir_to_list
+        lookups in the synthetic trees, with a cold and a warm
+        directory index, whose answers are checked against os.path;
+  make jobs
+        the build workers under the MAKEFLAGS of make -j, checked;
+  detect_modules
+        a cold run (force) and a warm run served by the detection cache;
+  build_all
+        building all the stub extensions, then the no-op rebuild and
+        the --plan report of the up-to-date tree;
+  import_checks
+        the round-trip of the helper interpreters of the import checks.
+
+The results are appended to --results as one JSON object per run, and
+compared with the previous run made with the same parameters.
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+FAKE_COMPILER = r"""#!/bin/sh
+# Record the call, sleep, and create the files the real compiler would.
+echo "$*" >> "$FAKE_GCC_LOG"
+out=
+dep=
+src=
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -o) out="$2"; shift;;
+        -MF) dep="$2"; shift;;
+        *.c) src="$1";;
+    esac
+    shift
+done
+sleep "$FAKE_GCC_DELAY"
+if [ -n "$out" ]; then
+    : > "$out"
+    if [ -n "$dep" ]; then
+        echo "$out: $src" > "$dep"
+    fi
+fi
+exit 0
+"""
+
+def load_setup(filename):
+    spec = importlib.util.spec_from_file_location('setup_under_bench',
+                                                  filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def make_tree(root, ndirs, nfiles, nexts):
+    """Create the synthetic environment under 'root', return a dict of
+    the directories and files the benchmarks use."""
+    env = {'inc_dirs': [], 'lib_dirs': [], 'headers': [], 'libnames': [],
+           'sources': []}
+    for i in range(ndirs):
+        inc = os.path.join(root, 'include', 'd%03d' % i)
+        lib = os.path.join(root, 'lib', 'd%03d' % i)
+        os.makedirs(inc)
+        os.makedirs(lib)
+        env['inc_dirs'].append(inc)
+        env['lib_dirs'].append(lib)
+        for j in range(nfiles):
+            name = 'h%03d_%04d' % (i, j)
+            with open(os.path.join(inc, name + '.h'), 'w') as fp:
+                fp.write('#define %s 1\n' % name.upper())
+            open(os.path.join(lib, 'lib%s.so' % name), 'w').close()
+            open(os.path.join(lib, 'lib%s.a' % name), 'w').close()
+        env['headers'].append('h%03d_%04d.h' % (i, nfiles - 1))
+        env['libnames'].append('h%03d_%04d' % (i, nfiles - 1))
+
+    # Several versions of the libraries whose headers are parsed.
+    for i, inc in enumerate(env['inc_dirs'][:8]):
+        lib = env['lib_dirs'][i]
+        minor = i % 9
+        dbdir = os.path.join(inc, 'db4%d' % minor)
+        os.makedirs(dbdir)
+        with open(os.path.join(dbdir, 'db.h'), 'w') as fp:
+            fp.write('#define DB_VERSION_MAJOR 4\n'
+                     '#define DB_VERSION_MINOR %d\n' % minor)
+        open(os.path.join(lib, 'libdb-4.%d.so' % minor), 'w').close()
+        with open(os.path.join(inc, 'sqlite3.h'), 'w') as fp:
+            fp.write('#define SQLITE_VERSION "3.%d.0"\n' % (7 + i))
+        for name in ('tcl', 'tk'):
+            tcldir = os.path.join(inc, '%s8.%d' % (name, i % 7))
+            os.makedirs(tcldir, exist_ok=True)
+            with open(os.path.join(tcldir, name + '.h'), 'w') as fp:
+                fp.write('#define %s_VERSION "8.%d"\n'
+                         % (name.upper(), i % 7))
+            open(os.path.join(lib, 'lib%s8.%d.so' % (name, i % 7)),
+                 'w').close()
+
+    srcdir = os.path.join(root, 'src')
+    os.makedirs(srcdir)
+    for i in range(nexts):
+        source = os.path.join(srcdir, 'ext%04d.c' % i)
+        with open(source, 'w') as fp:
+            fp.write('int ext%04d;\n' % i)
+        env['sources'].append(source)
+
+    env['compiler'] = os.path.join(root, 'bin', 'fake-gcc')
+    os.makedirs(os.path.dirname(env['compiler']))
+    with open(env['compiler'], 'w') as fp:
+        fp.write(FAKE_COMPILER)
+    os.chmod(env['compiler'], 0o755)
+    return env
+
+class Bench:
+
+    def __init__(self, setup, env, args):
+        self.setup = setup
+        self.env = env
+        self.args = args
+        self.results = {}
+
+    def timed(self, name, func, *args):
+        """Run func(*args), record how long it took in self.results."""
+        start = time.perf_counter()
+        try:
+            value = func(*args)
+        except Exception as exc:
+            self.results[name] = 'error: %s: %s' % (type(exc).__name__, exc)
+            if self.args.verbose:
+                traceback.print_exc()
+            return None
+        self.results[name] = round(time.perf_counter() - start, 4)
+        return value
+
+    def compiler(self, fake=False):
+        from distutils.ccompiler import new_compiler
+        from distutils.sysconfig import customize_compiler
+        compiler = new_compiler()
+        customize_compiler(compiler)
+        if fake:
+            cc = self.env['compiler']
+            compiler.set_executables(compiler=[cc], compiler_so=[cc],
+                                     linker_so=[cc, '-shared'])
+        return compiler
+
+    def build_ext(self, compiler, build_dir):
+        from distutils.dist import Distribution
+        cmd = self.setup.PyBuildExt(Distribution({'ext_modules': []}))
+        cmd.build_temp = os.path.join(build_dir, 'temp')
+        cmd.build_lib = os.path.join(build_dir, 'lib')
+        cmd.finalize_options()
+        cmd.compiler = compiler
+        cmd.parallel = self.args.jobs
+        cmd.extensions = []
+        return cmd
+
+    def lookups(self):
+        setup = self.setup
+        inc_dirs = self.env['inc_dirs']
+        lib_dirs = self.env['lib_dirs']
+        compiler = self.compiler()
+        def find_files():
+            for name in self.env['headers']:
+                setup.find_file(name, [], inc_dirs)
+        def find_libraries():
+            for name in self.env['libnames']:
+                setup.find_library_file(compiler, name, [], lib_dirs)
+        def add_dirs():
+            dirlist = []
+            for dir in inc_dirs + lib_dirs:
+                setup.add_dir_to_list(dirlist, dir)
+        for name, func in (('find_file', find_files),
+                           ('find_library_file', find_libraries),
+                           ('add_dir_to_list', add_dirs)):
+            setup.dir_index.clear()
+            self.timed(name + ' cold', func)
+            self.timed(name + ' warm', func)
+
+        # The index must answer as os.path does, the root included.
+        paths = [os.sep, '', os.curdir, os.pardir, self.args.tmp,
+                 self.args.tmp + os.sep, inc_dirs[0],
+                 os.path.join(inc_dirs[0], self.env['headers'][0]),
+                 os.path.join(inc_dirs[0], os.pardir),
+                 os.path.join(self.args.tmp, 'missing')]
+        setup.dir_index.clear()
+        wrong = [path for path in paths
+                 if setup.dir_index.exists(path) != os.path.exists(path) or
+                 setup.dir_index.isdir(path) != os.path.isdir(path)]
+        for path in wrong:
+            print('directory index disagrees with os.path on %r' % path,
+                  file=sys.stderr)
+        self.results['dir_index mismatches'] = len(wrong)
+
+    def detect_modules(self):
+        build_dir = os.path.join(self.args.tmp, 'detect')
+        for name, force in (('detect_modules cold', True),
+                            ('detect_modules warm', False)):
+            self.setup.dir_index.clear()
+            cmd = self.build_ext(self.compiler(), build_dir)
+            cmd.force = force
+            cmd.compiler.include_dirs[:0] = self.env['inc_dirs']
+            cmd.compiler.library_dirs[:0] = self.env['lib_dirs']
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.timed(name, cmd.detect_modules)
+
+    def build(self):
+        setup = self.setup
+        build_dir = os.path.join(self.args.tmp, 'build')
+        log = os.path.join(self.args.tmp, 'fake-gcc.log')
+        os.environ['FAKE_GCC_LOG'] = log
+        os.environ['FAKE_GCC_DELAY'] = str(self.args.delay)
+        extensions = [setup.Extension('ext%04d' % i, [source])
+                      for i, source in enumerate(self.env['sources'])]
+        for name in ('build_all', 'build_all no-op', 'plan'):
+            cmd = self.build_ext(self.compiler(fake=True), build_dir)
+            cmd.extensions = list(extensions)
+            if os.path.exists(log):
+                os.remove(log)
+            with contextlib.redirect_stdout(io.StringIO()):
+                if name == 'plan':
+                    self.timed(name, cmd.write_plan, [], [], [], [])
+                else:
+                    self.timed(name, cmd.build_all)
+            if name == 'build_all' and os.path.exists(log):
+                # The time the compiler spent sleeping, spread over the
+                # workers, is the best the scheduler can do.
+                with open(log) as fp:
+                    calls = sum(1 for line in fp)
+                ideal = calls * self.args.delay / self.args.jobs
+                self.results['compiler calls'] = calls
+                if isinstance(self.results[name], float):
+                    self.results['build_all overhead'] = round(
+                        self.results[name] - ideal, 4)
+
+    def make_jobs(self):
+        # The workers of a build run by make, which passes "-jN" on
+        # together with its jobserver.
+        from distutils.dist import Distribution
+        expected = [('', 1), ('k', 1), (' -j8 --jobserver-auth=3,4', 8),
+                    ('k -j3 --jobserver-auth=fifo:/tmp/GMfifo1', 3),
+                    (' --jobserver-fds=3,4 -j', os.cpu_count() or 1)]
+        saved = os.environ.get('MAKEFLAGS')
+        wrong = []
+        try:
+            for makeflags, jobs in expected:
+                os.environ['MAKEFLAGS'] = makeflags
+                cmd = self.setup.PyBuildExt(Distribution({'ext_modules': []}))
+                if cmd.build_jobs() != jobs:
+                    wrong.append((makeflags, cmd.build_jobs(), jobs))
+        finally:
+            if saved is None:
+                del os.environ['MAKEFLAGS']
+            else:
+                os.environ['MAKEFLAGS'] = saved
+        for makeflags, jobs, expected_jobs in wrong:
+            print('MAKEFLAGS=%r: %d build jobs instead of %d'
+                  % (makeflags, jobs, expected_jobs), file=sys.stderr)
+        self.results['make jobs mismatches'] = len(wrong)
+
+    def import_checks(self):
+        # Stub files that the helpers fail to load: only the round-trip
+        # of the checks is measured.
+        stubs = []
+        for i, source in enumerate(self.env['sources']):
+            stub = os.path.splitext(source)[0] + '.so'
+            open(stub, 'w').close()
+            stubs.append(('ext%04d' % i, stub))
+        def check_all():
+            checker = self.setup.ImportChecker(self.args.jobs, 60)
+            try:
+                futures = [checker.submit(name, stub)
+                           for name, stub in stubs]
+                for future in futures:
+                    future.result()
+            finally:
+                checker.shutdown()
+        self.timed('import_checks', check_all)
+
+def compare(results, previous):
+    for name, value in results.items():
+        old = previous.get(name)
+        if (isinstance(value, (int, float)) and
+                isinstance(old, (int, float)) and old):
+            change = '%+6.1f%%' % ((value - old) * 100.0 / old)
+        else:
+            change = ''
+        print('%-24s %12s %8s' % (name, value, change))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n', 1)[0])
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser.add_argument('--setup', default=os.path.join(here, os.pardir,
+                                                        os.pardir,
+                                                        'setup.py'),
+                        help='the setup.py to benchmark')
+    parser.add_argument('--dirs', type=int, default=50,
+                        help='include and library directories')
+    parser.add_argument('--files', type=int, default=100,
+                        help='headers and libraries per directory')
+    parser.add_argument('--extensions', type=int, default=300,
+                        help='stub extensions to build')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='parallel compiler processes')
+    parser.add_argument('--delay', type=float, default=0.01,
+                        help='seconds each fake compiler call takes')
+    parser.add_argument('--results', default='setup_bench.jsonl',
+                        help='file the results are appended to')
+    parser.add_argument('--keep', action='store_true',
+                        help="don't remove the synthetic tree")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='print the tracebacks of failed benchmarks')
+    args = parser.parse_args()
+
+    args.tmp = tempfile.mkdtemp(prefix='setup_bench-')
+    try:
+        setup = load_setup(os.path.abspath(args.setup))
+        env = make_tree(args.tmp, args.dirs, args.files, args.extensions)
+        bench = Bench(setup, env, args)
+        bench.lookups()
+        bench.make_jobs()
+        bench.detect_modules()
+        bench.build()
+        bench.import_checks()
+    finally:
+        if args.keep:
+            print('synthetic tree kept in', args.tmp)
+        else:
+            shutil.rmtree(args.tmp, ignore_errors=True)
+
+    params = {name: getattr(args, name)
+              for name in ('dirs', 'files', 'extensions', 'jobs', 'delay')}
+    previous = {}
+    try:
+        with open(args.results) as fp:
+            for line in fp:
+                run = json.loads(line)
+                if run.get('params') == params:
+                    previous = run['results']
+    except (OSError, ValueError):
+        pass
+    compare(bench.results, previous)
+    with open(args.results, 'a') as fp:
+        fp.write(json.dumps({'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                             'python': sys.version.split()[0],
+                             'params': params,
+                             'results': bench.results}) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,8 @@
 # Autodetecting setup.py script for building the Python extensions
 #
 
-import sys, os, importlib.machinery, re, argparse
+import sys, os, importlib.machinery, re, argparse, marshal, threading, time
+import copy
 from glob import glob
 import importlib._bootstrap
 import importlib.util
@@ -9,7 +10,7 @@ import sysconfig
 
 from distutils import log
 from distutils.errors import *
-from distutils.core import Extension, setup
+from distutils.core import Extension as DistutilsExtension, setup
 from distutils.command.build_ext import build_ext
 from distutils.command.install import install
 from distutils.command.install_lib import install_lib
@@ -45,6 +46,256 @@ COMPILED_WITH_PYDEBUG = ('--with-pydebug' in sysconfig.get_config_var("CONFIG_AR
 # This global variable is used to hold the list of modules to be disabled.
 disabled_module_list = []
 
+# The small, self-contained extensions linked into one shared object when
+# _PYTHON_BUNDLE_EXTENSIONS is "default" (see PyBuildExt.link_bundle()).
+default_bundle = ['array', '_contextvars', 'cmath', 'math', '_datetime',
+                  '_random', '_bisect', '_heapq', '_pickle', '_json',
+                  'binascii', 'select', 'fcntl', '_posixsubprocess', '_csv',
+                  '_md5', '_sha1', '_sha256', '_sha512', '_blake2', '_sha3']
+bundle_name = '_bundle'
+
+# The hot accelerator extensions built with profile-guided optimization
+# when _PYTHON_PGO_EXTENSIONS is "default" (see PyBuildExt.prepare_pgo()).
+default_pgo = ['_json', '_pickle', '_decimal', '_heapq', '_bisect',
+               '_datetime', '_asyncio', '_elementtree']
+
+# The sources left out of the unity build of an extension because they
+# conflict with the others (see PyBuildExt.prepare_unity()), by extension
+# name; _PYTHON_UNITY_EXCLUDE adds "name:source" entries.
+unity_exclude = {}
+
+# The linkers tried in place of the compiler's default one by
+# PyBuildExt.select_linker(), the preferred one first: the -fuse-ld= name
+# of each, and the executables gcc and clang look for.
+fast_linkers = [('mold', ('ld.mold', 'mold')), ('lld', ('ld.lld',)),
+                ('gold', ('ld.gold',))]
+
+# Runs the PGO training script argv[2], with the arguments that follow,
+# with the directories argv[1] (the instrumented extensions, then the
+# others, separated by os.pathsep) first on sys.path.
+PGO_TRAINING_WRAPPER = (
+    "import sys, os, runpy; sys.path[:0] = sys.argv[1].split(os.pathsep); "
+    "sys.argv = sys.argv[2:]; runpy.run_path(sys.argv[0], run_name='__main__')")
+
+# Prints, as JSON, the best of three timings of the workloads of the PGO
+# training script argv[2] for the extensions named after argv[3] (the
+# loops of each run), imported from the directory argv[1].  Extensions
+# without a workload, or whose workload fails, are left out.
+WORKLOAD_TIMER = """\
+import sys, os, json, runpy, time
+sys.path.insert(0, sys.argv[1])
+workloads = runpy.run_path(sys.argv[2], run_name='pgo_workload')['WORKLOADS']
+loops = int(sys.argv[3])
+results = {}
+for name in sys.argv[4:]:
+    work = workloads.get(name)
+    try:
+        work(1)
+        path = os.path.abspath(sys.modules[name].__file__)
+    except Exception:
+        continue
+    if os.path.dirname(path) != os.path.abspath(sys.argv[1]):
+        continue
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        work(loops)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    results[name] = best
+print(json.dumps(results))
+"""
+
+class Extension(DistutilsExtension):
+    """An extension module, with the other parts of the build it needs.
+
+    'requires' names the extension modules that must be built before this
+    one can be, typically because they are imported by its init function.
+    'generated' lists the files created by the Makefile before setup.py
+    runs (generated headers, bundled libraries such as Modules/_math.o)
+    that the extension is compiled or linked with.
+    """
+
+    def __init__(self, name, sources, *, requires=(), generated=(), **kw):
+        DistutilsExtension.__init__(self, name, sources, **kw)
+        self.requires = list(requires)
+        self.generated = list(generated)
+
+class DirectoryIndex:
+    """Index of directory listings used to look up headers and libraries.
+
+    detect_modules() looks for the same handful of files in the same
+    directories over and over.  Each directory is listed only once with
+    os.scandir() and all later lookups are answered from the listing,
+    which saves a stat() per lookup (a network round-trip on NFS).
+    """
+
+    def __init__(self):
+        self.listings = {}
+        self.links = {}
+        self.lookups = 0        # stat() calls that would have been made
+        self.syscalls = 0       # system calls actually made
+
+    def clear(self):
+        self.listings.clear()
+        self.links.clear()
+
+    def listing(self, dir):
+        """Return the (names, subdirectories, symbolic links) sets of 'dir'."""
+        if not dir:
+            dir = os.curdir
+        elif dir != os.sep:
+            dir = dir.rstrip(os.sep) or os.sep
+        try:
+            return self.listings[dir]
+        except KeyError:
+            pass
+        names = set()
+        subdirs = set()
+        links = set()
+        self.syscalls += 1
+        try:
+            with os.scandir(dir) as it:
+                for entry in it:
+                    names.add(entry.name)
+                    if entry.is_symlink():
+                        links.add(entry.name)
+                    elif entry.is_dir(follow_symlinks=False):
+                        subdirs.add(entry.name)
+        except OSError:
+            pass
+        self.listings[dir] = (names, subdirs, links)
+        return names, subdirs, links
+
+    def resolve(self, path):
+        # Symbolic links are only followed when they are looked up, most
+        # of the ones in library directories never are.
+        try:
+            return self.links[path]
+        except KeyError:
+            pass
+        self.syscalls += 1
+        self.links[path] = (os.path.exists(path), os.path.isdir(path))
+        return self.links[path]
+
+    def exists(self, path):
+        self.lookups += 1
+        dir, name = os.path.split(path)
+        # The root and the . and .. entries aren't in any listing.
+        if name in ('', os.curdir, os.pardir):
+            return self.resolve(path)[0]
+        names, subdirs, links = self.listing(dir)
+        if name in links:
+            return self.resolve(path)[0]
+        return name in names
+
+    def isdir(self, path):
+        self.lookups += 1
+        dir, name = os.path.split(path.rstrip(os.sep))
+        if name in ('', os.curdir, os.pardir):
+            return self.resolve(path)[1]
+        names, subdirs, links = self.listing(dir)
+        if name in links:
+            return self.resolve(path)[1]
+        return name in subdirs
+
+    def find_library_file(self, compiler, dirs, libname):
+        """Same as compiler.find_library_file(dirs, libname)."""
+        return self.find_library_files(compiler, dirs, [libname]).get(libname)
+
+    def find_library_files(self, compiler, dirs, libnames):
+        """Look for all the libraries 'libnames' in one pass over 'dirs',
+        return a dict mapping those found to their path."""
+        found = {}
+        if compiler.compiler_type not in ('unix', 'cygwin', 'mingw32'):
+            for libname in libnames:
+                path = compiler.find_library_file(dirs, libname)
+                if path is not None:
+                    found[libname] = path
+            return found
+        # Keep the order of distutils: the linker prefers shared libraries.
+        filenames = {
+            libname: [compiler.library_filename(libname, lib_type=lib_type)
+                      for lib_type in ('dylib', 'xcode_stub', 'shared',
+                                       'static')]
+            for libname in libnames}
+        if host_platform == 'darwin':
+            sysroot = macosx_sdk_root()
+        for dir in dirs:
+            if host_platform == 'darwin' and is_macosx_sdk_path(dir):
+                dir = os.path.join(sysroot, dir[1:])
+            names, subdirs, links = self.listing(dir)
+            for libname in libnames:
+                if libname in found:
+                    continue
+                for filename in filenames[libname]:
+                    self.lookups += 1
+                    if filename not in names:
+                        continue
+                    path = os.path.join(dir, filename)
+                    if filename not in links or self.resolve(path)[0]:
+                        found[libname] = path
+                        break
+            if len(found) == len(libnames):
+                break
+        return found
+
+    def report(self):
+        log.info("directory index: %d lookups answered from %d directory "
+                 "listings, %d system calls avoided",
+                 self.lookups, len(self.listings),
+                 self.lookups - self.syscalls)
+
+# The index shared by all the lookups of a build.
+dir_index = DirectoryIndex()
+
+def path_state(path):
+    """Return a snapshot of the state of 'path' that changes whenever the
+    file or directory is replaced, modified or (dis)appears.  None is
+    returned if 'path' does not exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+# The files consulted by the detection probe running in the current thread,
+# see PyBuildExt.run_probe().
+_probe_state = threading.local()
+
+def note_probe_input(path):
+    """Record 'path' as an input of the running detection probe.
+
+    Record paths that were looked for but do not exist as well: creating
+    them later must invalidate the cached result of the probe.
+    """
+    inputs = getattr(_probe_state, 'inputs', None)
+    if inputs is not None:
+        inputs.add(path)
+
+class ProbeOutput:
+    """Stand-in for sys.stdout and sys.stderr while the detection probes run
+    concurrently.  What a probe prints is kept aside, so that it can be
+    written out in the order the probes would have run in one by one."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        output = getattr(_probe_state, 'output', None)
+        if output is None:
+            return self.stream.write(text)
+        output.append((self.stream, text))
+        return len(text)
+
+    def flush(self):
+        if getattr(_probe_state, 'output', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
 def add_dir_to_list(dirlist, dir):
     """Add the directory 'dir' to the list 'dirlist' (after and relative
     directories) if:
@@ -52,7 +303,9 @@ def add_dir_to_list(dirlist, dir):
     1) 'dir' is not already in 'dirlist'
     2) 'dir' actually exists, and is a directory.
     """
-    if dir is None or not os.path.isdir(dir) or dir in dirlist:
+    if dir is not None:
+        note_probe_input(dir)
+    if dir is None or not dir_index.isdir(dir) or dir in dirlist:
         return
     for i, path in enumerate(dirlist):
         if not os.path.isabs(path):
@@ -130,7 +383,8 @@ def find_file(filename, std_dirs, paths):
         if host_platform == 'darwin' and is_macosx_sdk_path(dir):
             f = os.path.join(sysroot, dir[1:], filename)
 
-        if os.path.exists(f): return[]
+        note_probe_input(f)
+        if dir_index.exists(f): return[]
 
     # Check the additional directories
     for dir in paths:
@@ -139,14 +393,15 @@ def find_file(filename, std_dirs, paths):
         if host_platform == 'darwin' and is_macosx_sdk_path(dir):
             f = os.path.join(sysroot, dir[1:], filename)
 
-        if os.path.exists(f):
+        note_probe_input(f)
+        if dir_index.exists(f):
             return [dir]
 
     # Not found anywhere
     return None
 
 def find_library_file(compiler, libname, std_dirs, paths):
-    result = compiler.find_library_file(std_dirs + paths, libname)
+    result = dir_index.find_library_file(compiler, std_dirs + paths, libname)
     if result is None:
         return None
 
@@ -197,6 +452,146 @@ def find_library_file(compiler, libname, std_dirs, paths):
     else:
         assert False, "Internal error: Path not found is std_dirs or paths"
 
+# Tags of the entries of the dynamic section of an ELF file, see elf(5).
+ELF_DYNAMIC_TAGS = {1: 'needed', 14: 'soname', 15: 'rpath', 29: 'runpath'}
+
+def read_elf_dynamic(filename):
+    """Return the strings of the dynamic section of the ELF shared library
+    or executable 'filename' as a dict mapping 'needed', 'soname', 'rpath'
+    and 'runpath' to lists, or None if it isn't an ELF file.
+
+    This reads the few parts of the file that matter directly, so it works
+    for the libraries of any target (32 or 64-bit, either endianness) and
+    doesn't need ldd or readelf.  It can't rely on struct or mmap, which
+    are among the extensions this script builds.
+    """
+    try:
+        with open(filename, 'rb') as fp:
+            header = fp.read(64)
+            if len(header) < 52 or header[:4] != b'\x7fELF':
+                return None
+            is64 = header[4] == 2
+            order = 'little' if header[5] == 1 else 'big'
+            word = 8 if is64 else 4
+
+            def field(data, offset, size):
+                return int.from_bytes(data[offset:offset+size], order)
+
+            if is64:
+                phoff = field(header, 32, 8)
+                phentsize = field(header, 54, 2)
+                phnum = field(header, 56, 2)
+            else:
+                phoff = field(header, 28, 4)
+                phentsize = field(header, 42, 2)
+                phnum = field(header, 44, 2)
+
+            # The program headers give the dynamic section and the
+            # segments needed to turn addresses into file offsets.
+            fp.seek(phoff)
+            phdrs = fp.read(phentsize * phnum)
+            loads = []
+            dynamic = None
+            for i in range(phnum):
+                phdr = phdrs[i * phentsize:(i + 1) * phentsize]
+                p_type = field(phdr, 0, 4)
+                if is64:
+                    p_offset = field(phdr, 8, 8)
+                    p_vaddr = field(phdr, 16, 8)
+                    p_filesz = field(phdr, 32, 8)
+                else:
+                    p_offset = field(phdr, 4, 4)
+                    p_vaddr = field(phdr, 8, 4)
+                    p_filesz = field(phdr, 16, 4)
+                if p_type == 1:         # PT_LOAD
+                    loads.append((p_vaddr, p_offset, p_filesz))
+                elif p_type == 2:       # PT_DYNAMIC
+                    dynamic = (p_offset, p_filesz)
+            if dynamic is None:
+                return {name: [] for name in ELF_DYNAMIC_TAGS.values()}
+
+            fp.seek(dynamic[0])
+            data = fp.read(dynamic[1])
+            entries = []
+            strtab = strsz = None
+            for offset in range(0, len(data) - 2 * word + 1, 2 * word):
+                tag = field(data, offset, word)
+                value = field(data, offset + word, word)
+                if tag == 0:            # DT_NULL
+                    break
+                elif tag == 5:          # DT_STRTAB
+                    strtab = value
+                elif tag == 10:         # DT_STRSZ
+                    strsz = value
+                elif tag in ELF_DYNAMIC_TAGS:
+                    entries.append((tag, value))
+
+            # DT_STRTAB is an address, find where it is in the file.
+            strings = b''
+            for vaddr, offset, filesz in loads:
+                if strtab is not None and vaddr <= strtab < vaddr + filesz:
+                    fp.seek(strtab - vaddr + offset)
+                    strings = fp.read(strsz or filesz)
+                    break
+    except OSError:
+        return None
+
+    result = {name: [] for name in ELF_DYNAMIC_TAGS.values()}
+    for tag, value in entries:
+        end = strings.find(b'\0', value)
+        if end >= 0:
+            result[ELF_DYNAMIC_TAGS[tag]].append(
+                strings[value:end].decode(errors='replace'))
+    return result
+
+_define_re = re.compile(br'\s*#\s*define\s+(\w+)[ \t]+(.*)')
+_header_macros = {}
+
+def header_macros(filename, names):
+    """Return a dict mapping those of the macros 'names' that the header
+    'filename' #defines to their value (as a string), or None if the file
+    can't be read.
+
+    The header is read line by line and only up to the last of the macros
+    wanted.  Results are cached on the path, mtime and size of the file.
+    """
+    state = path_state(filename)
+    if state is None:
+        return None
+    key = (filename, state[0], state[2], frozenset(names))
+    try:
+        return dict(_header_macros[key])
+    except KeyError:
+        pass
+    wanted = {name.encode() for name in names}
+    values = {}
+    try:
+        with open(filename, 'rb') as fp:
+            for line in fp:
+                if b'define' not in line:
+                    continue
+                m = _define_re.match(line)
+                if m and m.group(1) in wanted and m.group(1) not in values:
+                    value = m.group(2).split(b'/*')[0].split(b'//')[0]
+                    values[m.group(1)] = value.strip().decode('latin-1')
+                    if len(values) == len(wanted):
+                        break
+    except OSError:
+        return None
+    values = {name.decode(): value for name, value in values.items()}
+    _header_macros[key] = values
+    return dict(values)
+
+def parse_version(value):
+    """Return the version '"1.2.11"' or '5' as a tuple of ints, (1, 2, 11)
+    and (5,), or None if 'value' doesn't start with a version."""
+    if value is None:
+        return None
+    m = re.match(r'"?(\d+(?:\.\d+)*)', value)
+    if not m:
+        return None
+    return tuple(int(part) for part in m.group(1).split('.'))
+
 def module_enalbed(extlist, modname):
     """Returns whether the module 'modname' is present in the list
     of extensions 'extlist'."""
@@ -213,29 +608,1019 @@ def find_module_file(module, dirlist):
         log.info("WARNING: multiple copies of %s found", module)
     return os.path.join(list[0], module)
 
+def detection_fingerprint(config_h_vars):
+    """Return the settings that all detect_modules() results depend on.
+
+    A different compiler, different flags, a reconfigured interpreter or an
+    edited setup.py invalidate every cached probe at once.
+    """
+    cc = os.environ.get('CC') or sysconfig.get_config_var('CC')
+    config_vars = tuple(
+        (name, sysconfig.get_config_var(name), os.environ.get(name))
+        for name in ('CC', 'CFLAGS', 'LDFLAGS', 'CPPFLAGS', 'CONFIG_ARGS',
+                     'READELF', 'HOST_GNU_TYPE', 'MACOSX_DEPLOYMENT_TARGET',
+                     '_TCLTK_INCLUDES', '_TCLTK_LIBS'))
+    return (sys.version, host_platform, cross_compiling,
+            path_state(os.path.abspath(__file__)),
+            path_state(find_executable(cc.split()[0]) or ''),
+            config_vars,
+            tuple(sorted(config_h_vars.items())))
+
+class DetectionCache:
+    """On-disk cache of the results of the detect_modules() probes.
+
+    Each probe is cached on its own, together with the state of every file
+    it looked at, so that only the probes whose inputs changed are run
+    again.  The cache is stored with marshal, which (unlike pickle) doesn't
+    depend on any extension module that this script has yet to build.
+    """
+
+    # Bump this whenever the layout of the cache file changes.
+    version = 1
+
+    def __init__(self, filename, fingerprint):
+        self.filename = filename
+        self.fingerprint = fingerprint
+        self.entries = {}
+        self.hits = []
+        self.misses = []
+
+    def load(self):
+        try:
+            with open(self.filename, 'rb') as fp:
+                data = marshal.load(fp)
+        except (OSError, EOFError, ValueError, TypeError):
+            return
+        if (isinstance(data, dict) and
+                data.get('version') == self.version and
+                data.get('fingerprint') == self.fingerprint):
+            self.entries = data['entries']
+
+    def save(self):
+        data = {'version': self.version,
+                'fingerprint': self.fingerprint,
+                'entries': self.entries}
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        tmpfile = self.filename + '.tmp'
+        with open(tmpfile, 'wb') as fp:
+            marshal.dump(data, fp)
+        os.replace(tmpfile, self.filename)
+
+    def lookup(self, name, key):
+        """Return the cached result of probe 'name' run with the arguments
+        'key', or None if there is none or its inputs have changed."""
+        entry = self.entries.get(name)
+        if (entry is None or entry['key'] != key or
+                not self.inputs_unchanged(entry['dirs'], entry['files'])):
+            self.misses.append(name)
+            return None
+        self.hits.append(name)
+        return self.decode(entry['result'])
+
+    def store(self, name, key, result, inputs):
+        files = {path: path_state(path) for path in inputs}
+        dirs = {os.path.dirname(path) for path, state in files.items()
+                if state is None}
+        self.entries[name] = {
+            'key': key,
+            'dirs': {dir: path_state(dir) for dir in dirs},
+            'files': files,
+            'result': self.encode(result),
+        }
+
+    @staticmethod
+    def inputs_unchanged(dirs, files):
+        # Files that didn't exist can only have been created since if the
+        # directory they would live in has changed, so they needn't be
+        # looked at one by one as long as it hasn't.  Existing files can be
+        # rewritten in place and must always be checked.
+        changed_dirs = {dir for dir, state in dirs.items()
+                        if path_state(dir) != state}
+        for path, state in files.items():
+            if state is None and os.path.dirname(path) not in changed_dirs:
+                continue
+            if path_state(path) != state:
+                return False
+        return True
+
+    # Results are copied on the way in and out, the build goes on to modify
+    # the attributes of the extensions in place.
+
+    @staticmethod
+    def encode(result):
+        result = dict(result)
+        if 'exts' in result:
+            result['exts'] = [vars(ext) for ext in result['exts']]
+        return marshal.loads(marshal.dumps(result))
+
+    @staticmethod
+    def decode(result):
+        result = marshal.loads(marshal.dumps(result))
+        if 'exts' in result:
+            exts = []
+            for attrs in result['exts']:
+                ext = Extension.__new__(Extension)
+                ext.__dict__.update(attrs)
+                exts.append(ext)
+            result['exts'] = exts
+        return result
+
+class BuildTimer:
+    """Record how long each phase of the build takes.
+
+    Phases are timed with 'with timer.phase(category, name):' from any
+    thread.  write_trace() saves them in the Chrome trace event format
+    (open it in chrome://tracing or https://ui.perfetto.dev) and
+    write_summary() as a text table of the slowest steps.
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.events = []
+        self.threads = {}
+        # The BuildProfiler told which phase each thread is in.
+        self.profiler = None
+
+    def add(self, category, name, start, duration, **args):
+        """Record a phase that started at perf_counter() time 'start'."""
+        tid = threading.get_ident()
+        with self.lock:
+            tid = self.threads.setdefault(tid, len(self.threads))
+            self.events.append((category, name, start - self.origin,
+                                duration, tid, args))
+
+    def phase(self, category, name, **args):
+        timer = self
+        class Phase:
+            def __enter__(self):
+                if timer.profiler is not None:
+                    timer.profiler.enter(category)
+                self.start = time.perf_counter()
+                return self
+            def __exit__(self, *exc_info):
+                args['failed'] = exc_info[0] is not None
+                timer.add(category, name, self.start,
+                          time.perf_counter() - self.start, **args)
+                if timer.profiler is not None:
+                    timer.profiler.leave()
+        return Phase()
+
+    def write_trace(self, filename):
+        import json
+        events = [{'name': name, 'cat': category, 'ph': 'X',
+                   'ts': round(start * 1e6), 'dur': round(duration * 1e6),
+                   'pid': os.getpid(), 'tid': tid, 'args': args}
+                  for category, name, start, duration, tid, args
+                  in self.events]
+        with open(filename, 'w') as fp:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fp)
+
+    def write_summary(self, filename, count=30):
+        totals = {}
+        for category, name, start, duration, tid, args in self.events:
+            total = totals.setdefault(category, [0, 0.0])
+            total[0] += 1
+            total[1] += duration
+        with open(filename, 'w') as fp:
+            fp.write('%-10s %6s %10s\n' % ('phase', 'count', 'seconds'))
+            for category, (n, duration) in sorted(
+                    totals.items(), key=lambda item: -item[1][1]):
+                fp.write('%-10s %6d %10.3f\n' % (category, n, duration))
+            fp.write('\nslowest steps:\n')
+            events = sorted(self.events, key=lambda event: -event[3])
+            for category, name, start, duration, tid, args in events[:count]:
+                fp.write('%10.3f  %-10s %s\n' % (duration, category, name))
+
+    # The phases whose durations are kept as estimates for the next builds.
+    cost_categories = ('compile', 'link')
+
+    @staticmethod
+    def load_costs(filename):
+        """Return the durations saved by save_costs(), as a dict mapping
+        each category to a dict mapping names to seconds."""
+        import json
+        try:
+            with open(filename) as fp:
+                costs = json.load(fp)
+        except (OSError, ValueError):
+            costs = {}
+        return {category: costs.get(category, {})
+                for category in BuildTimer.cost_categories}
+
+    def save_costs(self, filename):
+        """Merge the durations of the compiles and links of this build
+        into the ones saved by previous builds."""
+        import json
+        costs = self.load_costs(filename)
+        for category, name, start, duration, tid, args in self.events:
+            if category in costs and not args.get('failed'):
+                costs[category][name] = round(duration, 4)
+        with open(filename, 'w') as fp:
+            json.dump(costs, fp, indent=1, sort_keys=True)
+
+class BuildProfiler:
+    """Profile a build run with PyBuildExt --profile or _PYTHON_BUILD_PROFILE.
+
+    The thread running the build is profiled with cProfile, or with the
+    pure Python profile module when _lsprof hasn't been built yet.  The
+    stacks of all threads are sampled every 'interval' seconds into a
+    collapsed-stack file for flame graph tools.  The calls that stat,
+    open or list files and those that spawn processes are counted per
+    phase of the BuildTimer.  write() saves profile.pstats, profile.txt,
+    profile.collapsed and profile_counts.txt in a directory.
+    """
+
+    interval = 0.001
+
+    # The functions counted, by kind, as (kind, module, attribute).
+    # Modules that aren't imported yet aren't imported for this.
+    counted = [('stat', 'os', 'stat'), ('stat', 'os', 'lstat'),
+               ('stat', 'os', 'access'), ('open', 'os', 'open'),
+               ('open', 'builtins', 'open'), ('open', 'io', 'open'),
+               ('listdir', 'os', 'listdir'), ('listdir', 'os', 'scandir'),
+               ('spawn', 'os', 'posix_spawn'), ('spawn', 'os', 'posix_spawnp'),
+               ('spawn', 'os', 'fork'),
+               ('spawn', 'subprocess', 'Popen._execute_child')]
+
+    def __init__(self, timer):
+        self.timer = timer
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.stacks = {}
+        self.saved = []
+        self.profile = None
+        self.sampling = False
+
+    def enter(self, category):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(category)
+
+    def leave(self):
+        self.local.stack.pop()
+
+    def count(self, kind):
+        stack = getattr(self.local, 'stack', None)
+        key = (stack[-1] if stack else 'other', kind)
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def wrap(self, kind, func):
+        def counted(*args, **kwargs):
+            self.count(kind)
+            return func(*args, **kwargs)
+        return counted
+
+    def sample(self):
+        own = threading.get_ident()
+        main = threading.main_thread().ident
+        while self.sampling:
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append('%s (%s)' % (
+                        code.co_name, os.path.basename(code.co_filename)))
+                    frame = frame.f_back
+                names.append('main' if ident == main else 'worker')
+                stack = ';'.join(reversed(names))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            time.sleep(self.interval)
+
+    def run(self, func, *args):
+        """Return func(*args), profiled."""
+        try:
+            import cProfile as profile
+        except ImportError:
+            import profile
+        for kind, module, name in self.counted:
+            owner = sys.modules.get(module)
+            path, _, name = name.rpartition('.')
+            if path and owner is not None:
+                owner = getattr(owner, path, None)
+            original = getattr(owner, name, None)
+            if original is not None:
+                self.saved.append((owner, name, original))
+                setattr(owner, name, self.wrap(kind, original))
+        self.timer.profiler = self
+        self.sampling = True
+        sampler = threading.Thread(target=self.sample, daemon=True)
+        sampler.start()
+        self.profile = profile.Profile()
+        try:
+            return self.profile.runcall(func, *args)
+        finally:
+            self.sampling = False
+            sampler.join()
+            self.timer.profiler = None
+            for owner, name, original in reversed(self.saved):
+                setattr(owner, name, original)
+            del self.saved[:]
+
+    def write(self, directory):
+        """Save the results in 'directory', return False if there are none
+        (run() failed before profiling started)."""
+        if self.profile is None:
+            return False
+        import pstats
+        os.makedirs(directory, exist_ok=True)
+        self.profile.dump_stats(os.path.join(directory, 'profile.pstats'))
+        with open(os.path.join(directory, 'profile.txt'), 'w') as fp:
+            stats = pstats.Stats(self.profile, stream=fp)
+            stats.sort_stats('cumulative').print_stats(60)
+        with open(os.path.join(directory, 'profile.collapsed'), 'w') as fp:
+            for stack, count in sorted(self.stacks.items()):
+                fp.write('%s %d\n' % (stack, count))
+        kinds = ['stat', 'open', 'listdir', 'spawn']
+        phases = sorted({phase for phase, kind in self.counts})
+        with open(os.path.join(directory, 'profile_counts.txt'), 'w') as fp:
+            fp.write('%-10s' % 'phase' +
+                     ''.join('%10s' % kind for kind in kinds) + '\n')
+            for phase in phases:
+                fp.write('%-10s' % phase + ''.join(
+                    '%10d' % self.counts.get((phase, kind), 0)
+                    for kind in kinds) + '\n')
+        return True
+
+class ToolchainProbes:
+    """Run the commands that ask the toolchain about itself and remember
+    their output.
+
+    Commands run with their output read from pipes (os.popen and the
+    subprocess module need extension modules that aren't built yet).
+    Results are memoized on the command line, the size and mtime of the
+    executable and of any 'inputs' it reads, and the environment
+    variables the compiler looks at, and are kept across builds in
+    'filename'; save() drops the results this build didn't use, so that
+    those of old compilers and environments don't pile up.  prefetch()
+    starts commands in the background, so that independent queries run
+    at once.
+    """
+
+    # Bump this whenever the layout of the cache file changes.
+    version = 2
+
+    environ = ('PATH', 'LIBRARY_PATH', 'CPATH', 'C_INCLUDE_PATH',
+               'COMPILER_PATH', 'GCC_EXEC_PREFIX', 'LD_LIBRARY_PATH')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.results = {}
+        self.used = set()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.runs = 0
+
+    def load(self):
+        try:
+            with open(self.filename, 'rb') as fp:
+                data = marshal.load(fp)
+        except (OSError, EOFError, ValueError, TypeError):
+            return
+        if isinstance(data, dict) and data.get('version') == self.version:
+            self.results = data['results']
+
+    def save(self):
+        with self.lock:
+            data = {'version': self.version,
+                    'results': {key: result for key, result
+                                in self.results.items() if key in self.used}}
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        tmpfile = self.filename + '.tmp'
+        with open(tmpfile, 'wb') as fp:
+            marshal.dump(data, fp)
+        os.replace(tmpfile, self.filename)
+
+    def key(self, argv, inputs, input):
+        executable = find_executable(argv[0]) or argv[0]
+        return (tuple(argv), input,
+                tuple(path_state(path) for path in [executable] + inputs),
+                tuple(os.environ.get(name) for name in self.environ))
+
+    def run(self, argv, inputs=(), input=None):
+        """Run the command 'argv', return (status, stdout, stderr).
+
+        status is the exit status, minus the number of the signal that
+        killed the command, or 127 if it couldn't be run at all.  The
+        bytes 'input', if given, are fed to the command's stdin.
+        """
+        from concurrent.futures import Future
+        key = self.key(argv, list(inputs), input)
+        with self.lock:
+            if key in self.results:
+                self.hits += 1
+                self.used.add(key)
+                return self.results[key]
+            future = self.pending.get(key)
+            if future is None:
+                future = self.pending[key] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return future.result()
+        result = self.spawn(argv, input)
+        with self.lock:
+            self.runs += 1
+            self.results[key] = result
+            self.used.add(key)
+            del self.pending[key]
+        future.set_result(result)
+        return result
+
+    def prefetch(self, commands):
+        for argv in commands:
+            threading.Thread(target=self.run, args=(argv,),
+                             daemon=True).start()
+
+    @staticmethod
+    def spawn(argv, input=None):
+        if not hasattr(os, 'posix_spawnp'):
+            return 127, '', 'os.posix_spawnp() is not available'
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        if input is None:
+            stdin = [(os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0)]
+        else:
+            in_r, in_w = os.pipe()
+            stdin = [(os.POSIX_SPAWN_DUP2, in_r, 0),
+                     (os.POSIX_SPAWN_CLOSE, in_w)]
+        try:
+            pid = os.posix_spawnp(argv[0], argv, os.environ,
+                                  file_actions=stdin + [
+                                      (os.POSIX_SPAWN_DUP2, out_w, 1),
+                                      (os.POSIX_SPAWN_DUP2, err_w, 2)])
+        except OSError as why:
+            os.close(out_r)
+            os.close(err_r)
+            if input is not None:
+                os.close(in_w)
+            return 127, '', str(why)
+        finally:
+            os.close(out_w)
+            os.close(err_w)
+            if input is not None:
+                os.close(in_r)
+
+        # Read stderr and feed stdin on the side so that no pipe can
+        # fill up.
+        def read(fd, chunks):
+            with open(fd, 'rb') as fp:
+                chunks.append(fp.read())
+        def write(fd):
+            try:
+                with open(fd, 'wb') as fp:
+                    fp.write(input)
+            except BrokenPipeError:
+                pass
+        err = []
+        threads = [threading.Thread(target=read, args=(err_r, err))]
+        if input is not None:
+            threads.append(threading.Thread(target=write, args=(in_w,)))
+        for thread in threads:
+            thread.start()
+        out = []
+        read(out_r, out)
+        for thread in threads:
+            thread.join()
+        _, status = os.waitpid(pid, 0)
+        if os.WIFSIGNALED(status):
+            status = -os.WTERMSIG(status)
+        else:
+            status = os.WEXITSTATUS(status)
+        return (status, out[0].decode(errors='replace'),
+                err[0].decode(errors='replace'))
+
+def parse_depfile(filename):
+    """Return the prerequisites of the make rule written by the compiler's
+    -MMD -MF option, or None if 'filename' can't be read."""
+    try:
+        with open(filename) as fp:
+            text = fp.read()
+    except OSError:
+        return None
+    target, sep, prereqs = text.replace('\\\n', ' ').partition(': ')
+    if not sep:
+        return None
+    # Only the first rule matters, -MP adds an empty rule for each header.
+    prereqs = prereqs.split('\n', 1)[0]
+    return [name.replace('\\ ', ' ')
+            for name in re.split(r'(?<!\\)\s+', prereqs.strip()) if name]
+
+def stale_reason(sources, target):
+    """Return why 'target' is out of date with respect to 'sources', as
+    the pair (reason, path), or None if it is up to date.
+
+    This is newer_group(sources, target, 'newer') telling which file
+    triggered the rebuild: the reason is 'missing' for a missing target or
+    source and 'newer' for a source newer than the target.
+    """
+    try:
+        target_mtime = int(os.stat(target).st_mtime)
+    except OSError:
+        return 'missing', target
+    for source in sources:
+        try:
+            mtime = int(os.stat(source).st_mtime)
+        except OSError:
+            return 'missing', source
+        if mtime > target_mtime:
+            return 'newer', source
+    return None
+
+def content_digest(data):
+    """Return a hex digest of the bytes 'data'.
+
+    hashlib may not be importable yet while the interpreter bootstraps its
+    own extensions, fall back to the residues of the data modulo two
+    Mersenne primes, which is plenty to tell build products apart.
+    """
+    try:
+        from _sha256 import sha256
+    except ImportError:
+        try:
+            from _sha2 import sha256
+        except ImportError:
+            sha256 = None
+    if sha256 is not None:
+        return 'sha256-' + sha256(data).hexdigest()
+    n = int.from_bytes(data, 'little')
+    return 'mod-%016x%032x%x' % (n % (2**61 - 1), n % (2**127 - 1), len(data))
+
+class ObjectCache:
+    """Content-addressed cache of compiled objects and linked extensions.
+
+    Entries are keyed on the digest of everything that goes into the
+    product (the preprocessed source or the objects, the compiler and its
+    flags), so they survive checkouts that touch every file and can be
+    shared between build directories.  Each entry is a directory holding
+    the cached files, its mtime records when it was last used; the least
+    recently used entries are evicted once the cache outgrows 'max_size'.
+
+    The paths below 'roots', (directory, placeholder) pairs such as the
+    source and build directories, are replaced with their placeholder in
+    the keys and in the cached depfiles, so that the same tree checked out
+    elsewhere reuses the entries and its depfiles name its own files.
+    """
+
+    def __init__(self, directory, max_size, roots=()):
+        self.directory = directory
+        self.max_size = max_size
+        # The longest first, the build directory may be in the sources.
+        self.roots = sorted(((os.path.join(root, '').encode(),
+                              os.path.join(placeholder, '').encode())
+                             for root, placeholder in roots),
+                            key=lambda root: -len(root[0]))
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+        self.evicted = 0
+
+    def entry(self, key):
+        return os.path.join(self.directory, key[-2:], key)
+
+    def count(self, counter, kind):
+        with self.lock:
+            counter[kind] = counter.get(kind, 0) + 1
+
+    def relocate(self, data, restore=False):
+        """Return the bytes 'data' with the paths below the roots made
+        relative to them, or made absolute again if 'restore' is true."""
+        for root, placeholder in self.roots:
+            if restore:
+                data = data.replace(placeholder, root)
+            else:
+                data = data.replace(root, placeholder)
+        return data
+
+    def fetch(self, kind, key, targets, relocated=()):
+        """Copy the files of the entry 'key' to 'targets', a dict mapping
+        the names of the cached files to their destination, restoring the
+        paths in the files named in 'relocated'.  Return True if the entry
+        was found."""
+        import shutil
+        entry = self.entry(key)
+        try:
+            for name, target in targets.items():
+                if name in relocated:
+                    with open(os.path.join(entry, name), 'rb') as fp:
+                        data = self.relocate(fp.read(), restore=True)
+                    with open(target, 'wb') as fp:
+                        fp.write(data)
+                else:
+                    shutil.copyfile(os.path.join(entry, name), target)
+            os.utime(entry)
+        except OSError:
+            self.count(self.misses, kind)
+            return False
+        self.count(self.hits, kind)
+        return True
+
+    def store(self, key, files, relocated=()):
+        """Add the files of 'files', a dict mapping the names to cache them
+        under to their path, as the entry 'key'.  The paths in the files
+        named in 'relocated' are made relative to the roots."""
+        import shutil
+        entry = self.entry(key)
+        tmpdir = '%s.%d.%d.tmp' % (entry, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(tmpdir)
+            for name, path in files.items():
+                if name in relocated:
+                    with open(path, 'rb') as fp:
+                        data = self.relocate(fp.read())
+                    with open(os.path.join(tmpdir, name), 'wb') as fp:
+                        fp.write(data)
+                else:
+                    shutil.copyfile(path, os.path.join(tmpdir, name))
+            # Another build may have stored the same entry meanwhile.
+            os.rename(tmpdir, entry)
+        except OSError as why:
+            log.debug("can't cache %s: %s", key, why)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def trim(self):
+        """Evict the least recently used entries until the cache fits in
+        its size limit."""
+        import shutil
+        entries = []
+        total = 0
+        try:
+            subdirs = os.listdir(self.directory)
+        except OSError:
+            return
+        for subdir in subdirs:
+            subdir = os.path.join(self.directory, subdir)
+            try:
+                keys = os.listdir(subdir)
+            except OSError:
+                continue
+            for key in keys:
+                entry = os.path.join(subdir, key)
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, name))
+                               for name in os.listdir(entry))
+                    entries.append((os.stat(entry).st_mtime, size, entry))
+                except OSError:
+                    continue
+                total += size
+        entries.sort()
+        for mtime, size, entry in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            self.evicted += 1
+
+    def report(self):
+        for kind in sorted(set(self.hits) | set(self.misses)):
+            log.info("build cache: %d of %d %s files reused",
+                     self.hits.get(kind, 0),
+                     self.hits.get(kind, 0) + self.misses.get(kind, 0), kind)
+        if self.evicted:
+            log.info("build cache: evicted %d entries", self.evicted)
+
+class BuildGraph:
+    """The graph of the dependencies between the extensions to build.
+
+    Only the 'requires' of an extension on other extensions of the same
+    build are edges; extensions built by the Makefile, already up-to-date
+    or not built at all don't constrain the order.
+    """
+
+    def __init__(self, extensions):
+        self.extensions = {ext.name: ext for ext in extensions}
+        self.requires = {}
+        self.dependents = {name: [] for name in self.extensions}
+        for ext in extensions:
+            self.requires[ext.name] = [name for name in ext.requires
+                                       if name in self.extensions]
+            for name in self.requires[ext.name]:
+                self.dependents[name].append(ext.name)
+
+    def topological_order(self):
+        """Return the extensions so that each comes after those it
+        requires, otherwise keeping their order."""
+        order = []
+        state = {}
+        def visit(name, path):
+            if state.get(name) == 'done':
+                return
+            if state.get(name) == 'visiting':
+                raise DistutilsSetupError(
+                    "circular dependency between extensions: %s" %
+                    " -> ".join(path + [name]))
+            state[name] = 'visiting'
+            for required in self.requires[name]:
+                visit(required, path + [name])
+            state[name] = 'done'
+            order.append(self.extensions[name])
+        for name in self.extensions:
+            visit(name, [])
+        return order
+
+    def ranks(self, cost):
+        """Return the cost of the longest path from each extension to the
+        end of the build, 'cost' maps extension names to their own cost."""
+        ranks = {}
+        for ext in reversed(self.topological_order()):
+            name = ext.name
+            ranks[name] = cost.get(name, 0) + max(
+                [ranks[dependent] for dependent in self.dependents[name]],
+                default=0)
+        return ranks
+
+    def critical_path(self, cost):
+        """Return the chain of extensions that bounds the build time."""
+        ranks = self.ranks(cost)
+        if not ranks:
+            return []
+        name = max(self.extensions, key=lambda name: ranks[name])
+        path = [name]
+        while self.dependents[name]:
+            name = max(self.dependents[name], key=lambda name: ranks[name])
+            path.append(name)
+        return path
+
+class ExtensionBuild:
+    """The state of the build of one extension by PyBuildExt.build_all().
+
+    The stale sources of an extension are compiled one by one so that the
+    translation units of all extensions can be spread over the workers;
+    the extension is linked once the last of its objects is ready.
+    """
+
+    def __init__(self, ext, sources, ext_path, macros, language, objects,
+                 stale):
+        self.ext = ext
+        self.sources = sources
+        self.ext_path = ext_path
+        self.macros = macros
+        self.language = language
+        self.objects = objects
+        # The indexes of the sources that have to be compiled.
+        self.stale = stale
+        self.pending = len(stale)
+        self.failed = False
+        # The size of the sources is a good enough estimate of the time
+        # the compiles take.
+        self.cost = 0
+        for index in stale:
+            try:
+                self.cost += os.path.getsize(sources[index])
+            except OSError:
+                pass
+
+# The helper interpreter of ImportChecker.  It reads the names and paths
+# of the extensions to import from stdin, one JSON list per line, and
+# writes a JSON list [status, message, seconds] for each to file
+# descriptor 3, so that what the extensions print can't get in the way.
+IMPORT_CHECK_SCRIPT = """\
+import sys, os, json, time
+import importlib.machinery, importlib.util, importlib._bootstrap
+results = os.fdopen(3, 'w')
+sys.path_importer_cache.clear()
+for line in sys.stdin:
+    name, filename = json.loads(line)
+    start = time.perf_counter()
+    loader = importlib.machinery.ExtensionFileLoader(name, filename)
+    spec = importlib.util.spec_from_file_location(name, filename,
+                                                  loader=loader)
+    try:
+        importlib._bootstrap._load(spec)
+    except ImportError as why:
+        status, message = 'import error', str(why)
+    except BaseException as why:
+        status, message = 'error', '%s: %s' % (type(why).__name__, why)
+    else:
+        status, message = 'ok', ''
+    results.write(json.dumps([status, message,
+                              time.perf_counter() - start]) + '\\n')
+    results.flush()
+"""
+
+class ImportChecker:
+    """Import extensions in helper interpreters, so that an extension that
+    crashes or hangs can't take the build down with it.
+
+    Each of the 'jobs' worker threads keeps a helper interpreter running
+    and hands it the extensions to import one at a time as they are
+    submitted.  The helper is killed if an import takes more than
+    'timeout' seconds; a new one is started for the next extension after
+    a crash or a timeout.  The result of each import is (status, message,
+    seconds), status being one of 'ok', 'import error', 'error', 'crash'
+    or 'timeout'.
+    """
+
+    def __init__(self, jobs, timeout):
+        import queue
+        self.jobs = jobs
+        self.timeout = timeout
+        self.queue = queue.SimpleQueue()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.started = 0
+
+    def submit(self, name, filename):
+        """Queue the import of 'name' from 'filename', return a Future."""
+        from concurrent.futures import Future
+        future = Future()
+        self.queue.put((name, filename, future))
+        if len(self.threads) < self.jobs:
+            thread = threading.Thread(target=self.worker, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return future
+
+    def shutdown(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.started > len(self.threads):
+            log.info("import checks needed %d helper interpreters",
+                     self.started)
+
+    def spawn(self):
+        """Start a helper, return (pid, requests, results)."""
+        argv = [sys.executable]
+        if sys.flags.ignore_environment:
+            argv.append('-E')
+        argv += ['-c', IMPORT_CHECK_SCRIPT]
+        stdin_r, stdin_w = os.pipe()
+        results_r, results_w = os.pipe()
+        try:
+            pid = os.posix_spawn(sys.executable, argv, os.environ,
+                                 file_actions=[
+                                     (os.POSIX_SPAWN_DUP2, stdin_r, 0),
+                                     (os.POSIX_SPAWN_DUP2, results_w, 3),
+                                     (os.POSIX_SPAWN_CLOSE, stdin_w),
+                                     (os.POSIX_SPAWN_CLOSE, results_r)])
+        except:
+            os.close(stdin_w)
+            os.close(results_r)
+            raise
+        finally:
+            os.close(stdin_r)
+            os.close(results_w)
+        with self.lock:
+            self.started += 1
+        return pid, os.fdopen(stdin_w, 'w'), os.fdopen(results_r, 'rb')
+
+    @staticmethod
+    def stop(helper):
+        pid, requests, results = helper
+        try:
+            requests.close()
+        except OSError:
+            pass
+        results.close()
+        _, status = os.waitpid(pid, 0)
+        return status
+
+    def worker(self):
+        helper = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            name, filename, future = item
+            try:
+                if helper is None:
+                    helper = self.spawn()
+                result = self.check(helper, name, filename)
+            except BaseException as why:
+                future.set_exception(why)
+                continue
+            if result[0] in ('crash', 'timeout'):
+                helper = None
+            future.set_result(result)
+        if helper is not None:
+            self.stop(helper)
+
+    def check(self, helper, name, filename):
+        import json
+        pid, requests, results = helper
+        timed_out = []
+        def kill():
+            timed_out.append(True)
+            os.kill(pid, 9)
+        timer = threading.Timer(self.timeout, kill)
+        timer.start()
+        try:
+            requests.write(json.dumps([name, filename]) + '\n')
+            requests.flush()
+            line = results.readline()
+        except BrokenPipeError:
+            line = b''
+        finally:
+            timer.cancel()
+        if line:
+            status, message, seconds = json.loads(line)
+            return status, message, seconds
+        # The helper is gone, with this extension.
+        status = self.stop(helper)
+        if timed_out:
+            return 'timeout', 'no result after %s seconds' % self.timeout, \
+                   self.timeout
+        if os.WIFSIGNALED(status):
+            return 'crash', 'killed by signal %d' % os.WTERMSIG(status), 0.0
+        return 'crash', 'exited with status %d' % os.WEXITSTATUS(status), 0.0
+
+class BundleInstallLib(install_lib):
+    """install_lib that installs the members of the bundle of extensions
+    (see PyBuildExt.link_bundle()) as the symbolic links to it they are
+    built as, where install_lib makes each of them a full copy of the
+    bundle.  The 'install_lib' command of the setup() call must be this
+    class or derive from it for the bundle to be installed once.
+    """
+
+    def copy_tree(self, infile, outfile, preserve_mode=1, preserve_times=1,
+                  preserve_symlinks=0, level=1):
+        if not self.dry_run:
+            # copy_tree() can't make a symbolic link in place of the copy
+            # a previous install left.
+            for dirpath, dirnames, filenames in os.walk(infile):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    target = os.path.join(outfile,
+                                          os.path.relpath(path, infile))
+                    if os.path.islink(path) and os.path.lexists(target):
+                        os.remove(target)
+        return install_lib.copy_tree(self, infile, outfile, preserve_mode,
+                                     preserve_times, 1, level)
+
 class PyBuildExt(build_ext):
 
+    user_options = build_ext.user_options + [
+        ('plan', None,
+         "print what would be compiled and linked, and why, without "
+         "building anything"),
+        ('profile', None,
+         "profile the build, the results go to the build directory "
+         "(see BuildProfiler)"),
+        ]
+    boolean_options = build_ext.boolean_options + ['plan', 'profile']
+
+    def initialize_options(self):
+        build_ext.initialize_options(self)
+        self.plan = 0
+        self.profile = 0
+
+    def run(self):
+        if not (self.profile or os.environ.get('_PYTHON_BUILD_PROFILE')):
+            return build_ext.run(self)
+        profiler = BuildProfiler(self.timer)
+        try:
+            profiler.run(build_ext.run, self)
+        finally:
+            if profiler.write(self.build_temp):
+                log.info("build profile written to %s", self.build_temp)
+
     def __init__(self, dist):
         build_ext.__init__(self, dist)
         self.failed = []
         self.failed_on_import = []
         if '-j' in os.environ.get('MAKEFLAGS', ''):
             self.parallel = True
+        self.python_headers = []
+        self.object_cache = None
+        self.import_checks = {}
+        self.import_checker = None
+        self.import_times = {}
+        self.timer = BuildTimer()
+        self.bundled = set()
+        self.bundle_builds = {}
+        self.check_imports = True
+        self.pgo_profiled = set()
+        self.pch_dirs = {}
+        self.unity_sources = {}
+        self.lto_extensions = set()
+        self.linker = None
+        self.library_digests = {}
+        # The files the build would write or remove before compiling, and
+        # why, when it only plans (see object_is_stale()).
+        self.plan_changes = {}
 
     def build_extensions(self):
 
         # Detect which modules should be compiled
-        missing = self.detect_modules()
+        with self.timer.phase('detect', 'detect_modules'):
+            missing = self.detect_modules()
 
         # Remove modules that are present on the disabled list
+        disabled = [ext.name for ext in self.extensions
+                     if ext.name in disabled_module_list]
         extensions = [ext for ext in self.extensions
                       if ext.name not in disabled_module_list]
-        # move ctypes to the end, it depends on other modules
-        ext_map = dict((ext.name, i) for i, ext in enumerate(extensions))
-        if "_ctypes" in ext_map:
-            ctypes = extensions.pop(ext_map["_ctypes"])
-            extensions.append(ctypes)
-        self.extensions = extensions
+        # Build the extensions after the ones they require
+        self.extensions = BuildGraph(extensions).topological_order()
 
         # Fix up the autodetected modules, prefixing all the source files
         # with Modules/.
@@ -250,9 +1635,12 @@ class PyBuildExt(build_ext):
         self.distribution.scripts = [os.path.join(srcdir, filename)
                                      for filename in self.distribution.scripts]
 
-        # Python header files
+        # Python header files.  Objects are re-compiled when one of them
+        # has been changed, unless the compiler told us which headers they
+        # actually include (see object_is_stale()).
         headers = [sysconfig.get_config_h_filename()]
         headers += glob(os.path.join(sysconfig.get_path('include'), "*.h"))
+        self.python_headers = headers
 
         # The sysconfig variables built by makesetup that list the already
         # built modules and the disabled modules as configured by the Setup
@@ -270,8 +1658,6 @@ class PyBuildExt(build_ext):
                                 for filename in ext.depends ]
             else:
                 ext.depends = []
-            # re-compile extensions if a header file has been changed
-            ext.depends.extend(headers)
 
             # If a module has already been built or has been disabled in the
             # Setup files, don't build it here.
@@ -287,7 +1673,7 @@ class PyBuildExt(build_ext):
             # Remove the shared libraries built by a previous build.
             for ext in mods_configured:
                 fullpath = self.get_ext_fullpath(ext.name)
-                if os.path.exists(fullpath):
+                if os.path.exists(fullpath) and not self.plan:
                     os.unlink(fullpath)
 
         # When you run "make CC-altcc" or something similar, you really want
@@ -302,10 +1688,73 @@ class PyBuildExt(build_ext):
             args['compiler_so'] = compiler + ' ' + ccshared + ' ' + cflags
         self.compiler.set_executables(**args)
 
-        build_ext.build_extensions(self)
-
-        for ext in self.extensions:
-            self.check_extension_import(ext)
+        self.bundled = set(self.bundle_members())
+
+        # Objects and extensions are cached by content in the directory
+        # named by _PYTHON_BUILD_CACHE, if set: by default the build writes
+        # nothing outside of the build directory.
+        cache_dir = os.environ.get('_PYTHON_BUILD_CACHE')
+        if cache_dir and self.use_depfiles():
+            # The size limit is given in megabytes.
+            max_size = int(os.environ.get('_PYTHON_BUILD_CACHE_SIZE', 1024))
+            self.object_cache = ObjectCache(
+                cache_dir, max_size << 20,
+                [(srcdir, '@srcdir@'), (os.path.abspath(os.curdir),
+                                        '@builddir@')])
+
+        self.check_extensions_list(self.extensions)
+        unity = self.prepare_unity()
+        lto = self.prepare_lto()
+        self.select_linker(lto)
+        profiled, training = self.prepare_pgo()
+        with self.timer.phase('pch', 'Python.h'):
+            self.prepare_pch()
+        if self.plan:
+            self.write_plan(missing, disabled, mods_built, mods_disabled)
+            return
+        everything = self.extensions
+        if training is not None:
+            # The training needs the other extensions: build them first,
+            # and the extensions to optimize once it's done.
+            self.extensions = [ext for ext in everything
+                               if ext not in training[0]]
+        with self.timer.phase('build', 'build_all'):
+            self.build_all()
+        self.extensions = everything
+        if training is not None:
+            profiled = self.train_pgo(training)
+            with self.timer.phase('build', 'build_all'):
+                self.build_all()
+        self.retry_without_profile(profiled)
+        self.retry_without_unity(unity)
+        self.link_bundle()
+        self.record_lto_stats(lto)
+        self.write_link_times(os.path.join(self.build_temp, 'link_times.txt'))
+        if self.object_cache is not None:
+            with self.timer.phase('cache', 'trim'):
+                self.object_cache.trim()
+            self.object_cache.report()
+
+        # Most import checks have been started as their extension got
+        # linked, start those of the extensions that were up to date.
+        with self.timer.phase('build', 'import checks'):
+            for ext in self.extensions:
+                self.start_import_check(ext)
+            for ext in self.extensions:
+                self.check_extension_import(ext)
+            if self.import_checker is not None:
+                self.import_checker.shutdown()
+
+        # The timings of the build go to build_trace.json and
+        # build_times.txt in the build directory.
+        os.makedirs(self.build_temp, exist_ok=True)
+        trace = os.path.join(self.build_temp, 'build_trace.json')
+        self.timer.write_trace(trace)
+        self.timer.write_summary(os.path.join(self.build_temp,
+                                              'build_times.txt'))
+        self.timer.save_costs(os.path.join(self.build_temp,
+                                           'build_costs.json'))
+        log.info("build timings written to %s", trace)
 
         longest = max([len(e.name) for e in self.extensions], default=0)
         if self.failed or self.failed_on_import:
@@ -373,36 +1822,1410 @@ class PyBuildExt(build_ext):
                   "APIs, https://github.com/libressl-portable/portable/issues/381")
             print()
 
+    def build_jobs(self):
+        """Return the number of compiler processes to run at once."""
+        if self.parallel is not None and self.parallel is not True:
+            return max(int(self.parallel), 1)
+        if not self.parallel:
+            return 1
+        # Honour "make -jN", which make passes on together with its
+        # jobserver; a plain "make -j" (or the "-j" an old make passes with
+        # --jobserver-fds) gets one job per CPU.
+        m = re.search(r'(?:^|\s)-j\s*(\d+)', os.environ.get('MAKEFLAGS', ''))
+        if m:
+            return max(int(m.group(1)), 1)
+        return os.cpu_count() or 1
+
+    def link_jobs(self):
+        """Return the number of links to run at once, out of the
+        build_jobs() workers: _PYTHON_LINK_JOBS, by default half of them.
+        Links take more memory than compiles, and the fast linkers and
+        link-time optimization run several threads each."""
+        jobs = os.environ.get('_PYTHON_LINK_JOBS')
+        if jobs:
+            return max(int(jobs), 1)
+        return max(self.build_jobs() // 2, 1)
+
+    def build_all(self):
+        """Build self.extensions, compiling the translation units of all
+        of them in parallel on build_jobs() workers.
+
+        An extension is linked once its objects are ready and the
+        extensions it requires are built (see BuildGraph).  Compiles
+        don't wait for anything, the sources of the extensions on the
+        longest chain of dependencies are compiled first.
+        """
+        # concurrent.futures.process can't be imported, see Dummy above.
+        from concurrent.futures import (ThreadPoolExecutor, wait,
+                                        FIRST_COMPLETED)
+
+        builds = {}
+        for ext in self.extensions:
+            build = self.prepare_extension(ext)
+            if build is not None:
+                builds[ext.name] = build
+        graph = BuildGraph([build.ext for build in builds.values()])
+        cost = {name: build.cost for name, build in builds.items()}
+        ranks = graph.ranks(cost)
+        critical_path = graph.critical_path(cost)
+        if len(critical_path) > 1:
+            log.info("critical path: %s", " -> ".join(critical_path))
+
+        order = {ext.name: i for i, ext in enumerate(self.extensions)}
+        compiles = []
+        for name in sorted(builds, key=lambda name: (-ranks[name],
+                                                     order[name])):
+            build = builds[name]
+            compiles.extend((build, i) for i in build.stale)
+        # Compiles are popped from the end, most urgent first.
+        compiles.reverse()
+        links = []
+        waiting = []
+        done_names = set()
+        running = {}
+        jobs = self.build_jobs()
+        link_jobs = self.link_jobs()
+        linking = 0
+
+        def finished(build):
+            # Release the extensions that were waiting for this one.
+            done_names.add(build.ext.name)
+            for other in waiting[:]:
+                if other in waiting and all(
+                        name in done_names
+                        for name in graph.requires[other.ext.name]):
+                    waiting.remove(other)
+                    ready(other)
+
+        def ready(build):
+            # All the objects of 'build' are there.
+            failed = [name for name in build.ext.requires
+                      if name in self.failed]
+            if failed:
+                build.failed = True
+                self.build_failed(build.ext, "required extension %s failed"
+                                  % ", ".join(failed))
+                finished(build)
+            elif all(name in done_names
+                     for name in graph.requires[build.ext.name]):
+                links.append(build)
+            else:
+                waiting.append(build)
+
+        for build in builds.values():
+            if not build.pending:
+                # Nothing to compile, only to link again.
+                ready(build)
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            while compiles or links or running:
+                while len(running) < jobs:
+                    # Link as soon as an extension can be, before going on
+                    # with the compiles of the others.
+                    if links and linking < link_jobs:
+                        build = links.pop(0)
+                        future = executor.submit(self.link_extension, build)
+                        running[future] = (build, None)
+                        linking += 1
+                        continue
+                    if not compiles:
+                        break
+                    build, index = compiles.pop()
+                    if build.failed:
+                        continue
+                    future = executor.submit(self.compile_source, build,
+                                             index)
+                    running[future] = (build, index)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    build, index = running.pop(future)
+                    if index is None:
+                        linking -= 1
+                    try:
+                        result = future.result()
+                    except (CCompilerError, DistutilsError) as why:
+                        if not build.failed:
+                            build.failed = True
+                            self.build_failed(build.ext, why)
+                            finished(build)
+                        continue
+                    if index is None:
+                        self.start_import_check(build.ext)
+                        finished(build)
+                    elif not build.failed:
+                        build.pending -= 1
+                        if not build.pending:
+                            ready(build)
+
     def build_extension(self, ext):
+        build = self.prepare_extension(ext)
+        if build is None:
+            return
+        failed = [name for name in ext.requires if name in self.failed]
+        if failed:
+            self.build_failed(ext, "required extension %s failed"
+                              % ", ".join(failed))
+            return
+        try:
+            for index in build.stale:
+                self.compile_source(build, index)
+            self.link_extension(build)
+        except (CCompilerError, DistutilsError) as why:
+            self.build_failed(ext, why)
+        else:
+            self.start_import_check(ext)
 
+    def build_failed(self, ext, why):
+        self.announce('WARNING: building of extension "%s" failed: %s' %
+                      (ext.name, why))
+        self.failed.append(ext.name)
+
+    def prepare_extension(self, ext):
+        """Return the ExtensionBuild for 'ext', or None if there is nothing
+        to build."""
         if ext.name == '_ctypes':
             if not self.configure_ctypes(ext):
                 self.failed.append(ext.name)
+                return None
+
+        missing = [path for path in ext.generated if not os.path.exists(path)]
+        if missing:
+            self.build_failed(ext, "%s not generated by the Makefile"
+                              % ", ".join(missing))
+            return None
+
+        sources = ext.sources
+        if sources is None or not isinstance(sources, (list, tuple)):
+            raise DistutilsSetupError(
+                  "in 'ext_modules' option (extension '%s'), "
+                  "'sources' must be present and must be "
+                  "a list of source filenames" % ext.name)
+        # sort to make the resulting .so file build reproducible
+        sources = sorted(sources)
+
+        ext_path = self.get_ext_fullpath(ext.name)
+        sources = self.swig_sources(sources, ext)
+        objects = self.compiler.object_filenames(sources,
+                                                 output_dir=self.build_temp)
+        compiles, relink = self.staleness(ext, sources, objects, ext_path)
+        if relink is None:
+            log.debug("skipping '%s' extension (up-to-date)", ext.name)
+            return None
+        if relink[0] == 'unbundled':
+            os.remove(ext_path)
+        log.info("building '%s' extension", ext.name)
+        stale = sorted(compiles)
+
+        language = ext.language or self.compiler.detect_language(sources)
+        return ExtensionBuild(ext, sources, ext_path, self.ext_macros(ext),
+                              language, objects, stale)
+
+    @staticmethod
+    def ext_macros(ext):
+        """Return the macros of 'ext' in the form CCompiler.compile()
+        takes them."""
+        macros = ext.define_macros[:]
+        for undef in ext.undef_macros:
+            macros.append((undef,))
+        return macros
+
+    def use_depfiles(self):
+        """Return True if the compiler can write the headers included by
+        each object to a depfile (the -MMD and -MF options of gcc and
+        clang)."""
+        if self.compiler.compiler_type != 'unix':
+            return False
+        # Skip wrappers such as ccache.
+        for word in self.compiler.compiler_so[:2]:
+            name = os.path.basename(word)
+            if 'gcc' in name or 'clang' in name:
+                return True
+            if name == 'cc' and host_platform.startswith(('linux', 'darwin')):
+                return True
+        return False
+
+    def object_is_stale(self, ext, source, obj):
+        """Return why 'obj' has to be compiled again (see stale_reason()),
+        or None."""
+        deps = None
+        if self.use_depfiles():
+            deps = parse_depfile(obj + '.d')
+        if deps is None:
+            # Fall back to all the headers an extension could include.
+            deps = [source] + self.python_headers
+        for path in [obj] + deps + ext.depends:
+            if path in self.plan_changes:
+                return self.plan_changes[path], path
+        return stale_reason(deps + ext.depends, obj)
+
+    def staleness(self, ext, sources, objects, ext_path):
+        """Return why each source of 'ext' has to be compiled, a dict
+        mapping the indexes of the stale ones to (reason, path), and why
+        'ext' has to be linked again, or None if it is up to date.
+
+        Nothing is changed on disk, this is shared by prepare_extension()
+        and the --plan option.
+        """
+        compiles = {}
+        for index, (source, obj) in enumerate(zip(sources, objects)):
+            if self.force:
+                compiles[index] = ('forced', source)
+                continue
+            reason = self.object_is_stale(ext, source, obj)
+            if reason is not None:
+                compiles[index] = reason
+        if compiles:
+            relink = ('compiled', sources[min(compiles)])
+        elif ext.name not in self.bundled and os.path.islink(ext_path):
+            # Left by a build that linked it into the bundle.
+            relink = ('unbundled', ext_path)
+        else:
+            relink = stale_reason(objects + ext.extra_objects + ext.depends,
+                                  ext_path)
+        return compiles, relink
+
+    def write_plan(self, missing, disabled, mods_built, mods_disabled):
+        """Print what a build would do as JSON, and save it as
+        build_plan.json in the build directory.
+
+        Each extension has an 'action': 'compile' (some sources are stale),
+        'link' (only linking again), 'up-to-date' or 'fail', the file that
+        triggered each compile and the link, and an estimate of the time
+        they take from the durations of previous builds (see
+        BuildTimer.save_costs()); null when a step has never been timed.
+        The extensions are planned as prepared for the build, their
+        sources, flags and dependencies changed by the prepare_*() steps,
+        which only note in self.plan_changes the files they would write.
+        'unity' lists the extensions compiled as one translation unit,
+        'lto' those built with link-time optimization and 'pgo' those
+        compiled with a profile, 'pgo_training' tells whether the build
+        would first run the training to make it.  'pch' lists the
+        extensions compiled with a precompiled Python.h.  'linker' is the
+        linker picked by select_linker(), 'linker_check' tells whether
+        the build would check the candidates first.
+        Nothing is compiled and no file of the build is touched.
+        """
+        import json
+        costs = BuildTimer.load_costs(os.path.join(self.build_temp,
+                                                   'build_costs.json'))
+        def step(category, name, reason):
+            return {'name': name, 'reason': reason[0], 'trigger': reason[1],
+                    'seconds': costs[category].get(name)}
+
+        entries = []
+        bundle = {'name': bundle_name, 'members': sorted(self.bundled),
+                  'link': None}
+        bundle_inputs = []
+        for ext in self.extensions:
+            entry = {'name': ext.name, 'action': 'up-to-date',
+                     'compile': [], 'link': None}
+            if ext.name in self.bundled:
+                entry['bundle'] = bundle_name
+            entries.append(entry)
+            generated = [path for path in ext.generated
+                         if not os.path.exists(path)]
+            if generated:
+                entry['action'] = 'fail'
+                entry['link'] = {'name': ext.name, 'reason': 'not generated',
+                                 'trigger': generated[0], 'seconds': None}
+                continue
+            sources = sorted(ext.sources)
+            objects = self.compiler.object_filenames(
+                sources, output_dir=self.build_temp)
+            ext_path = self.get_ext_fullpath(ext.name)
+            compiles, relink = self.staleness(ext, sources, objects, ext_path)
+            entry['compile'] = [step('compile', sources[index], reason)
+                                for index, reason in sorted(compiles.items())]
+            if ext.name in self.bundled:
+                bundle_inputs += objects + ext.extra_objects + ext.depends
+                if relink is not None and bundle['link'] is None:
+                    bundle['link'] = step('link', bundle_name, relink)
+            elif relink is not None:
+                entry['link'] = step('link', ext.name, relink)
+            if compiles:
+                entry['action'] = 'compile'
+            elif entry['link'] is not None:
+                entry['action'] = 'link'
+        names = sorted(entry['name'] for entry in entries
+                       if 'bundle' in entry and entry['action'] != 'fail')
+        if (self.bundled and bundle['link'] is None and
+                self.linked_bundle_members() != names):
+            bundle['link'] = step('link', bundle_name, (
+                'members', os.path.join(self.build_temp, 'bundle.json')))
+        if self.bundled and bundle['link'] is None:
+            relink = stale_reason(bundle_inputs,
+                                  self.get_ext_fullpath(bundle_name))
+            if relink is not None:
+                bundle['link'] = step('link', bundle_name, relink)
+
+        steps = [entry['link'] for entry in entries
+                 if entry['action'] != 'fail']
+        for entry in entries:
+            steps += entry['compile']
+        steps.append(bundle['link'])
+        seconds = [s['seconds'] for s in steps if s is not None]
+        plan = {
+            'extensions': entries,
+            'bundle': bundle if self.bundled else None,
+            'built_by_makefile': [ext.name for ext in mods_built],
+            'disabled_in_setup': [ext.name for ext in mods_disabled],
+            'disabled': disabled,
+            'missing': sorted(missing),
+            'estimated_seconds': round(sum(s for s in seconds
+                                           if s is not None), 3),
+            'untimed_steps': seconds.count(None),
+            'jobs': self.build_jobs(),
+            'unity': sorted(self.unity_sources),
+            'lto': sorted(self.lto_extensions),
+            'pgo': sorted(self.pgo_profiled),
+            'pgo_training': 'pgo training' in self.plan_changes.values(),
+            'linker': self.linker or 'default',
+            'linker_check': 'linker check' in self.plan_changes.values(),
+            'pch': sorted(ext.name for ext in self.extensions
+                          if self.pch_key(list(ext.extra_compile_args or []),
+                                          self.ext_macros(ext))
+                          in self.pch_dirs),
+            }
+        text = json.dumps(plan, indent=1)
+        os.makedirs(self.build_temp, exist_ok=True)
+        with open(os.path.join(self.build_temp, 'build_plan.json'), 'w') as fp:
+            fp.write(text + '\n')
+        print(text)
+
+    def compiler_identity(self):
+        """Return the command line of the compiler and linker, together
+        with the size and mtime of the compiler itself."""
+        executables = []
+        # Look past wrappers such as ccache.
+        for word in self.compiler.compiler_so[:2]:
+            path = find_executable(word)
+            if path is not None:
+                state = path_state(os.path.realpath(path))
+                executables.append((word, state[0], state[2]))
+        return repr((self.compiler.compiler_so, self.compiler.linker_so,
+                     executables))
+
+    def object_key(self, build, index, extra_args):
+        """Return the cache key of an object: the digest of its source after
+        preprocessing together with the compiler and its flags, or None if
+        the source can't be preprocessed."""
+        from distutils.ccompiler import gen_preprocess_options
+        ext = build.ext
+        pp_opts = gen_preprocess_options(
+            self.compiler.macros + build.macros,
+            (ext.include_dirs or []) + self.compiler.include_dirs)
+        compiler_so = self.compiler.compiler_so
+        if compiler_so.count('-arch') > 1:
+            # Universal builds can't preprocess for all archs at once.
+            return None
+        ifile = build.objects[index] + '.i'
+        try:
+            self.compiler.mkpath(os.path.dirname(ifile))
+            self.compiler.spawn(compiler_so + pp_opts + extra_args +
+                                ['-E', build.sources[index], '-o', ifile])
+            with open(ifile, 'rb') as fp:
+                preprocessed = fp.read()
+            os.remove(ifile)
+        except (DistutilsExecError, OSError):
+            return None
+        flags = repr((self.compiler_identity(), pp_opts, extra_args,
+                      self.debug)).encode()
+        # The line markers and __FILE__ name the sources by their path.
+        data = self.object_cache.relocate(b'object\0' + flags + b'\0' +
+                                          preprocessed)
+        return content_digest(data)
+
+    def compile_source(self, build, index):
+        """Compile one source file of an extension."""
+        ext = build.ext
+        obj = build.objects[index]
+        extra_args = list(ext.extra_compile_args or [])
+        source = build.sources[index]
+        key = None
+        # The cache keys don't cover the profile data.
+        if (self.object_cache is not None and
+                ext.name not in self.pgo_profiled):
+            with self.timer.phase('cache', source):
+                key = self.object_key(build, index, extra_args)
+                files = {'o': obj, 'd': obj + '.d'}
+                hit = (key is not None and
+                       self.object_cache.fetch('object', key, files,
+                                               ('d',)))
+            if hit:
                 return
+        include_dirs = ext.include_dirs
+        pch_dir = self.pch_dirs.get(self.pch_key(extra_args, build.macros))
+        if pch_dir is not None and source.endswith('.c'):
+            include_dirs = [pch_dir] + include_dirs
+        if self.use_depfiles():
+            extra_args += ['-MMD', '-MF', obj + '.d']
+        with self.timer.phase('compile', source, ext=ext.name):
+            self.compiler.compile([source],
+                                  output_dir=self.build_temp,
+                                  macros=build.macros,
+                                  include_dirs=include_dirs,
+                                  debug=self.debug,
+                                  extra_postargs=extra_args,
+                                  depends=ext.depends)
+        if include_dirs is not ext.include_dirs and self.use_depfiles():
+            # gcc leaves out the headers read from the precompiled one,
+            # depend on it instead: prepare_pch() makes it again when one
+            # of them changes.
+            with open(obj + '.d') as fp:
+                text = fp.read()
+            gch = os.path.join(pch_dir, 'Python.h.gch').replace(' ', '\\ ')
+            with open(obj + '.d', 'w') as fp:
+                fp.write(text.replace(': ', ': %s ' % gch, 1))
+        if key is not None:
+            self.object_cache.store(key, files, ('d',))
+
+    def pch_key(self, extra_args, macros):
+        """Return what a precompiled Python.h depends on: the compiler,
+        its flags and the macros."""
+        return repr((self.compiler.compiler_so,
+                     self.compiler.macros + macros, extra_args, self.debug))
+
+    def prepare_pch(self):
+        """Precompile Python.h for each combination of flags and macros
+        (see pch_key()) shared by several extensions, in self.pch_dirs.
+
+        Each directory holds a Python.h including the real one, and the
+        Python.h.gch made from it.  gcc reads the latter in its place,
+        unless the source defines macros before including it or its
+        flags differ, and falls back to parsing the headers.  Extensions
+        with macros of their own, such as Py_LIMITED_API for xxlimited,
+        are compiled as usual.  Only gcc looks up precompiled headers for
+        #include; set _PYTHON_PRECOMPILED_HEADER to 0 to disable them.
+        """
+        if os.environ.get('_PYTHON_PRECOMPILED_HEADER') == '0':
+            return
+        if (self.pgo_compiler() != 'gcc' or
+                self.compiler.compiler_so.count('-arch') > 1):
+            return
+        found = find_file('Python.h', [], self.compiler.include_dirs)
+        if not found:
+            return
+        header = os.path.abspath(os.path.join(found[0], 'Python.h'))
+
+        users = {}
+        for ext in self.extensions:
+            if ext.name in self.failed or not any(
+                    source.endswith('.c') for source in ext.sources):
+                continue
+            key = self.pch_key(list(ext.extra_compile_args or []),
+                               self.ext_macros(ext))
+            users.setdefault(key, []).append(ext)
+        keys = [key for key in users if len(users[key]) > 1]
+        if not keys:
+            return
 
+        from concurrent.futures import ThreadPoolExecutor
+        from distutils.ccompiler import gen_preprocess_options
+        def precompile(key):
+            ext = users[key][0]
+            pch_dir = os.path.join(self.build_temp, 'pch',
+                                   content_digest(key.encode())[-16:])
+            wrapper = os.path.join(pch_dir, 'Python.h')
+            gch = wrapper + '.gch'
+            text = '#include "%s"\n' % header
+            try:
+                with open(wrapper) as fp:
+                    current = fp.read()
+            except OSError:
+                current = None
+            deps = parse_depfile(gch + '.d')
+            if deps is None:
+                deps = [wrapper] + self.python_headers
+            stale = (self.force or current != text or
+                     stale_reason(deps, gch) is not None)
+            if stale and self.plan:
+                self.plan_changes[gch] = 'precompiled header'
+                return pch_dir
+            if current != text:
+                os.makedirs(pch_dir, exist_ok=True)
+                with open(wrapper, 'w') as fp:
+                    fp.write(text)
+            if stale:
+                pp_opts = gen_preprocess_options(
+                    self.compiler.macros + self.ext_macros(ext),
+                    self.compiler.include_dirs)
+                self.compiler.spawn(
+                    self.compiler.compiler_so + pp_opts +
+                    (['-g'] if self.debug else []) +
+                    list(ext.extra_compile_args or []) +
+                    ['-MMD', '-MF', gch + '.d',
+                     '-x', 'c-header', wrapper, '-o', gch])
+            return pch_dir
+
+        with ThreadPoolExecutor(min(len(keys), self.build_jobs())) as pool:
+            futures = {key: pool.submit(precompile, key) for key in keys}
+        for key, future in futures.items():
+            try:
+                self.pch_dirs[key] = future.result()
+            except (DistutilsExecError, OSError) as why:
+                self.announce('WARNING: precompiling Python.h for %s failed: '
+                              '%s' % (", ".join(ext.name
+                                                for ext in users[key]), why),
+                              level=3)
+        if self.pch_dirs:
+            log.info("using a precompiled Python.h in %d variants for %d "
+                     "extensions", len(self.pch_dirs),
+                     sum(len(users[key]) for key in self.pch_dirs))
+
+    def link_key(self, build, objects, libraries, export_symbols):
+        """Return the cache key of an extension: the digest of its objects
+        together with the linker and its flags."""
+        ext = build.ext
+        data = [b'shared']
+        for obj in objects:
+            with open(obj, 'rb') as fp:
+                data.append(fp.read())
+        # A static library such as libmpdec.a goes into the extension as
+        # much as its objects do.
+        library_dirs = (list(ext.library_dirs or []) +
+                        self.compiler.library_dirs)
+        for library in libraries:
+            path = self.compiler.find_library_file(library_dirs, library)
+            data.append(self.library_digest(path).encode())
+        flags = (self.compiler_identity(), os.path.basename(build.ext_path),
+                 libraries, ext.library_dirs, ext.runtime_library_dirs,
+                 ext.extra_link_args, export_symbols, self.debug,
+                 build.language)
+        data.append(repr(flags).encode())
+        return content_digest(b'\0'.join(data))
+
+    def library_digest(self, path):
+        """Return the digest of the library 'path' (empty if None),
+        computed once per build for each state of the file."""
+        if path is None:
+            return ''
+        state = path_state(path)
+        digest = self.library_digests.get(path)
+        if digest is None or digest[0] != state:
+            with open(path, 'rb') as fp:
+                digest = (state, content_digest(fp.read()))
+            self.library_digests[path] = digest
+        return digest[1]
+
+    def link_extension(self, build):
+        ext = build.ext
+        if ext.name in self.bundled:
+            # Linked together with the other members by link_bundle().
+            self.bundle_builds[ext.name] = build
+            return
+        objects = build.objects + list(ext.extra_objects or [])
+        libraries = self.get_libraries(ext)
+        export_symbols = self.get_export_symbols(ext)
+        key = None
+        if (self.object_cache is not None and
+                ext.name not in self.pgo_profiled):
+            with self.timer.phase('cache', ext.name):
+                try:
+                    key = self.link_key(build, objects, libraries,
+                                        export_symbols)
+                except OSError:
+                    hit = False
+                else:
+                    self.compiler.mkpath(os.path.dirname(build.ext_path))
+                    files = {'so': build.ext_path}
+                    hit = self.object_cache.fetch('shared object', key,
+                                                  files)
+            if hit:
+                return
+        # distutils only compares the objects with the extension, and
+        # would skip the links prepare_extension() asks for other reasons
+        # (a changed dependency, flags, or objects restored by the cache).
+        if os.path.lexists(build.ext_path):
+            os.remove(build.ext_path)
+        with self.timer.phase('link', ext.name):
+            self.compiler.link_shared_object(
+                objects, build.ext_path,
+                libraries=libraries,
+                library_dirs=ext.library_dirs,
+                runtime_library_dirs=ext.runtime_library_dirs,
+                extra_postargs=ext.extra_link_args or [],
+                export_symbols=export_symbols,
+                debug=self.debug,
+                build_temp=self.build_temp,
+                target_lang=build.language)
+        if key is not None:
+            self.object_cache.store(key, files)
+
+    def bundle_members(self):
+        """Return the names of the extensions to link into one shared
+        object, as listed by _PYTHON_BUNDLE_EXTENSIONS.
+
+        The value is a list of extension names separated by commas or
+        spaces, or "default" for default_bundle.  Extensions that require,
+        or are required by, other extensions and C++ extensions are left
+        out.
+        """
+        value = os.environ.get('_PYTHON_BUNDLE_EXTENSIONS', '').strip()
+        if value == 'default':
+            names = default_bundle
+        else:
+            names = value.replace(',', ' ').split()
+        graph = BuildGraph(self.extensions)
+        members = []
+        for ext in self.extensions:
+            if ext.name not in names:
+                continue
+            language = (ext.language or
+                        self.compiler.detect_language(ext.sources) or 'c')
+            if (graph.requires[ext.name] or graph.dependents[ext.name] or
+                    language != 'c'):
+                log.info("not bundling '%s' extension", ext.name)
+                continue
+            members.append(ext.name)
+        # A bundle of one is just a renamed extension.
+        if len(members) < 2:
+            return []
+        return members
+
+    def link_bundle(self):
+        """Link the members of the bundle into one shared object, and make
+        the file name of each member a symlink to it.
+
+        The dynamic loader maps the shared object once, whichever of the
+        names it's opened by, and importing a member finds its PyInit_
+        function there, as with _testimportmultiple.  If the bundle can't
+        be linked, say because two members define the same symbol, the
+        members are linked on their own.  BundleInstallLib installs the
+        symlinks as they are.
+        """
+        if not self.bundled:
+            return
+        members = [ext for ext in self.extensions
+                   if ext.name in self.bundled and ext.name not in self.failed]
+        objects = []
+        libraries = []
+        library_dirs = []
+        runtime_library_dirs = []
+        extra_link_args = []
+        depends = []
+        builds = []
+        for ext in members:
+            build = self.bundle_builds.pop(ext.name, None)
+            if build is None:
+                # Up to date, but its objects still go into the bundle.
+                sources = self.swig_sources(sorted(ext.sources), ext)
+                build = ExtensionBuild(
+                    ext, sources, self.get_ext_fullpath(ext.name), [], 'c',
+                    self.compiler.object_filenames(
+                        sources, output_dir=self.build_temp), [])
+            builds.append(build)
+            # math and cmath are both linked with Modules/_math.o.
+            for obj in build.objects + list(ext.extra_objects or []):
+                obj = os.path.normpath(obj)
+                if obj not in objects:
+                    objects.append(obj)
+            for value, merged in ((ext.libraries, libraries),
+                                  (ext.library_dirs, library_dirs),
+                                  (ext.runtime_library_dirs,
+                                   runtime_library_dirs),
+                                  (ext.extra_link_args, extra_link_args),
+                                  (ext.depends, depends)):
+                for item in value or []:
+                    if item not in merged:
+                        merged.append(item)
+
+        bundle_ext = Extension(bundle_name, [], libraries=libraries,
+                               library_dirs=library_dirs,
+                               runtime_library_dirs=runtime_library_dirs,
+                               extra_link_args=extra_link_args,
+                               extra_objects=objects)
+        bundle = ExtensionBuild(bundle_ext, [], self.get_ext_fullpath(
+            bundle_name), [], 'c', [], [])
+        names = sorted(ext.name for ext in members)
         try:
-            build_ext.build_extension(self, ext)
+            # The objects of an extension built on its own before it was
+            # added to the bundle are older than the bundle.
+            if (self.force or self.linked_bundle_members() != names or
+                    stale_reason(objects + depends, bundle.ext_path)):
+                log.info("linking %d extensions into '%s'", len(builds),
+                         bundle_name)
+                self.link_extension(bundle)
+                self.linked_bundle_members(names)
         except (CCompilerError, DistutilsError) as why:
-            self.annouce('WARNING: building of extension "%s" failed: %s' %
-                         (ext.name, sys.exc_info()[1]))
-            self.failed.append(ext.name)
+            self.announce('WARNING: linking the bundle of extensions failed, '
+                          'linking them one by one: %s' % why, level=3)
+            self.bundled = set()
+            for build in builds:
+                if os.path.islink(build.ext_path):
+                    os.remove(build.ext_path)
+                try:
+                    self.link_extension(build)
+                except (CCompilerError, DistutilsError) as why:
+                    self.build_failed(build.ext, why)
             return
 
-    def check_extension_import(self, ext):
+        for build in builds:
+            path = build.ext_path
+            target = os.path.relpath(bundle.ext_path, os.path.dirname(path))
+            if os.path.islink(path) and os.readlink(path) == target:
+                continue
+            self.compiler.mkpath(os.path.dirname(path))
+            tmp = path + '.tmp'
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            os.symlink(target, tmp)
+            os.replace(tmp, path)
+
+    def linked_bundle_members(self, names=None):
+        """Return the sorted names of the extensions the bundle was last
+        linked with, kept in build_temp/bundle.json, or None.  Keep
+        'names' instead if given."""
+        import json
+        filename = os.path.join(self.build_temp, 'bundle.json')
+        if names is not None:
+            os.makedirs(self.build_temp, exist_ok=True)
+            with open(filename, 'w') as fp:
+                json.dump(names, fp)
+            return names
+        try:
+            with open(filename) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def pgo_compiler(self):
+        """Return the flavour of profile-guided optimization the compiler
+        supports, 'gcc' or 'clang', or None."""
+        if not self.use_depfiles():
+            return None
+        for word in self.compiler.compiler_so[:2]:
+            name = os.path.basename(word)
+            if 'clang' in name or (name == 'cc' and host_platform == 'darwin'):
+                return 'clang'
+        return 'gcc'
+
+    def prepare_pgo(self):
+        """Set up the profile-guided optimization of the extensions named
+        by _PYTHON_PGO_EXTENSIONS, a list or "default" for default_pgo.
+
+        The profile is reused while it matches the sources, the compiler
+        and the training script.  Return the (extension, flags) pairs
+        compiled with it, and None or, when there is no valid profile,
+        what train_pgo() needs to make a new one once the other
+        extensions are built.
+        """
+        value = os.environ.get('_PYTHON_PGO_EXTENSIONS', '').strip()
+        if value == 'default':
+            names = default_pgo
+        else:
+            names = value.replace(',', ' ').split()
+        exts = [ext for ext in self.extensions if ext.name in names]
+        kind = self.pgo_compiler() if exts else None
+        if exts and (kind is None or cross_compiling):
+            log.info("skipping profile-guided optimization: %s",
+                     "can't run the training when cross-compiling"
+                     if kind else "the compiler is not gcc or clang")
+            exts = []
+        if not exts:
+            self.switch_modes('pgo.json', {})
+            return [], None
+
+        pgo_dir = os.path.join(self.build_temp, 'pgo')
+        profile_dir = os.path.join(pgo_dir, 'profile')
+        stamp = os.path.join(pgo_dir, 'profile.stamp')
+        script = self.training_script()
+        data = [self.compiler_identity().encode()]
+        for path in [script] + [path for ext in exts
+                                for path in sorted(ext.sources) + ext.depends]:
+            try:
+                with open(path, 'rb') as fp:
+                    data.append(fp.read())
+            except OSError:
+                data.append(b'')
+        fingerprint = content_digest(b'\0'.join(data))
+
+        if kind == 'clang':
+            profdata = os.path.join(pgo_dir, 'merged.profdata')
+            flags = ['-fprofile-use=' + profdata,
+                     '-Wno-profile-instr-out-of-date',
+                     '-Wno-profile-instr-unprofiled']
+        else:
+            flags = ['-fprofile-use=' + profile_dir, '-fprofile-correction',
+                     '-Wno-missing-profile', '-Wno-error=coverage-mismatch']
+        try:
+            with open(stamp) as fp:
+                valid = fp.read() == fingerprint
+        except OSError:
+            valid = False
+        if not valid and self.plan:
+            # Planned as built with the profile the training would make.
+            self.plan_changes[stamp] = 'pgo training'
+        elif not valid:
+            return [], (exts, kind, script, flags, stamp, fingerprint)
+        return self.use_profile(exts, flags, stamp, fingerprint), None
+
+    def use_profile(self, exts, flags, stamp, fingerprint):
+        """Compile 'exts' with the profile-use 'flags', return the
+        (extension, flags) pairs."""
+        profiled = []
+        for ext in exts:
+            ext.extra_compile_args = list(ext.extra_compile_args or []) + flags
+            # Compiled again whenever the profile changes.
+            ext.depends = ext.depends + [stamp]
+            self.pgo_profiled.add(ext.name)
+            profiled.append((ext, flags))
+        self.pgo_fingerprint = fingerprint
+        self.switch_modes('pgo.json', {ext.name: fingerprint for ext in exts})
+        return profiled
+
+    def train_pgo(self, training):
+        """Make the profile described by 'training' (see prepare_pgo())
+        against the extensions built so far, return the (extension, flags)
+        pairs to compile with it, none if the training failed."""
+        exts, kind, script, flags, stamp, fingerprint = training
+        with self.timer.phase('pgo', 'train'):
+            trained = self.pgo_train(exts, kind, script,
+                                     os.path.dirname(stamp))
+        if not trained:
+            self.switch_modes('pgo.json', {})
+            return []
+        with open(stamp, 'w') as fp:
+            fp.write(fingerprint)
+        return self.use_profile(exts, flags, stamp, fingerprint)
+
+    def pgo_train(self, exts, kind, script, pgo_dir):
+        """Build 'exts' instrumented and run the training 'script' against
+        them, with the extensions of the build after them on sys.path, and
+        return True if a profile was written to 'pgo_dir'.
+
+        The script is given the names of 'exts' and must exit with a
+        non-zero status if it couldn't exercise one of them (see
+        Tools/scripts/pgo_training.py), the profile would be incomplete.
+        The instrumented objects take the place of the normal ones, so
+        that gcc finds the profile of each object under its name, and are
+        removed once the training is over.
+        """
+        import shutil
+        profile_dir = os.path.join(pgo_dir, 'profile')
+        if os.path.isdir(profile_dir):
+            shutil.rmtree(profile_dir)
+        os.makedirs(profile_dir)
+        generate = ['-fprofile-generate=' + profile_dir]
+        instrumented = []
+        for ext in exts:
+            ext = copy.copy(ext)
+            ext.extra_compile_args = (list(ext.extra_compile_args or []) +
+                                      generate)
+            ext.extra_link_args = list(ext.extra_link_args or []) + generate
+            instrumented.append(ext)
+        log.info("building %d extensions instrumented for profile-guided "
+                 "optimization", len(exts))
+        build = copy.copy(self)
+        build.extensions = instrumented
+        build.build_lib = os.path.join(pgo_dir, 'lib')
+        build.force = True
+        build.failed = []
+        build.bundled = set()
+        build.bundle_builds = {}
+        build.object_cache = None
+        build.check_imports = False
+        # The instrumented compiles and links are no estimate of the
+        # normal ones (see BuildTimer.save_costs()).
+        build.timer = BuildTimer()
+        build.build_all()
+
+        trained = False
+        if build.failed:
+            why = "building %s failed" % ", ".join(build.failed)
+        else:
+            log.info("running the training workload %s", script)
+            with self.timer.phase('pgo', 'training'):
+                status, out, err = ToolchainProbes.spawn(
+                    [sys.executable, '-c', PGO_TRAINING_WRAPPER,
+                     os.pathsep.join([build.build_lib, self.build_lib]),
+                     script] + [ext.name for ext in exts])
+            if kind == 'clang':
+                profiles = glob(os.path.join(profile_dir, '*.profraw'))
+            else:
+                profiles = glob(os.path.join(profile_dir, '**', '*.gcda'),
+                                recursive=True)
+            merger = find_executable('llvm-profdata')
+            if status != 0:
+                lines = err.strip().splitlines() or ['exit status %d' % status]
+                why = "the training failed: %s" % lines[-1]
+            elif not profiles:
+                why = "the training wrote no profile"
+            elif kind == 'gcc':
+                trained = True
+            elif merger is None:
+                why = "llvm-profdata is not installed"
+            else:
+                status, out, err = ToolchainProbes.spawn(
+                    [merger, 'merge', '-output=' +
+                     os.path.join(pgo_dir, 'merged.profdata')] + profiles)
+                trained = status == 0
+                why = "llvm-profdata failed: %s" % err.strip()
+        # Don't let the instrumented objects pass for up to date.
+        for ext in exts:
+            self.remove_objects(ext, 'pgo training')
+        if not trained:
+            self.announce("WARNING: skipping profile-guided optimization, %s"
+                          % why, level=3)
+        return trained
+
+    def prepare_unity(self):
+        """Compile the C sources of each extension named by
+        _PYTHON_UNITY_BUILD, a list of extension names, as a single
+        translation unit that includes them all.
+
+        Python.h and the headers shared by the sources are parsed once
+        and the compiler can inline across them.  Sources that define
+        the same static names or macros can miscompile rather than fail
+        when merged, so extensions are only built this way when named,
+        and sources listed in unity_exclude or _PYTHON_UNITY_EXCLUDE are
+        compiled on their own.  Return the (extension, original sources)
+        pairs changed.
+        """
+        names = os.environ.get('_PYTHON_UNITY_BUILD', '').replace(
+            ',', ' ').split()
+        exclude = {name: list(sources)
+                   for name, sources in unity_exclude.items()}
+        for item in os.environ.get('_PYTHON_UNITY_EXCLUDE', '').replace(
+                ',', ' ').split():
+            name, _, source = item.partition(':')
+            exclude.setdefault(name, []).append(source)
+
+        unity_dir = os.path.join(self.build_temp, 'unity')
+        changed = []
+        for ext in self.extensions:
+            if ext.name not in names:
+                continue
+            excluded = exclude.get(ext.name, [])
+            merged = [source for source in ext.sources
+                      if source.endswith('.c') and not any(
+                          source == name or source.endswith(os.sep + name)
+                          for name in excluded)]
+            if len(merged) < 2:
+                continue
+            filename = os.path.join(unity_dir, ext.name + '.c')
+            text = ('/* Generated by setup.py: the sources of the %s '
+                    'extension as one translation unit. */\n' % ext.name +
+                    ''.join('#include "%s"\n' % os.path.abspath(source)
+                            for source in merged))
+            # Rewritten only when it changes, not to make it look stale.
+            try:
+                with open(filename) as fp:
+                    current = fp.read()
+            except OSError:
+                current = None
+            if current != text and self.plan:
+                self.plan_changes[filename] = 'unity'
+            elif current != text:
+                os.makedirs(unity_dir, exist_ok=True)
+                with open(filename, 'w') as fp:
+                    fp.write(text)
+            changed.append((ext, ext.sources))
+            self.unity_sources[ext.name] = ext.sources
+            ext.sources = [filename] + [source for source in ext.sources
+                                        if source not in merged]
+            # In case the compiler can't tell which files were included.
+            ext.depends = ext.depends + merged
+        if changed:
+            log.info("compiling %d extensions as unity builds: %s",
+                     len(changed), ", ".join(ext.name for ext, _ in changed))
+        return changed
+
+    def retry_without_unity(self, unity):
+        """Build the extensions of 'unity' (see prepare_unity()) that
+        failed, from their separate sources."""
+        retried = []
+        for ext, sources in unity:
+            if ext.name not in self.failed:
+                continue
+            self.announce('WARNING: building "%s" again from separate '
+                          'sources, list those that conflict in '
+                          '_PYTHON_UNITY_EXCLUDE' % ext.name, level=3)
+            self.failed.remove(ext.name)
+            ext.sources = sources
+            del self.unity_sources[ext.name]
+            self.build_extension(ext)
+            retried.append(ext.name)
+        self.retry_dependents(retried)
+
+    def retry_dependents(self, names):
+        """Build again the extensions that failed because an extension
+        they require, one of 'names' built again, had failed."""
+        retried = set(names)
+        for ext in BuildGraph(self.extensions).topological_order():
+            if (ext.name not in self.failed or
+                    not retried.intersection(ext.requires) or
+                    any(name in self.failed for name in ext.requires)):
+                continue
+            self.announce('WARNING: building "%s" again, the extensions it '
+                          'requires are built now' % ext.name, level=3)
+            self.failed.remove(ext.name)
+            self.build_extension(ext)
+            retried.add(ext.name)
+
+    def switch_modes(self, filename, modes):
+        """Keep 'modes', a dict mapping the names of the extensions built
+        in a special way to the JSON value telling how, in 'filename' of
+        the build directory.  The objects of the extensions whose mode
+        changed since the previous build, either way, are removed so that
+        they are compiled again."""
+        import json
+        reason = os.path.splitext(filename)[0] + ' mode'
+        filename = os.path.join(self.build_temp, filename)
+        # JSON has no tuples.
+        modes = json.loads(json.dumps(modes))
+        try:
+            with open(filename) as fp:
+                previous = json.load(fp)
+        except (OSError, ValueError):
+            previous = {}
+        for ext in self.extensions:
+            if modes.get(ext.name) != previous.get(ext.name):
+                self.remove_objects(ext, reason)
+        if self.plan:
+            return
+        os.makedirs(self.build_temp, exist_ok=True)
+        with open(filename, 'w') as fp:
+            json.dump(modes, fp)
+
+    def remove_objects(self, ext, reason):
+        """Remove the objects of 'ext', so that they are compiled again
+        although their sources haven't changed (compiler flags have).
+        Under --plan, they are noted in plan_changes with 'reason'."""
+        sources = self.swig_sources(sorted(ext.sources), ext)
+        for obj in self.compiler.object_filenames(sources,
+                                                  output_dir=self.build_temp):
+            if self.plan:
+                self.plan_changes[obj] = reason
+            elif os.path.exists(obj):
+                os.remove(obj)
+
+    def lto_flags(self):
+        """Return the compile and link flags of link-time optimization, or
+        None if the compiler or the linker can't do it.
+
+        The LTO back end of each link runs _PYTHON_LTO_JOBS jobs, by
+        default the build_jobs() budget shared out between the link_jobs()
+        links that run at once, so that they don't start more processes
+        than the build was given.
+        """
+        kind = self.pgo_compiler()
+        if kind is None:
+            return None
+        jobs = os.environ.get('_PYTHON_LTO_JOBS')
+        if jobs:
+            jobs = max(int(jobs), 1)
+        else:
+            jobs = max(self.build_jobs() // self.link_jobs(), 1)
+        if kind == 'gcc':
+            candidates = [(['-flto'], ['-flto=%d' % jobs]),
+                          (['-flto'], ['-flto'])]
+        else:
+            # The option for the jobs of ThinLTO depends on the linker:
+            # lld, then the LLVM plugin of gold and ld.bfd.
+            candidates = [(['-flto=thin'],
+                           ['-flto=thin', '-Wl,--thinlto-jobs=%d' % jobs]),
+                          (['-flto=thin'],
+                           ['-flto=thin', '-Wl,-plugin-opt,jobs=%d' % jobs]),
+                          (['-flto=thin'], ['-flto=thin'])]
+        for compile_args, link_args in candidates:
+            if self.try_compile('int lto_probe(void) { return 0; }\n',
+                                link=True, extra_args=compile_args +
+                                link_args + ['-shared']):
+                return compile_args, link_args
+        return None
+
+    def prepare_lto(self):
+        """Add the flags of link-time optimization to the extensions named
+        by _PYTHON_LTO_EXTENSIONS, a list or "default" for those with more
+        than one source file, if the toolchain supports it.
+
+        The flags of each extension are kept in build_temp/lto.json (see
+        switch_modes()).  Return the names of the extensions built with
+        LTO.
+        """
+        value = os.environ.get('_PYTHON_LTO_EXTENSIONS', '').strip()
+        if value == 'default':
+            # Counted before prepare_unity() merged them.
+            exts = [ext for ext in self.extensions
+                    if len(self.unity_sources.get(ext.name, ext.sources)) > 1]
+        else:
+            names = value.replace(',', ' ').split()
+            exts = [ext for ext in self.extensions if ext.name in names]
+        flags = None
+        if exts:
+            with self.timer.phase('probe', 'lto'):
+                flags = self.lto_flags()
+            if flags is None:
+                log.info("skipping link-time optimization: the toolchain "
+                         "doesn't support it")
+                exts = []
+        self.switch_modes('lto.json', {ext.name: flags for ext in exts})
+
+        for ext in exts:
+            compile_args, link_args = flags
+            ext.extra_compile_args = (list(ext.extra_compile_args or []) +
+                                      compile_args)
+            ext.extra_link_args = list(ext.extra_link_args or []) + link_args
+        self.lto_extensions = {ext.name for ext in exts}
+        return self.lto_extensions
+
+    def training_script(self):
+        """Return the PGO training script: _PYTHON_PGO_TRAINING, or else
+        Tools/scripts/pgo_training.py."""
+        script = os.environ.get('_PYTHON_PGO_TRAINING')
+        if not script:
+            script = os.path.join(sysconfig.get_config_var('srcdir'),
+                                  'Tools', 'scripts', 'pgo_training.py')
+        return os.path.abspath(script)
+
+    def time_workloads(self, names):
+        """Time the workloads of the PGO training script for the extensions
+        in 'names' against build_lib; return a dict mapping the name of
+        each extension that has one to its best time in seconds.
+
+        _PYTHON_LTO_BENCH_LOOPS sets the loops of each run (100 by
+        default); 0 turns the timing off.  Nothing is timed when
+        cross-compiling.
+        """
+        import json
+        loops = int(os.environ.get('_PYTHON_LTO_BENCH_LOOPS') or 100)
+        if not names or loops <= 0 or cross_compiling:
+            return {}
+        argv = [sys.executable, '-c', WORKLOAD_TIMER, self.build_lib,
+                self.training_script(), str(loops)] + sorted(names)
+        with self.timer.phase('lto', 'benchmark'):
+            status, out, err = ToolchainProbes.spawn(argv)
+        try:
+            if status:
+                raise ValueError(err)
+            return json.loads(out.splitlines()[-1])
+        except (ValueError, IndexError):
+            self.announce('WARNING: timing the LTO workloads failed: %s'
+                          % err.strip(), level=3)
+            return {}
+
+    def record_lto_stats(self, lto):
+        """Keep the size, the compile and link times and the run time of
+        the training workload (see time_workloads()) of the extensions
+        linked by this build in build_temp/lto_stats.json, for their mode
+        ('lto' if their name is in 'lto', 'plain' otherwise), and write
+        the differences of the extensions built both ways to
+        lto_stats.txt."""
+        import json
+        filename = os.path.join(self.build_temp, 'lto_stats.json')
+        try:
+            with open(filename) as fp:
+                stats = json.load(fp)
+        except (OSError, ValueError):
+            stats = {}
+        compiled = {}
+        linked = {}
+        for category, name, start, duration, tid, args in self.timer.events:
+            if category == 'compile':
+                name = args.get('ext')
+                compiled[name] = compiled.get(name, 0) + duration
+            elif category == 'link' and not args.get('failed'):
+                linked[name] = linked.get(name, 0) + duration
+        run = self.time_workloads([ext.name for ext in self.extensions
+                                   if ext.name in linked])
+        for ext in self.extensions:
+            if ext.name not in linked:
+                continue
+            try:
+                size = os.path.getsize(self.get_ext_fullpath(ext.name))
+            except OSError:
+                continue
+            mode = 'lto' if ext.name in lto else 'plain'
+            entry = {'size': size,
+                     'compile': round(compiled.get(ext.name, 0), 3),
+                     'link': round(linked[ext.name], 3)}
+            if ext.name in run:
+                entry['run'] = round(run[ext.name], 6)
+            stats.setdefault(ext.name, {})[mode] = entry
+        with open(filename, 'w') as fp:
+            json.dump(stats, fp, indent=1, sort_keys=True)
+
+        with open(os.path.join(self.build_temp, 'lto_stats.txt'), 'w') as fp:
+            fp.write('%-20s %10s %10s %7s %9s %9s %7s\n' % (
+                'extension', 'size', 'lto size', 'size', 'run', 'lto run',
+                'speedup'))
+            for name, modes in sorted(stats.items()):
+                if 'plain' not in modes or 'lto' not in modes:
+                    continue
+                plain, optimized = modes['plain'], modes['lto']
+                if plain.get('run') and optimized.get('run'):
+                    timing = '%9.4f %9.4f %6.2fx' % (
+                        plain['run'], optimized['run'],
+                        plain['run'] / optimized['run'])
+                else:
+                    timing = '%9s %9s %7s' % ('-', '-', '-')
+                fp.write('%-20s %10d %10d %+6.1f%% %s\n' % (
+                    name, plain['size'], optimized['size'],
+                    (optimized['size'] - plain['size']) * 100.0 /
+                    plain['size'], timing))
+
+    def select_linker(self, lto):
+        """Link the extensions with the linker named by _PYTHON_LINKER,
+        "default" for the one the compiler picks, or else with the first
+        of fast_linkers that is installed and links extensions which
+        import (see check_linkers()).
+
+        Timing links of a probe extension would only measure noise: the
+        order of fast_linkers is that of their speed on real links.  The
+        choice is kept in build_temp/linker.json while the compiler, the
+        flags of link-time optimization ('lto' is the set of the
+        extensions built with it) and the linkers stay the same.
+        """
+        import json
+        name = os.environ.get('_PYTHON_LINKER', '').strip() or None
+        if name is None and not cross_compiling and self.pgo_compiler():
+            candidates = []
+            for linker, executables in fast_linkers:
+                for executable in executables:
+                    path = find_executable(executable)
+                    if path is not None:
+                        candidates.append(
+                            (linker, path_state(os.path.realpath(path))))
+                        break
+            flags = self.lto_flags() if lto else None
+            key = repr((self.compiler_identity(), flags, candidates))
+            filename = os.path.join(self.build_temp, 'linker.json')
+            try:
+                with open(filename) as fp:
+                    saved = json.load(fp)
+                if saved['key'] == key:
+                    name = saved['linker']
+            except (OSError, ValueError, KeyError):
+                saved = None
+            if candidates and (saved is None or saved['key'] != key):
+                if self.plan:
+                    # Planned with the default linker until they're checked.
+                    self.plan_changes[filename] = 'linker check'
+                    return
+                with self.timer.phase('probe', 'linker'):
+                    working = self.check_linkers(
+                        [linker for linker, _ in candidates], flags)
+                for linker, _ in candidates:
+                    log.info("linker %s: %s", linker,
+                             "works" if linker in working
+                             else "doesn't work")
+                if working:
+                    name = working[0]
+                os.makedirs(self.build_temp, exist_ok=True)
+                with open(filename, 'w') as fp:
+                    json.dump({'key': key, 'linker': name,
+                               'working': working}, fp, indent=1)
+        if name is not None and name != 'default':
+            log.info("linking extensions with %s", name)
+            self.compiler.linker_so = (self.compiler.linker_so +
+                                       ['-fuse-ld=' + name])
+            self.linker = name
+
+    def check_linkers(self, names, flags):
+        """Return the linkers of 'names', in the same order, that link a
+        probe extension (using the LTO 'flags' if not None) which passes
+        the import check."""
+        probe_dir = os.path.join(self.build_temp, 'linker')
+        source = os.path.join(probe_dir, 'linker_probe.c')
+        os.makedirs(probe_dir, exist_ok=True)
+        with open(source, 'w') as fp:
+            fp.write('#include "Python.h"\n')
+            # One module per linker, so that each check imports its own.
+            for name in names:
+                fp.write('static struct PyModuleDef def_%s = {\n'
+                         '    PyModuleDef_HEAD_INIT, "_linker_probe_%s", '
+                         'NULL, -1, NULL};\n'
+                         'PyMODINIT_FUNC PyInit__linker_probe_%s(void) '
+                         '{ return PyModule_Create(&def_%s); }\n'
+                         % (name, name, name, name))
+        compile_args, link_args = flags or ([], [])
+        try:
+            objects = self.compiler.compile([source], output_dir=probe_dir,
+                                            extra_postargs=compile_args)
+        except CCompilerError:
+            return []
+
+        checks = {}
+        for name in names:
+            output = os.path.join(probe_dir, self.get_ext_filename(
+                '_linker_probe_' + name))
+            if os.path.exists(output):
+                os.remove(output)
+            try:
+                self.compiler.link_shared_object(
+                    objects, output,
+                    extra_postargs=link_args + ['-fuse-ld=' + name],
+                    build_temp=probe_dir)
+            except (CCompilerError, DistutilsError):
+                continue
+            checks[name] = self.get_import_checker().submit(
+                '_linker_probe_' + name, output)
+        working = []
+        for name in names:
+            try:
+                passed = (name in checks and
+                          checks[name].result()[0] == 'ok')
+            except Exception:
+                passed = False
+            if passed:
+                working.append(name)
+        return working
+
+    def write_link_times(self, filename):
+        """Write the time each extension linked by this build took, the
+        slowest first, with the name of the linker."""
+        links = [(duration, name) for category, name, start, duration, tid,
+                 args in self.timer.events
+                 if category == 'link' and not args.get('failed')]
+        if not links:
+            return
+        links.sort(reverse=True)
+        total = sum(duration for duration, name in links)
+        log.info("linked %d extensions with %s in %.3fs", len(links),
+                 self.linker or "the default linker", total)
+        os.makedirs(self.build_temp, exist_ok=True)
+        with open(filename, 'w') as fp:
+            fp.write('linker: %s, %d links at once\n' % (
+                self.linker or 'default', self.link_jobs()))
+            fp.write('%-24s %9s\n' % ('extension', 'seconds'))
+            for duration, name in links:
+                fp.write('%-24s %9.3f\n' % (name, duration))
+            fp.write('%-24s %9.3f\n' % ('total', total))
+
+    def retry_without_profile(self, profiled):
+        """Build again without the profile the extensions of 'profiled'
+        (see prepare_pgo()) that failed with it."""
+        retried = []
+        for ext, flags in profiled:
+            if ext.name not in self.failed:
+                continue
+            self.announce('WARNING: building "%s" again without its profile'
+                          % ext.name, level=3)
+            self.failed.remove(ext.name)
+            self.pgo_profiled.discard(ext.name)
+            # Tried with the profile again by the next build.
+            self.switch_modes('pgo.json', dict.fromkeys(self.pgo_profiled,
+                                                        self.pgo_fingerprint))
+            ext.extra_compile_args = [arg for arg in ext.extra_compile_args
+                                      if arg not in flags]
+            self.build_extension(ext)
+            retried.append(ext.name)
+        self.retry_dependents(retried)
+
+    def import_check_skipped(self, ext):
+        """Return the warning to print if 'ext' must not be imported, an
+        empty string to skip it silently, or None to check it."""
         # Don't try to import an extension that has failed to compile
         if ext.name in self.failed:
-            self.annouce(
-                'WARNING: skipping import check for failed build "%s"' %
-                ext.name, level=1)
-            return
+            return ('WARNING: skipping import check for failed build "%s"' %
+                    ext.name)
 
         # Workaround for Mac OS X: The Carbon-based modules cannot be
         # reliably imported into a command-line Python
         if 'Carbon' in ext.extra_link_args:
-            self.annouce(
-                'WARNING: skipping import check for Carbon-based "%s"' %
-                ext.name)
-            return
+            return ('WARNING: skipping import check for Carbon-based "%s"' %
+                    ext.name)
 
         if host_platform == 'darwin' and (
             sys.maxsize > 2**32 and '-arch' in ext.extra_link_args):
@@ -411,69 +3234,121 @@ class PyBuildExt(build_ext):
             # only used to build 32-bit only extensions in a 4-way
             # universal build and loading 32-bit code into a 64-bit
             # process will fail
-            self.announce(
-                'WARNING: skipping import check for "%s"' %
-                ext.name)
-            return
+            return 'WARNING: skipping import check for "%s"' % ext.name
 
         # Workaround for Cygwin: Cygwin currently has fork issues when many
         # modules have been imported
         if host_platform == 'cygwin':
-            self.announce('WARNING: skipping import check for Cygwin-based "%s"'
-                          % ext.name)
-            return
-        ext_filename = os.path.join(
+            return ('WARNING: skipping import check for Cygwin-based "%s"'
+                    % ext.name)
+
+        # Don't try to load extensions for cross builds
+        if cross_compiling:
+            return ''
+        return None
+
+    def ext_filename(self, ext):
+        return os.path.join(
             self.build_lib,
             self.get_ext_filename(self.get_ext_fullname(ext.name)))
 
+    def get_import_checker(self):
+        if self.import_checker is None:
+            timeout = float(os.environ.get('_PYTHON_IMPORT_CHECK_TIMEOUT',
+                                           60))
+            self.import_checker = ImportChecker(self.build_jobs(), timeout)
+        return self.import_checker
+
+    def start_import_check(self, ext):
+        """Start importing 'ext' in a helper interpreter,
+        check_extension_import() collects the result."""
+        if (not hasattr(os, 'posix_spawn') or not self.check_imports or
+                ext.name in self.import_checks or
+                ext.name in self.bundle_builds or
+                self.import_check_skipped(ext) is not None):
+            return
+        future = self.get_import_checker().submit(ext.name,
+                                                  self.ext_filename(ext))
+        def record(future):
+            if future.exception() is None:
+                status, why, seconds = future.result()
+                self.timer.add('import', ext.name,
+                               time.perf_counter() - seconds, seconds,
+                               status=status)
+        future.add_done_callback(record)
+        self.import_checks[ext.name] = future
+
+    def load_extension(self, ext):
+        """Import 'ext' into this process, where worker processes can't be
+        spawned."""
         # If the build directory didn't exist when setup.py was
         # started, sys.path_importer_cache has a negative result
         # cached. Clear that cache before trying to import.
         sys.path_importer_cache.clear()
 
-        # Don't try to load extensions for cross builds
-        if cross_compiling:
-            return
-
+        ext_filename = self.ext_filename(ext)
         loader = importlib.machinery.ExtensionFileLoader(ext.name, ext_filename)
         spec = importlib.util.spec_from_file_location(ext.name, ext_filename,
                                                       loader=loader)
+        start = time.perf_counter()
         try:
             importlib._bootstrap._load(spec)
         except ImportError as why:
+            status, why = 'import error', str(why)
+        except:
+            exc_type, why, tb = sys.exc_info()
+            status, why = 'error', '%s: %s' % (exc_type, why)
+        else:
+            status, why = 'ok', ''
+        return status, why, time.perf_counter() - start
+
+    def check_extension_import(self, ext):
+        skipped = self.import_check_skipped(ext)
+        if skipped is not None:
+            if skipped:
+                self.announce(skipped, level=1)
+            return
+
+        future = self.import_checks.pop(ext.name, None)
+        if future is not None:
+            try:
+                status, why, seconds = future.result()
+            except Exception as exc:
+                # The helper interpreter couldn't be run or talked to.
+                status, why, seconds = 'error', '%s: %s' % (
+                    type(exc).__name__, exc), 0.0
+        else:
+            with self.timer.phase('import', ext.name):
+                status, why, seconds = self.load_extension(ext)
+        self.import_times[ext.name] = seconds
+        log.debug("importing %s took %.3f seconds (%s)", ext.name, seconds,
+                  status)
+
+        if status == 'import error':
             self.failed_on_import.append(ext.name)
             self.announce('*** WARNING: renaming "%s" since importing it'
                           ' failed: %s' % (ext.name, why), level=3)
             assert not self.inplace
+            ext_filename = self.ext_filename(ext)
             basename, tail = os.path.splitext(ext_filename)
             newname = basename + "_failed" + tail
             if os.path.exists(newname):
                 os.remove(newname)
             os.rename(ext_filename, newname)
 
-        except:
-            exc_type, why, tb = sys.exc_info()
+        elif status != 'ok':
             self.announce('*** WARNING: importing extension "%s" '
-                          'failed with %s: %s' % (ext.name, exc_type, why),
+                          'failed with %s: %s' % (ext.name, status, why),
                           level=3)
             self.failed.append(ext.name)
 
     def add_multiarch_paths(self):
         # Debian/Ubuntu multiarch support.
         # https://wiki.ubuntu.com/MultiarchSpec
-        cc = sysconfig.get_config_var('CC')
-        tmpfile = os.path.join(self.build_temp, 'multiarch')
-        if not os.path.exists(self.build_temp):
-            os.makedirs(self.build_temp)
-        ret = os.system(
-            '%s -print-multiarch > %s 2> /dev/null' % (cc, tmpfile))
+        ret, out, _ = self.toolchain.run(self.toolchain_query('multiarch'))
         multiarch_path_component = ''
-        try:
-            if ret >> 8 == 0:
-                with open(tmpfile) as fp:
-                    multiarch_path_component = fp.readline().strip()
-        finally:
-            os.unlink(tmpfile)
+        if ret == 0:
+            multiarch_path_component = out.partition('\n')[0].strip()
 
         if multiarch_path_component != '':
             add_dir_to_list(self.compiler.library_dirs,
@@ -482,102 +3357,232 @@ class PyBuildExt(build_ext):
                             '/usr/include/' + multiarch_path_component)
             return
 
+        # Which dpkg-architecture runs, if any, is an input of the probe:
+        # note each place looked at on PATH, up to the one found.
+        for dir in os.environ.get('PATH', os.defpath).split(os.pathsep):
+            executable = os.path.join(dir, 'dpkg-architecture')
+            note_probe_input(executable)
+            if os.path.isfile(executable):
+                break
         if not find_executable('dpkg-architecture'):
             return
-        opt = ''
-        if cross_compiling:
-            opt = '-t' + sysconfig.get_config_var('HOST_GNU_TYPE')
-        tmpfile = os.path.join(self.build_temp, 'multiarch')
-        if not os.path.exists(self.build_temp):
-            os.makedirs(self.build_temp)
-        ret = os.system(
-            'dpkg-architecture %s -qDEB_HOST_MULTIARCH > %s 2> /dev/null' %
-            (opt, tmpfile))
-        try:
-            if ret >> 8 == 0:
-                with open(tmpfile) as fp:
-                    multiarch_path_component = fp.readline().strip()
-                add_dir_to_list(self.compiler.library_dirs,
-                                '/usr/lib/' + multiarch_path_component)
-                add_dir_to_list(self.compiler.include_dirs,
-                                '/usr/include/' + multiarch_path_component)
-        finally:
-            os.unlink(tmpfile)
+        ret, out, _ = self.toolchain.run(
+            self.toolchain_query('dpkg-multiarch'))
+        if ret == 0:
+            multiarch_path_component = out.partition('\n')[0].strip()
+            add_dir_to_list(self.compiler.library_dirs,
+                            '/usr/lib/' + multiarch_path_component)
+            add_dir_to_list(self.compiler.include_dirs,
+                            '/usr/include/' + multiarch_path_component)
 
     def add_gcc_paths(self):
-        gcc = sysconfig.get_config_var('CC')
-        tmpfile = os.path.join(self.build_temp, 'gccpaths')
-        if not os.path.exists(self.build_temp):
-            os.makedirs(self.build_temp)
-        ret = os.system('%s -E -v - </dev/null 2>%s 1>/dev/null' %(gcc, tmpfile))
+        ret, _, err = self.toolchain.run(self.toolchain_query('gcc-paths'))
         is_gcc = False
         in_incdirs = False
-        inc_dirs = []
-        lib_dirs = []
+        if ret == 0:
+            for line in err.splitlines():
+                if line.startswith("gcc version"):
+                    is_gcc = True
+                elif line.startswith("#include <...>"):
+                    in_incdirs = True
+                elif line.startswith("End of search list"):
+                    in_incdirs = False
+                elif is_gcc and line.startswith("LIBRARY_PATH"):
+                    for d in line.strip().split("=")[1].split(":"):
+                        d = os.path.normpath(d)
+                        if '/gcc/' not in d:
+                            add_dir_to_list(self.compiler.library_dirs,
+                                            d)
+                elif is_gcc and in_incdirs and '/gcc/' not in line:
+                    add_dir_to_list(self.compiler.include_dirs,
+                                    line.strip())
+
+    def run_probe(self, name, func, *args):
+        """Return the result of the detection probe func(*args).
+
+        The result of a previous build is reused when the probe was run with
+        the same arguments and none of the files it consulted has changed
+        since (see DetectionCache).
+        """
+        key = repr(args)
+        if not self.force:
+            with self.timer.phase('cache', name):
+                result = self.detection_cache.lookup(name, key)
+            if result is not None:
+                return result
+        _probe_state.inputs = inputs = set()
         try:
-            if ret >> 8 == 0:
-                with open(tmpfile) as fp:
-                    for line in fp.readlines():
-                        if line.startswith("gcc version"):
-                            is_gcc = True
-                        elif line.startswith("#include <...>"):
-                            in_incdirs = True
-                        elif line.startswith("End of search list"):
-                            in_incdirs = False
-                        elif is_gcc and line.startswith("LIBRARY_PATH"):
-                            for d in line.strip().split("=")[1].split(":"):
-                                d = os.path.normpath(d)
-                                if '/gcc/' not in d:
-                                    add_dir_to_list(self.compiler.library_dirs,
-                                                    d)
-                        elif is_gcc and in_incdirs and '/gcc/' not in line:
-                            add_dir_to_list(self.compiler.include_dirs,
-                                            line.stript())
+            with self.timer.phase('probe', name):
+                result = func(*args)
         finally:
-            os.unlink(tmpfile)
+            _probe_state.inputs = None
+        self.detection_cache.store(name, key, result, inputs)
+        return result
+
+    def start_probe(self, name, func, *args):
+        """Start run_probe(name, func, *args) on the thread pool of the
+        detection probes, return a future for probe_result()."""
+        def run():
+            _probe_state.output = output = []
+            try:
+                return self.run_probe(name, func, *args), None, output
+            except BaseException as why:
+                return None, why, output
+            finally:
+                _probe_state.output = None
+        return self.probe_pool.submit(run)
+
+    def probe_result(self, future):
+        """Wait for a probe started by start_probe(), write out what it
+        printed and return its result."""
+        result, error, output = future.result()
+        for stream, text in output:
+            stream.write(text)
+        if error is not None:
+            raise error
+        return result
+
+    def find_library_file(self, dirs, libname):
+        """Same as self.compiler.find_library_file(), but the files looked
+        for are recorded as inputs of the running detection probe."""
+        result = dir_index.find_library_file(self.compiler, dirs, libname)
+        if getattr(_probe_state, 'inputs', None) is None:
+            return result
 
-    def detect_modules(self):
-        # Ensure that /usr/local is always used, but the local build
-        # directories (i.e. '.' and 'Include') must be first. See issue
-        # 10520.
-        if not cross_compiling:
-            add_dir_to_list(self.compiler.library_dirs, '/usr/local/lib')
-            add_dir_to_list(self.compiler.include_dirs, '/usr/local/include')
-        # only change this for cross builds for 3.3, issues on Mageia
-        if cross_compiling:
-            self.add_gcc_paths()
-        self.add_multiarch_paths()
+        if host_platform == 'darwin':
+            sysroot = macosx_sdk_root()
+        filenames = [self.compiler.library_filename(libname, lib_type=lib_type)
+                     for lib_type in ('dylib', 'xcode_stub', 'shared', 'static')]
+        for dir in dirs:
+            if host_platform == 'darwin' and is_macosx_sdk_path(dir):
+                dir = os.path.join(sysroot, dir[1:])
+            for filename in filenames:
+                note_probe_input(os.path.join(dir, filename))
+            # The directories after the one it was found in don't matter.
+            if result is not None and os.path.dirname(result) == dir:
+                break
+        return result
+
+    def find_library_files(self, dirs, libnames):
+        """Same as dir_index.find_library_files().  The directories are
+        recorded as inputs of the running detection probe, rather than
+        every file name looked for in them."""
+        found = dir_index.find_library_files(self.compiler, dirs, libnames)
+        if getattr(_probe_state, 'inputs', None) is None:
+            return found
+        if host_platform == 'darwin':
+            sysroot = macosx_sdk_root()
+        for dir in dirs:
+            if host_platform == 'darwin' and is_macosx_sdk_path(dir):
+                dir = os.path.join(sysroot, dir[1:])
+            note_probe_input(dir)
+        for path in found.values():
+            note_probe_input(path)
+        return found
+
+    def try_compile(self, source, link=False, include_dirs=(),
+                    library_dirs=(), libraries=(), extra_args=(),
+                    link_args=()):
+        """Return True if the C code 'source' compiles with the compiler
+        and flags used for the extensions (and links into a program with
+        'libraries' and 'link_args' if 'link' is true), False if it
+        doesn't, or None if the compiler can't be asked.
+
+        Programs are linked as the extensions are: with the flags of the
+        linker, LDFLAGS among them, and with the libraries the interpreter
+        loading the extensions provides, which static libraries may need.
+
+        The answers are memoized by self.toolchain, on the compiler's
+        command line and executable and the directories searched.
+        """
+        if self.compiler.compiler_type != 'unix':
+            return None
+        from distutils.ccompiler import gen_lib_options, gen_preprocess_options
+        include_dirs = list(include_dirs) + self.compiler.include_dirs
+        argv = (self.compiler.compiler_so +
+                gen_preprocess_options(self.compiler.macros, include_dirs) +
+                list(extra_args) + ['-x', 'c', '-', '-o', os.devnull])
+        inputs = include_dirs
+        if link:
+            library_dirs = list(library_dirs) + self.compiler.library_dirs
+            argv += gen_lib_options(self.compiler, library_dirs, [],
+                                    list(libraries))
+            argv += list(link_args)
+            argv += [arg for arg in self.compiler.linker_so[1:]
+                     if arg not in ('-shared', '-bundle')]
+            argv += (sysconfig.get_config_var('LIBS') or '').split()
+            inputs = inputs + library_dirs
+        else:
+            argv.append('-c')
+        for dir in inputs:
+            note_probe_input(dir)
+        status, _, _ = self.toolchain.run(argv, inputs, source.encode())
+        return status == 0
+
+    def try_compile_all(self, checks):
+        """Run try_compile(**kwargs) for each dict of 'checks' at once,
+        return the list of answers."""
+        if len(checks) < 2:
+            return [self.try_compile(**kwargs) for kwargs in checks]
+        from concurrent.futures import ThreadPoolExecutor
+        # The checks are run on behalf of the probe running on this thread.
+        inputs = getattr(_probe_state, 'inputs', None)
+        def check(kwargs):
+            _probe_state.inputs = inputs
+            try:
+                return self.try_compile(**kwargs)
+            finally:
+                _probe_state.inputs = None
+        with ThreadPoolExecutor(len(checks)) as pool:
+            return list(pool.map(check, checks))
+
+    @staticmethod
+    def symbol_check(libraries, symbols, **kwargs):
+        """Return the try_compile() arguments that check that a program
+        linked with 'libraries' can resolve all of 'symbols'."""
+        # Declared with a dummy prototype, as autoconf's AC_CHECK_LIB does,
+        # so that no header is needed.
+        source = ''.join('char %s(void);\n' % symbol for symbol in symbols)
+        source += 'int main(void) { return %s; }\n' % ' + '.join(
+            '%s()' % symbol for symbol in symbols)
+        return dict(kwargs, source=source, link=True, libraries=libraries)
+
+    def library_provides(self, libraries, symbols, **kwargs):
+        """Return False if linking with 'libraries' doesn't resolve all of
+        'symbols', True otherwise (or if the compiler can't tell)."""
+        return self.try_compile(
+            **self.symbol_check(libraries, symbols, **kwargs)) is not False
 
-        # Add paths specified in the environment variables LDFLAGS and
-        # CPPFLAGS for header and library files.
-        # We must get the values from the Makefile and not the environment
-        # directly since an inconsistently reproducible issue comes up where
-        # the environment variable is not set even though the value were passed
-        # into configure and stored in the Makefile (issue found on OS X 10.3).
-        for env_var, arg_name, dir_list in (
-                ('LDFLAGS', '-R', self.compiler.runtime_library_dirs),
-                ('LDFLAGS', '-L', self.compiler.library_dirs),
-                ('CPPFLAGS', '-I', self.compiler.include_dirs)):
-            env_val = sysconfig.get_config_var(env_var)
-            if env_val:
-                parser = argparse.ArgumentParser()
-                parser.add_argument(arg_name, dest="dirs", action="append")
-                options, _ = parser.parse_known_args(env_val.split())
-                if options.dirs:
-                    for directory in reversed(options.dirs):
-                        add_dir_to_list(dir_list, directory)
+    def detect_modules(self):
+        config_h = sysconfig.get_config_h_filename()
+        with open(config_h) as file:
+            config_h_vars = sysconfig.parse_config_h(file)
 
-        if (not cross_compiling and
-                os.path.normpath(sys.base_prefix) != '/usr' and
-                not sysconfig.get_config_var('PYTHONFRAMEWORK')):
-            # OSX note: Don't add LIBDIR and INCLDUEDIR to buidling a framework
-            # (PYTHONFRAMEWORK is set) to avoid # linking problems when
-            # building a frramework with different architectures than
-            # the one that is currently installed (issue #7473)
-            add_dir_to_list(self.compiler.library_dirs,
-                            sysconfig.get_config_var("LIBDIR"))
-            add_dir_to_list(self.compiler.include_dirs,
-                            sysconfig.get_config_var("INCLUDEDIR"))
+        self.detection_cache = DetectionCache(
+            os.path.join(self.build_temp, 'detect_modules.cache'),
+            detection_fingerprint(config_h_vars))
+        self.detection_cache.load()
+        self.toolchain = ToolchainProbes(
+            os.path.join(self.build_temp, 'toolchain.cache'))
+        self.toolchain.load()
+        # Start the toolchain queries that the probes below need.
+        queries = ['multiarch']
+        if find_executable('dpkg-architecture'):
+            queries.append('dpkg-multiarch')
+        if cross_compiling:
+            queries.append('gcc-paths')
+        self.toolchain.prefetch(self.toolchain_query(name)
+                                for name in queries)
+
+        search_paths = self.run_probe('paths', self.detect_search_paths,
+                                      self.compiler.library_dirs,
+                                      self.compiler.include_dirs,
+                                      self.compiler.runtime_library_dirs,
+                                      os.environ.get('PATH'))
+        self.compiler.library_dirs[:] = search_paths['library_dirs']
+        self.compiler.include_dirs[:] = search_paths['include_dirs']
+        self.compiler.runtime_library_dirs[:] = \
+            search_paths['runtime_library_dirs']
 
         system_lib_dirs = ['/lib64', '/usr/lib64', '/lib', '/usr/lib']
         system_include_dirs = ['/usr/include']
@@ -596,13 +3601,6 @@ class PyBuildExt(build_ext):
             inc_dirs = (self.compiler.include_dirs +
                         sysroot_paths(('CPPFLAGS', 'CFLAGS', 'CC'),
                                       system_include_dirs))
-        exts = []
-        missing = []
-
-        config_h = sysconfig.get_config_h_filename()
-        with open(config_h) as file:
-            config_h_vars = sysconfig.parse_config_h(file)
-
         srcdir = sysconfig.get_config_var('srcdir')
 
         # OSF/1 and Unixware have some stuff in /usr/ccs/lib (like -ldb)
@@ -613,6 +3611,34 @@ class PyBuildExt(build_ext):
         if host_platform == 'hp-ux11':
             lib_dirs += ['/usr/lib/hpux64', '/usr/lib/hpux32']
 
+        # The probes only read inc_dirs and lib_dirs and run concurrently;
+        # their results (and what they print) are merged in the order
+        # below, the same as if they had run one after the other.
+        # concurrent.futures.process can't be imported, see Dummy above.
+        from concurrent.futures import ThreadPoolExecutor
+        self.probe_pool = ThreadPoolExecutor()
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = ProbeOutput(stdout), ProbeOutput(stderr)
+        try:
+            missing = self.detect_extensions(config_h_vars, srcdir,
+                                             inc_dirs, lib_dirs)
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            self.probe_pool.shutdown()
+
+        dir_index.report()
+        if self.detection_cache.hits:
+            log.info("reused cached detection results for: %s",
+                     ", ".join(sorted(self.detection_cache.hits)))
+        self.detection_cache.save()
+        self.toolchain.save()
+        return missing
+
+    def detect_extensions(self, config_h_vars, srcdir, inc_dirs, lib_dirs):
+        """Add the extensions to build to self.extensions, return the
+        names of the missing ones."""
+        exts = []
+        missing = []
         if host_platform == 'darwin':
             # This should work on any unixy platform ;-)
             # If the user has bothered specifying additional -I and -L flags
@@ -631,6 +3657,27 @@ class PyBuildExt(build_ext):
                 if item.startswith('-L'):
                     lib_dirs.append(item[2:])
 
+        # The probes run concurrently and are keyed on their arguments (see
+        # run_probe()): hand them the complete directory lists, as tuples
+        # none of them can change.
+        inc_dirs = tuple(inc_dirs)
+        lib_dirs = tuple(lib_dirs)
+        probes = {}
+        for name, func, args in (
+                ('readline', self.detect_readline, (inc_dirs, lib_dirs)),
+                ('crypt', self.detect_crypt, (lib_dirs,)),
+                ('ssl', self.detect_openssl, (inc_dirs, lib_dirs)),
+                ('db', self.detect_bsddb, (inc_dirs, lib_dirs)),
+                ('sqlite', self.detect_sqlite, (inc_dirs, lib_dirs)),
+                ('nis', self.detect_nis, (inc_dirs, lib_dirs)),
+                ('zlib', self.detect_zlib, (inc_dirs, lib_dirs)),
+                ('bz2_lzma', self.detect_bz2_lzma, (lib_dirs,)),
+                ('expat', self.detect_expat, ()),
+                ('ctypes', self.detect_ctypes_probe, (inc_dirs, lib_dirs)),
+                ('tk', self.detect_tkinter_probe, (inc_dirs, lib_dirs)),
+                ('uuid', self.detect_uuid, (inc_dirs, lib_dirs))):
+            probes[name] = self.start_probe(name, func, *args)
+
         #
         # The following modules are all pretty straightforward, and compile
         # on pretty much any POSIXish platform
@@ -647,11 +3694,13 @@ class PyBuildExt(build_ext):
         exts.append( Extension('cmath', ['cmathmodule.c'],
                                extra_objects=[shared_math],
                                depends=['_math.h', shared_math],
+                               generated=[shared_math],
                                libraries=['m']) )
         # math library functions, e.g. sin()
         exts.append( Extension('math', ['mathmodule.c'],
                                extra_objects=[shared_math],
                                depends=['_math.h', shared_math],
+                               generated=[shared_math],
                                libraries=['m']) )
 
         # time libraries: librt may be needed for clock_gettime()
@@ -729,81 +3778,327 @@ class PyBuildExt(build_ext):
         # Fred Drake's interface to the Python parser
         exts.append( Extension('parser', ['parsermodule.c']) )
 
-        # Memory-mapped files (also works on Win32).
-        exts.append( Extension('mmap', ['mmapmodule.c']) )
+        # Memory-mapped files (also works on Win32).
+        exts.append( Extension('mmap', ['mmapmodule.c']) )
+
+        # Lance Ellinghaus's syslog module
+        # syslog daemon interface
+        exts.append( Extension('syslog', ['syslogmodule.c']) )
+
+        # Fuzz tests.
+        exts.append( Extension(
+            '_xxtestfuzz',
+            ['_xxtestfuzz/_xxtestfuzz.c', '_xxtestfuzz/fuzzer.c'])
+        )
+
+        # Python interface to subinterpreter C-API.
+        exts.append(Extension('_xxsubinterpreters', ['_xxsubinterpretersmodule.c'],
+                             defile_macros=[('Py_BUILD_CORE', '')]))
+
+        #
+        # Hear ends the simple stuff. From here on, modules need certain
+        # libraries, are platform-specific, or present other surprises.
+        #
+
+        # Multimedia modules
+        # These don't work for 64-bit platforms!!!
+        # These represent audio samples or images as strings:
+        #
+        # Operations on audio samples
+        # According to #993173, this ont should actually work fine on
+        # 64-bit platforms.
+        #
+        # audioop need libm for floor() in multiple functions.
+        exts.append( Extension('audioop', ['audioop.c'],
+                               libraries=['m']) )
+
+        readline = self.probe_result(probes['readline'])
+        # curses links with the same library as readline.
+        probes['curses'] = self.start_probe('curses', self.detect_curses,
+                                            lib_dirs,
+                                            readline['curses_library'])
+        exts.extend(readline['exts'])
+        missing.extend(readline['missing'])
+
+        crypt = self.probe_result(probes['crypt'])
+        exts.extend(crypt['exts'])
+
+        # CSV files
+        exts.append( Extension('_csv', ['_csv.c']) )
+
+        # POSIX subprocess module helper
+        exts.append( Extension('_posixsubprocess', ['_posixsubprocess.c']) )
+
+        # socket(2)
+        exts.append( Extension('_socket', ['socketmodule.c'],
+                               depends = ['socketmodule.h']) )
+        ssl = self.probe_result(probes['ssl'])
+        exts.extend(ssl['exts'])
+        missing.extend(ssl['missing'])
+
+        # We always compile these even when OpenSSL is available (issue #14693).
+        # It's harmless and the object code is tiny (40-50 KiB per module,
+        # only loaded when actually used).
+        exts.append( Extension('_sha256', ['sha256module.c'],
+                               depends=['hashlib.h']) )
+        exts.append( Extension('_sha512', ['sha512module.c'],
+                               depends=['hashlib.h']) )
+        exts.append( Extension('_md5', ['md5module.c'],
+                               depends=['hashlib.h']) )
+        exts.append( Extension('_sha1', ['sha1module.c'],
+                               depends=['hashlib.h']) )
+
+        blake2_deps = glob(os.path.join(os.getcwd(), srcdir,
+                                        'Modules/_blake2/impl/*'))
+        blake2_deps.append('hashlib.h')
+
+        exts.append( Extension('_blake2',
+                               ['_blake2/blake2module.c',
+                                '_blake2/blake2b_impl.c',
+                                '_blake2/blake2s_impl.c'],
+                               depends=blake2_deps) )
+
+        sha3_deps = glob(os.path.join(os.getcwd(), srcdir,
+                                      'Modules/_sha3/kcp/*'))
+        sha3_deps.append('hashlib.h')
+        exts.append( Extension('_sha3',
+                               ['_sha3/sha3module.c'],
+                               depends=sha3_deps))
+
+        db = self.probe_result(probes['db'])
+        probes['dbm'] = self.start_probe('dbm', self.detect_dbm,
+                                         inc_dirs, lib_dirs, db['dblibs'],
+                                         db['db_incs'], db['dblib_dir'])
+
+        sqlite = self.probe_result(probes['sqlite'])
+        exts.extend(sqlite['exts'])
+        missing.extend(sqlite['missing'])
+
+        dbm = self.probe_result(probes['dbm'])
+        exts.extend(dbm['exts'])
+        missing.extend(dbm['missing'])
+
+        # Unix-only modules
+        if host_platform != 'win32':
+            # Steen Lumholt's termios module
+            exts.append( Extension('termios', ['termios.c']) )
+            # Jeremy Hylton's rlimit interface
+            exts.append( Extension('resource', ['resource.c']) )
+        else:
+            missing.extend(['resource', 'termios'])
+
+        nis = self.probe_result(probes['nis'])
+        exts.extend(nis['exts'])
+        missing.extend(nis['missing'])
+
+        curses = self.probe_result(probes['curses'])
+        exts.extend(curses['exts'])
+        missing.extend(curses['missing'])
+
+        zlib = self.probe_result(probes['zlib'])
+        exts.extend(zlib['exts'])
+        missing.extend(zlib['missing'])
+
+        compress = self.probe_result(probes['bz2_lzma'])
+        exts.extend(compress['exts'])
+        missing.extend(compress['missing'])
+
+        expat = self.probe_result(probes['expat'])
+        exts.extend(expat['exts'])
+        missing.extend(expat['missing'])
+
+        # Hye-Shik Chang's CJKCodecs modules.
+        exts.append(Extension('_multibytecodec',
+                              ['cjkcodecs/multibytecodec.c']))
+        for loc in ('kr', 'jp', 'cn', 'tw', 'hk', 'iso2022'):
+            exts.append(Extension('_codecs_%s' % loc,
+                                  ['cjkcodecs/_codecs_%s.c' % loc]))
+
+        # Stefan Krah's _decimal module
+        exts.append(self._decimal_ext())
+
+        # Thomas Heller's _ctypes module.  It used to be built last because
+        # "it depends on other modules", but its init function imports
+        # none and configure_ctypes() only looks for libffi, so it has no
+        # 'requires' (only the ctypes package needs struct, at run time).
+        ctypes = self.probe_result(probes['ctypes'])
+        self.extensions.extend(ctypes['exts'])
+        self.use_system_libffi = ctypes['use_system_libffi']
+
+        # Richard Oudkerk's multiprocessing module
+        if host_platform == 'win32':        # Windows
+            macros = dict()
+            libraries = ['ws2_32']
+
+        elif host_platform == 'darwin':     # Mac OSX
+            macros = dict()
+            libraries = []
+
+        elif host_platform == 'cygwin':     # Cygwin
+            macros = dict()
+            libraries = []
+
+        elif host_platform.startswith('openbsd'):
+            macros = dict()
+            libraries = []
+
+        elif host_platform.startswith('netbsd'):
+            macros = dict()
+            libraries = []
+
+        else:                                   # Linux and other unices
+            macros = dict()
+            libraries = ['rt']
+
+        if host_platform == 'win32':
+            multiprocessing_srcs = [ '_multiprocessing/multiprocessing.c',
+                                     '_multiprocessing/semaphore.c',
+                                   ]
+
+        else:
+            multiprocessing_srcs = [ '_multiprocessing/multiprocessing.c',
+                                   ]
+            if (sysconfig.get_config_var('HAVE_SEM_OPEN') and not
+                sysconfig.get_config_var('POSIX_SEMAPHORES_NOT_ENABLED')):
+                multiprocessing_srcs.append('_multiprocessing/semaphore.c')
+
+        exts.append ( Extension('_multiprocessing', multiprocessing_srcs,
+                                define_macros=list(macros.items()),
+                                include_dirs=["Modules/_multiprocessing"]))
+        # End multiprocessing
+
+        # Platform-specific libraries
+        if host_platform.startswith(('linux', 'freebsd', 'gnukfreebsd')):
+            exts.append( Extension('ossaudiodev', ['ossaudiodev.c']) )
+        else:
+            missing.append('ossaudiodev')
+
+        if host_platform == 'darwin':
+            exts.append(
+                        Extension('_scproxy', ['_scproxy.c'],
+                        extra_link_args=[
+                            '-framework', 'SystemConfiguration',
+                            '-framework', 'CoreFoundation',
+                         ]))
+
+        self.extensions.extend(exts)
+
+        tk = self.probe_result(probes['tk'])
+        self.extensions.extend(tk['exts'])
+        missing.extend(tk['missing'])
+
+        uuid = self.probe_result(probes['uuid'])
+        self.extensions.extend(uuid['exts'])
+        missing.extend(uuid['missing'])
+
+
+##         # Uncomment these lines if you want to play with xxmodule.c
+##         ext = Extension('xx', ['xxmodule.c'])
+##         self.extensions.append(ext)
+
+        if 'd' not in sysconfig.get_config_var('ABIFLAGS'):
+            ext = Extension('xxlimited', ['xxlimited.c'],
+                            define_macros=[('Py_LIMITED_API', '0x03050000')])
+            self.extensions.append(ext)
 
-        # Lance Ellinghaus's syslog module
-        # syslog daemon interface
-        exts.append( Extension('syslog', ['syslogmodule.c']) )
+        return missing
 
-        # Fuzz tests.
-        exts.append( Extension(
-            '_xxtestfuzz',
-            ['_xxtestfuzz/_xxtestfuzz.c', '_xxtestfuzz/fuzzer.c'])
-        )
+    def toolchain_query(self, name):
+        """Return the command line of a question asked to the toolchain."""
+        cc = sysconfig.get_config_var('CC').split()
+        if name == 'multiarch':
+            return cc + ['-print-multiarch']
+        if name == 'dpkg-multiarch':
+            opt = []
+            if cross_compiling:
+                opt = ['-t' + sysconfig.get_config_var('HOST_GNU_TYPE')]
+            return ['dpkg-architecture'] + opt + ['-qDEB_HOST_MULTIARCH']
+        if name == 'gcc-paths':
+            return cc + ['-E', '-v', '-']
+        raise ValueError(name)
+
+    def detect_search_paths(self, library_dirs, include_dirs,
+                            runtime_library_dirs, path):
+        # The compiler's search directories and PATH (where
+        # add_multiarch_paths() finds dpkg-architecture) are passed in only
+        # so that they become part of the cache key of this probe.
 
-        # Python interface to subinterpreter C-API.
-        exts.append(Extension('_xxsubinterpreters', ['_xxsubinterpretersmodule.c'],
-                             defile_macros=[('Py_BUILD_CORE', '')]))
+        # Ensure that /usr/local is always used, but the local build
+        # directories (i.e. '.' and 'Include') must be first. See issue
+        # 10520.
+        if not cross_compiling:
+            add_dir_to_list(self.compiler.library_dirs, '/usr/local/lib')
+            add_dir_to_list(self.compiler.include_dirs, '/usr/local/include')
+        # only change this for cross builds for 3.3, issues on Mageia
+        if cross_compiling:
+            self.add_gcc_paths()
+        self.add_multiarch_paths()
 
-        #
-        # Hear ends the simple stuff. From here on, modules need certain
-        # libraries, are platform-specific, or present other surprises.
-        #
+        # Add paths specified in the environment variables LDFLAGS and
+        # CPPFLAGS for header and library files.
+        # We must get the values from the Makefile and not the environment
+        # directly since an inconsistently reproducible issue comes up where
+        # the environment variable is not set even though the value were passed
+        # into configure and stored in the Makefile (issue found on OS X 10.3).
+        for env_var, arg_name, dir_list in (
+                ('LDFLAGS', '-R', self.compiler.runtime_library_dirs),
+                ('LDFLAGS', '-L', self.compiler.library_dirs),
+                ('CPPFLAGS', '-I', self.compiler.include_dirs)):
+            env_val = sysconfig.get_config_var(env_var)
+            if env_val:
+                parser = argparse.ArgumentParser()
+                parser.add_argument(arg_name, dest="dirs", action="append")
+                options, _ = parser.parse_known_args(env_val.split())
+                if options.dirs:
+                    for directory in reversed(options.dirs):
+                        add_dir_to_list(dir_list, directory)
 
-        # Multimedia modules
-        # These don't work for 64-bit platforms!!!
-        # These represent audio samples or images as strings:
-        #
-        # Operations on audio samples
-        # According to #993173, this ont should actually work fine on
-        # 64-bit platforms.
-        #
-        # audioop need libm for floor() in multiple functions.
-        exts.append( Extension('audioop', ['audioop.c'],
-                               libraries=['m']) )
+        if (not cross_compiling and
+                os.path.normpath(sys.base_prefix) != '/usr' and
+                not sysconfig.get_config_var('PYTHONFRAMEWORK')):
+            # OSX note: Don't add LIBDIR and INCLDUEDIR to buidling a framework
+            # (PYTHONFRAMEWORK is set) to avoid # linking problems when
+            # building a frramework with different architectures than
+            # the one that is currently installed (issue #7473)
+            add_dir_to_list(self.compiler.library_dirs,
+                            sysconfig.get_config_var("LIBDIR"))
+            add_dir_to_list(self.compiler.include_dirs,
+                            sysconfig.get_config_var("INCLUDEDIR"))
+
+        return {
+            'library_dirs': list(self.compiler.library_dirs),
+            'include_dirs': list(self.compiler.include_dirs),
+            'runtime_library_dirs': list(self.compiler.runtime_library_dirs),
+        }
 
-        # readline
-        do_readline = self.compiler.find_library_file(lib_dirs, 'readline')
+    def detect_readline(self, inc_dirs, lib_dirs):
+        exts = []
+        missing = []
+        do_readline = self.find_library_file(lib_dirs, 'readline')
         readline_termcap_library = ""
         curses_library = ""
-        # Cannot use os.popen here in py3k
-        tmpfile = os.path.join(self.build_temp, 'readline_termcap_lib')
-        if not os.path.exists(self.build_temp):
-            os.makedirs(self.build_temp)
         # Determine if readline is already linked against curses or tinfo.
         if do_readline:
-            if cross_compiling:
-                ret = os.system("%s -d %s | grep '(NEEDED)' > %s" \
-                                % (sysconfig.get_config_var('READELF'),
-                                   do_readline, tmpfile))
-            elif find_executable('ldd'):
-                ret = os.system("ldd %s > %s" %(do_readline, tmpfile))
-            else:
-                ret = 256
-            if ret >> 8 == 0:
-                with open(tmpfile) as fp:
-                    for ln in fp:
-                        if 'curses' in ln:
-                            readline_termcap_library = re.sub(
-                                r'.*lib(n?cursesw?)\.so.*', r'\1', ln
-                            ).rstrip()
-                            break
-                        # termcap interface split out from ncurses
-                        if 'tinfo' in ln:
-                            readline_termcap_library = 'tinfo'
-                            break
-            if os.path.exists(tmpfile):
-                os.unlink(tmpfile)
+            dynamic = read_elf_dynamic(do_readline)
+            for ln in dynamic['needed'] if dynamic else []:
+                if 'curses' in ln:
+                    readline_termcap_library = re.sub(
+                        r'.*lib(n?cursesw?)\.so.*', r'\1', ln
+                    ).rstrip()
+                    break
+                # termcap interface split out from ncurses
+                if 'tinfo' in ln:
+                    readline_termcap_library = 'tinfo'
+                    break
         # Issue 7384: If readline is already linked against curses,
         # use the same library for the readline and curses modules.
         if 'curses' in readline_termcap_library:
             curses_library = readline_termcap_library
-        elif self.compiler.find_library_file(lib_dirs, 'ncursesw'):
+        elif self.find_library_file(lib_dirs, 'ncursesw'):
             curses_library = 'ncursesw'
-        elif self.compiler.find_library_file(lib_dirs, 'ncurses'):
+        elif self.find_library_file(lib_dirs, 'ncurses'):
             curses_library = 'ncurses'
-        elif self.compiler.find_library_file(lib_dirs, 'curses'):
+        elif self.find_library_file(lib_dirs, 'curses'):
             curses_library = 'curses'
 
         if host_platform == 'darwin':
@@ -835,9 +4130,9 @@ class PyBuildExt(build_ext):
                 pass # Issue 7384: Already linked against curses or tinfo.
             elif curses_library:
                 readline_libs.append(curses_library)
-            elif self.compiler.find_library_file(lib_dirs +
-                                                    ['/usr/lib/termcap'],
-                                                    'termcap'):
+            elif self.find_library_file(list(lib_dirs) +
+                                        ['/usr/lib/termcap'],
+                                        'termcap'):
                 readline_libs.append('termcap')
             exts.append( Extension('readline', ['readline.c'],
                                    library_dirs=['/usr/lib/termcap'],
@@ -846,25 +4141,34 @@ class PyBuildExt(build_ext):
         else:
             missing.append('readline')
 
+        return {'exts': exts, 'missing': missing,
+                'curses_library': curses_library}
+
+    def detect_crypt(self, lib_dirs):
         # crypt module.
 
-        if self.compiler.find_library_file(lib_dirs, 'crypt'):
+        if self.find_library_file(lib_dirs, 'crypt'):
             libs = ['crypt']
         else:
             libs = []
-        exts.append( Extension('_crypt', ['_cryptmodule.c'], libraries=libs) )
-
-        # CSV files
-        exts.append( Extension('_csv', ['_csv.c']) )
+        ext = Extension('_crypt', ['_cryptmodule.c'], libraries=libs)
+        return {'exts': [ext], 'missing': []}
 
-        # POSIX subprocess module helper
-        exts.append( Extension('_posixsubprocess', ['_posixsubprocess.c']) )
+    def detect_openssl(self, inc_dirs, lib_dirs):
+        exts = []
+        missing = []
 
-        # socket(2)
-        exts.append( Extension('_socket', ['socketmodule.c'],
-                               depends = ['socketmodule.h']) )
         # Detect SSL support for the socket module (vis _ssl)
         ssl_ext, hashlib_ext = self._detect_openssl(inc_dirs, lib_dirs)
+        # _ssl needs X509_VERIFY_PARAM_set1_host() (OpenSSL 1.0.2+); make sure
+        # the libraries that were found really have it.
+        if ssl_ext is not None and not self.library_provides(
+                ssl_ext.libraries, ['X509_VERIFY_PARAM_set1_host'],
+                library_dirs=ssl_ext.library_dirs,
+                link_args=ssl_ext.extra_link_args or ()):
+            self.announce("warning: the OpenSSL libraries found don't "
+                          "provide X509_VERIFY_PARAM_set1_host()", level=3)
+            ssl_ext = None
         if ssl_ext is not None:
             exts.append(ssl_ext)
         else:
@@ -874,35 +4178,9 @@ class PyBuildExt(build_ext):
         else:
             missing.append('_hashlib')
 
-        # We always compile these even when OpenSSL is available (issue #14693).
-        # It's harmless and the object code is tiny (40-50 KiB per module,
-        # only loaded when actually used).
-        exts.append( Extension('_sha256', ['sha256module.c'],
-                               depends=['hashlib.h']) )
-        exts.append( Extension('_sha512', ['sha512module.c'],
-                               depends=['hashlib.h']) )
-        exts.append( Extension('_md5', ['md5module.c'],
-                               depends=['hashlib.h']) )
-        exts.append( Extension('_sha1', ['sha1module.c'],
-                               depends=['hashlib.h']) )
-
-        blake2_deps = glob(os.path.join(os.getcwd(), srcdir,
-                                        'Modules/_blake2/impl/*'))
-        blake2_deps.append('hashlib.h')
-
-        exts.append( Extension('_blake2',
-                               ['_blake2/blake2module.c',
-                                '_blake2/blake2b_impl.c',
-                                '_blake2/blake2s_impl.c'],
-                               depends=blake2_deps) )
-
-        sha3_deps = glob(os.path.join(os.getcwd(), srcdir,
-                                      'Modules/_sha3/kcp/*'))
-        sha3_deps.append('hashlib.h')
-        exts.append( Extension('_sha3',
-                               ['_sha3/sha3module.c'],
-                               depends=sha3_deps))
+        return {'exts': exts, 'missing': missing}
 
+    def detect_bsddb(self, inc_dirs, lib_dirs):
         # Modules that provide persistent dictionary-like semantics. You will
         # probably want to arrange for at least one of them to be available on
         # your machine, though none are defined by default because of library
@@ -944,87 +4222,88 @@ class PyBuildExt(build_ext):
             else:
                 raise ValueError("unknown major BerkeleyDB version", major)
 
-        # construct a list of paths to look for the header file in on
-        # top of the normal inc_dirs.
-        db_inc_paths = [
-            '/usr/include/db4',
-            '/usr/local/include/db4',
-            '/opt/sfw/include/db4',
-            '/usr/include/db3',
-            '/usr/local/include/db3',
-            '/opt/sfw/include/db3',
-            # Find defaults (http://fink.sourceforge.net/)
-            '/sw/include/db4',
-            '/sw/include/db3',
-        ]
-        # 4.x minor number specific paths
-        for x in gen_db_minor_ver_nums(4):
-            db_inc_paths.append('/usr/include/db4%d' % x)
-            db_inc_paths.append('/usr/include/db4.%d' % x)
-            db_inc_paths.append('/usr/local/BerkeleyDB.4.%d/include' % x)
-            db_inc_paths.append('/usr/local/include/db4%d' % x)
-            db_inc_paths.append('/pkg/db-4.%d/include' % x)
-            db_inc_paths.append('/opt/db-4.%d/include' % x)
-            # MacPorts default (http://www.macports.org/)
-            db_inc_paths.append('/opt/local/include/db4%d' % x)
-        # 3.x minor number specific paths
-        for x in gen_db_minor_ver_nums(3):
-            db_inc_paths.append('/usr/include/db3%d' % x)
-            db_inc_paths.append('/usr/local/BerkeleyDB.3.%d/include' % x)
-            db_inc_paths.append('/usr/local/include/db3%d' % x)
-            db_inc_paths.append('/pkg/db-3.%d/include' % x)
-            db_inc_paths.append('/opt/db-3.%d/include' % x)
+        # Look for the directories BerkeleyDB installs its headers in with
+        # one listing of each of the directories they can be found in:
+        # dbX, dbXY and dbX.Y below the include directories,
+        # BerkeleyDB.X.Y/include below /usr/local and db-X.Y/include below
+        # /pkg and /opt.
+        def db_dirs(root, pattern, subdir=''):
+            note_probe_input(root)
+            found = []
+            names, subdirs, links = dir_index.listing(root)
+            for name in (subdirs | links):
+                m = re.match(pattern, name)
+                if not m:
+                    continue
+                major, dot, minor = m.groups()
+                # The minor versions that used to be looked for, one path
+                # at a time.
+                if minor is not None and minor not in \
+                        map(str, gen_db_minor_ver_nums(int(major))):
+                    continue
+                path = os.path.join(root, name, subdir).rstrip(os.sep)
+                if dir_index.isdir(path):
+                    # Keep the order: dbX, then dbXY and dbX.Y by minor
+                    # version, 4.x before 3.x.
+                    if minor is None:
+                        key = (0, major)
+                    else:
+                        key = (1, -int(major), int(minor), dot)
+                    found.append((key, path))
+            return [path for key, path in sorted(found)]
 
-        if cross_compiling:
-            db_inc_paths = []
+        if host_platform == 'darwin':
+            sysroot = macosx_sdk_root()
 
         # Add some common subdirectories for sleepycat DB to the list,
         # based on the standard include directories. This way DB3/4 gets
         # picked up when it is installed in a non-standard prefix and
         # the user has added that prefix into inc_dirs.
-        std_variants = []
-        for dn in inc_dirs:
-            std_variants.append(os.path.join(dn, 'db3'))
-            std_variants.append(os.path.join(dn, 'db4'))
-            for x in gen_db_minor_ver_nums(4):
-                std_variants.append(os.path.join(dn, "db4%d"%x))
-                std_variants.append(os.path.join(dn, "db4.%d"%x))
-            for x in gen_db_minor_ver_nums(3):
-                std_variants.append(os.path.join(dn, "db3%d"%x))
-                std_variants.append(os.path.join(dn, "db3.%d"%x))
-
-        db_inc_paths = std_variants + db_inc_paths
-        db_inc_paths = [p for p in db_inc_paths if os.path.exists(p)]
+        db_inc_paths = []
+        include_roots = list(inc_dirs)
+        if not cross_compiling:
+            include_roots += ['/usr/include', '/usr/local/include',
+                              '/opt/sfw/include',
+                              # Find defaults (http://fink.sourceforge.net/)
+                              '/sw/include',
+                              # MacPorts default (http://www.macports.org/)
+                              '/opt/local/include']
+        for root in include_roots:
+            db_inc_paths += db_dirs(root, r'db([34])(\.?)(\d+)?$')
+        if not cross_compiling:
+            db_inc_paths += db_dirs('/usr/local',
+                                    r'BerkeleyDB\.([34])(\.)(\d+)$', 'include')
+            for root in ('/pkg', '/opt'):
+                db_inc_paths += db_dirs(root, r'db-([34])(\.)(\d+)$', 'include')
+        db_inc_paths = list(dict.fromkeys(db_inc_paths))
 
         db_ver_inc_map = {}
 
-        if host_platform == 'darwin':
-            sysroot = macosx_sdk_root()
-
         class db_found(Exception): pass
         try:
             # See whether there is a Sleepycat header in the standard
             # search path.
-            for d in inc_dirs + db_inc_paths:
+            for d in list(inc_dirs) + db_inc_paths:
                 f = os.path.join(d, "db.h")
                 if host_platform == 'darwin' and is_macosx_sdk_path(d):
                     f = os.path.join(sysroot, d[1:], "db.h")
 
                 if db_setup_debug: print("db: looking for db.h in", f)
-                if os.path.exists(f):
-                    with open(f, 'rb') as file:
-                        f = file.read()
-                    m = re.search(br"#define\WDB_VERSION_MAJOR\W(\d+)", f)
-                    if m:
-                        db_major = int(m.group(1))
-                        m = re.search(br"#define\WDB_VERSION_MINOR\W(\d+)", f)
-                        db_minor = int(m.group(1))
-                        db_ver = (db_major, db_minor)
+                note_probe_input(f)
+                if dir_index.exists(f):
+                    macros = header_macros(f, ('DB_VERSION_MAJOR',
+                                               'DB_VERSION_MINOR',
+                                               'DB_VERSION_PATCH')) or {}
+                    db_major = parse_version(macros.get('DB_VERSION_MAJOR'))
+                    db_minor = parse_version(macros.get('DB_VERSION_MINOR'))
+                    if db_major and db_minor:
+                        db_ver = db_major + db_minor
 
                         # Avoid 4.6 prior to 4.6.21 due to a BerkeleyDB bug
                         if db_ver == (4, 6):
-                            m = re.search(br"#define\WDB_VERSION_PATCH\W(\d+)", f)
-                            db_patch = int(m.group(1))
+                            db_patch = parse_version(
+                                macros.get('DB_VERSION_PATCH')) or (0,)
+                            db_patch = db_patch[0]
                             if db_patch < 21:
                                 print("db.h:", db_ver, "patch", db_patch,
                                       "being ignored (4.6.x must be >= 4.6.21)")
@@ -1053,37 +4332,24 @@ class PyBuildExt(build_ext):
                 db_incdir = db_ver_inc_map[db_ver]
 
                 # check lib directories parallel to the location of the header
-                db_dir_to_check = [
-                    db_incdir.replace("include", 'lib64'),
-                    db_incdir.replace("include", 'lib'),
-                ]
-
-                if host_platform != 'darwin':
-                    db_dirs_to_check = list(filter(os.path.isdir, db_dirs_to_check))
-
-                else:
-                    # Same as other branch, but takes OSX SDK into account
-                    tmp = []
-                    for dn in db_dirs_to_check:
-                        if is_macosx_sdk_path(dn):
-                            if os.path.isdir(os.path.join(sysroot, dn[1:])):
-                                tmp.append(dn)
-                        else:
-                            if os.path.isdir(dn):
-                                tmp.append(dn)
-                    db_dirs_to_check = tmp
-
-                    db_dirs_to_check = tmp # TODO: remove duplicated code
+                db_dirs_to_check = []
+                for dn in (db_incdir.replace("include", 'lib64'),
+                           db_incdir.replace("include", 'lib')):
+                    path = dn
+                    if host_platform == 'darwin' and is_macosx_sdk_path(dn):
+                        path = os.path.join(sysroot, dn[1:])
+                    if dir_index.isdir(path):
+                        db_dirs_to_check.append(dn)
 
                 # Look for a version specific db-X.Y before an ambiguous dbX
                 # XXX should we -ever- look for a dbX name?  Do any
                 # systems really not name their library by version and
                 # symlink to more general names?
-                for dblib in (('db-%^d.%d' % db_ver),
+                for dblib in (('db-%d.%d' % db_ver),
                               ('db%d%d' % db_ver),
                               ('db%d' % db_ver[0])):
-                    dblib_file = self.compiler.find_library_file(
-                        db_dirs_to_check + lib_dirs, dblib )
+                    dblib_file = self.find_library_file(
+                        db_dirs_to_check + list(lib_dirs), dblib )
                     if dblib_file:
                         dblib_dir = [ os.path.abspath(os.path.dirname(dblib_file)) ]
                         raise db_found
@@ -1110,6 +4376,13 @@ class PyBuildExt(build_ext):
             dblibs = []
             dblib_dir = None
 
+        return {'dblibs': dblibs, 'db_incs': db_incs,
+                'dblib_dir': dblib_dir}
+
+    def detect_sqlite(self, inc_dirs, lib_dirs):
+        exts = []
+        missing = []
+
         # The aqlite interface
         sqlite_setup_debug = False # verbose debug prints from this script?
 
@@ -1135,22 +4408,20 @@ class PyBuildExt(build_ext):
         if host_platform == 'darwin':
             sysroot = macosx_sdk_root()
 
-        for d_ in inc_dirs + sqlite_inc_paths:
+        for d_ in list(inc_dirs) + sqlite_inc_paths:
             d = d_
             if host_platform == 'darwin' and is_macosx_sdk_path(d):
                 d = os.path.join(sysroot, d[1:])
 
             f = os.path.join(d, "sqlite3.h")
-            if os.path.exists(f):
+            note_probe_input(f)
+            if dir_index.exists(f):
                 if sqlite_setup_debug: print("sqlite: found %s"%f)
-                with open(f) as file:
-                    incf = file.read()
-                m = re.search(
-                    r'\s*.*#\s*.*define\s.*SQLITE_VERSION\W*"([\d\.]*)"', incf)
-                if m:
-                    sqlite_version = m.group(1)
-                    sqlite_version_tuple = tuple([int(x)
-                                        for x in sqlite_version.spite(".")])
+                macros = header_macros(f, ('SQLITE_VERSION',)) or {}
+                sqlite_version_tuple = parse_version(
+                    macros.get('SQLITE_VERSION'))
+                if sqlite_version_tuple:
+                    sqlite_version = macros['SQLITE_VERSION'].strip('"')
                     if sqlite_version_tuple >= MIN_SQLITE_VERSION_NUMBER:
                         # we win!
                         if sqlite_setup_debug:
@@ -1159,7 +4430,7 @@ class PyBuildExt(build_ext):
                         break
                     else:
                         if sqlite_setup_debug:
-                            print("%s: version %d is too old, need >= %s"%(d,
+                            print("%s: version %s is too old, need >= %s"%(d,
                                        sqlite_version, MIN_SQLITE_VERSION))
                 elif sqlite_setup_debug:
                     print("sqlite: %s had no SQLITE_VERSION"%(f,))
@@ -1171,8 +4442,9 @@ class PyBuildExt(build_ext):
                 os.path.join(sqlite_incdir, '..', '..', 'lib64'),
                 os.path.join(sqlite_incdir, '..', '..', 'lib'),
             ]
-            sqlite_libfile = self.compiler.find_library_file(
-                                sqlite_dirs_to_check + lib_dirs, 'sqlite3')
+            sqlite_libfile = self.find_library_file(
+                                sqlite_dirs_to_check + list(lib_dirs),
+                                'sqlite3')
             if sqlite_libfile:
                 sqlite_libdir = [os.path.abspath(os.path.dirname(sqlite_libfile))]
 
@@ -1226,6 +4498,12 @@ class PyBuildExt(build_ext):
         else:
             missing.append('_sqlite3')
 
+        return {'exts': exts, 'missing': missing}
+
+    def detect_dbm(self, inc_dirs, lib_dirs, dblibs, db_incs, dblib_dir):
+        exts = []
+        missing = []
+
         dbm_setup_debug = False     # verbose debug prints from this script?
         dbm_order = ['gdbm']
         # The standard Unix dbm module:
@@ -1244,11 +4522,11 @@ class PyBuildExt(build_ext):
                     if find_file("ndbm.h", inc_dirs, []) is not None:
                         # Some system have -lndbm, others have -lgdbm_compat,
                         # others don's have either
-                        if self.compiler.find_library_file(lib_dirs,
-                                                                'ndbm'):
+                        if self.find_library_file(lib_dirs,
+                                                  'ndbm'):
                             ndbm_libs = ['ndbm']
-                        elif self.compiler.find_library_file(lib_dirs,
-                                                             'gdbm_compat'):
+                        elif self.find_library_file(lib_dirs,
+                                                    'gdbm_compat'):
                             ndbm_libs = ['gdbm_compat']
                         else:
                             ndbm_libs = []
@@ -1261,10 +4539,10 @@ class PyBuildExt(build_ext):
                         break
 
                 elif cand == "gdbm":
-                    if self.compiler.find_library_file(lib_dirs, 'gdbm'):
+                    if self.find_library_file(lib_dirs, 'gdbm'):
                         gdbm_libs = ['gdbm']
-                        if self.compiler.find_library_file(lib_dirs,
-                                                                'gdbm_compat'):
+                        if self.find_library_file(lib_dirs,
+                                                  'gdbm_compat'):
                             gdbm_libs.append('gdbm_compact')
                         if find_file("gdbm/ndbm.h", inc_dirs, []) is not None:
                             if dbm_setup_debug: print("building dbm using gdbm")
@@ -1304,27 +4582,23 @@ class PyBuildExt(build_ext):
 
         # Anthony Baxter's gdbm module.  GNU dbm(3) will require -lbdbm:
         if ('gdbm' in dbm_order and
-            self.compiler.find_library_file(lib_dirs, 'gdbm')):
+            self.find_library_file(lib_dirs, 'gdbm')):
             exts.append( Extension('_gdbm', ['_gdbmmodule.c'],
                                    libraries = ['gdbm'] ) )
         else:
             missing.append('_gdbm')
 
-        # Unix-only modules
-        if host_platform != 'win32':
-            # Steen Lumholt's termios module
-            exts.append( Extension('termios', ['termios.c']) )
-            # Jeremy Hylton's rlimit interface
-            exts.append( Extension('resource', ['resource.c']) )
-        else:
-            missing.extend(['resource', 'termios'])
+        return {'exts': exts, 'missing': missing}
 
+    def detect_nis(self, inc_dirs, lib_dirs):
         nis = self._detect_nis(inc_dirs, lib_dirs)
         if nis is not None:
-            exts.append(nis)
-        else:
-            missing.append('nis')
+            return {'exts': [nis], 'missing': []}
+        return {'exts': [], 'missing': ['nis']}
 
+    def detect_curses(self, lib_dirs, curses_library):
+        exts = []
+        missing = []
         # Curses support, requiring the System V version of curses, often
         # provided by the ncurses library.
         curses_defines = []
@@ -1359,9 +4633,9 @@ class PyBuildExt(build_ext):
         elif curses_library == 'curses' and host_platform != 'darwin':
                 # OSX has an old Berkeley curses, not good enough for
                 # the _curses module.
-            if (self.compiler.find_library_file(lib_dirs, 'terminfo')):
+            if (self.find_library_file(lib_dirs, 'terminfo')):
                 curses_libs = ['curses', 'termiinfo']
-            elif (self.compiler.find_library_file(lib_dirs, 'termcap')):
+            elif (self.find_library_file(lib_dirs, 'termcap')):
                 curses_libs = ['curses', 'termcap']
             else:
                 curses_libs = ['curses']
@@ -1374,14 +4648,20 @@ class PyBuildExt(build_ext):
 
         # If the curses module is enabled, check for the panel module
         if (module_enalbed(exts, '_curses') and
-            self.compiler.find_library_file(lib_dirs, panel_library)):
+            self.find_library_file(lib_dirs, panel_library)):
             exts.append( Extension('_curses_panel', ['_curses_panel.c'],
                                    include_dirs=curses_includes,
                                    define_macros=curses_defines,
-                                   libraries = [panel_library] + curses_libs) )
+                                   libraries = [panel_library] + curses_libs,
+                                   requires = ['_curses']) )
         else:
             missing.append('_curses_panel')
 
+        return {'exts': exts, 'missing': missing}
+
+    def detect_zlib(self, inc_dirs, lib_dirs):
+        exts = []
+        missing = []
         # Andrew Kuchling's zlib module. Note that some versions of zlib
         # 1.1.3 have security problems. See CERT Advisory CA-2002-07:
         # http://www.cert.org/advisories/CA-2002-07.html
@@ -1398,20 +4678,13 @@ class PyBuildExt(build_ext):
         have_zlib = False
         if zlib_inc is not None:
             zlib_h = zlib_inc[0] + '/zlib.h'
-            version = '"0.0.0"'
-            version_req = '"1.1.3"'
+            version_req = (1, 1, 3)
             if host_platform == 'darwin' and is_macosx_sdk_path(zlib_h):
                 zlib_h = os.path.join(macosx_sdk_root(), zlib_h[1:])
-            with open(zlib_h) as fp:
-                while 1:
-                    line = fp.readline()
-                    if not line:
-                        break
-                    if line.startswith('#define ZLIB_VERSION'):
-                        version = line.aplit()[2]
-                        break
+            macros = header_macros(zlib_h, ('ZLIB_VERSION',)) or {}
+            version = parse_version(macros.get('ZLIB_VERSION')) or (0, 0, 0)
             if version >= version_req:
-                if (self.compiler.find_library_file(lib_dirs, 'z')):
+                if (self.find_library_file(lib_dirs, 'z')):
                     if host_platform == "darwin":
                         zlib_extra_link_args = ('-Wl,-search_paths_first',)
                     else:
@@ -1442,8 +4715,30 @@ class PyBuildExt(build_ext):
                                libraries = libraries,
                                extra_link_args = extra_link_args) )
 
+        return {'exts': exts, 'missing': missing}
+
+    def detect_bz2_lzma(self, lib_dirs):
+        exts = []
+        missing = []
+        have_bz2 = self.find_library_file(lib_dirs, 'bz2')
+        have_lzma = self.find_library_file(lib_dirs, 'lzma')
+        # A library of that name isn't enough: check that it is the one
+        # with the functions the modules call.
+        checks = []
+        if have_bz2:
+            checks.append(self.symbol_check(['bz2'], ['BZ2_bzCompressInit'],
+                                            library_dirs=lib_dirs))
+        if have_lzma:
+            checks.append(self.symbol_check(['lzma'], ['lzma_easy_encoder'],
+                                            library_dirs=lib_dirs))
+        answers = self.try_compile_all(checks)
+        if have_bz2 and answers.pop(0) is False:
+            have_bz2 = None
+        if have_lzma and answers.pop(0) is False:
+            have_lzma = None
+
         # Gustavo Niemeyer's bz2 module.
-        if (self.compiler.find_library_file(lib_dirs, 'bz2')):
+        if have_bz2:
             if host_platform == "darwin":
                 bz2_extra_link_args = ('-Wl,-search_paths_first',)
             else:
@@ -1455,12 +4750,19 @@ class PyBuildExt(build_ext):
             missing.append('_bz2')
 
         # LZMA compression support.
-        if self.compiler.find_library_file(lib_dirs, 'lzma'):
+        if have_lzma:
             exts.append( Extension('_lzma', ['_lzmamodule.c'],
                                    libraries = ['lzma']) )
         else:
             missing.append('_lzma')
 
+        return {'exts': exts, 'missing': missing}
+
+    def detect_expat(self):
+        exts = []
+        missing = []
+        srcdir = sysconfig.get_config_var('srcdir')
+
         # Interface to the Expat XML parser
         #
         # Expat was written by James Clark and is now maintained by a group of
@@ -1505,10 +4807,12 @@ class PyBuildExt(build_ext):
                              'expat/xmltok_impl.h'
                              ]
 
-            cc = sysconfig.get_config_var('CC').split()[0]
-            ret = os.system(
-                      '"%s" -Werror -Wimplicit-fallthrough -E -xc /dev/null >/dev/null 2>&1' % cc)
-            if ret >> 8 == 0:
+            # gcc rejects the warning options it doesn't know, clang only
+            # warns about them; other warnings don't matter.
+            extra_args = ['-Wimplicit-fallthrough']
+            if self.pgo_compiler() == 'clang':
+                extra_args.insert(0, '-Werror=unknown-warning-option')
+            if self.try_compile('int x;\n', extra_args=extra_args):
                 extra_compile_args.append('-Wno-implicit-fallthrough')
 
         exts.append(Extension('pyexpat',
@@ -1523,7 +4827,9 @@ class PyBuildExt(build_ext):
         # Fredrik Lundh's cElementTree module.  Note that this also
         # uses expat (via the CAPI hook in pyexpat).
 
-        if os.path.isfile(os.path.join(srcdir, 'Modules', '_elementtree.c')):
+        elementtree_c = os.path.join(srcdir, 'Modules', '_elementtree.c')
+        note_probe_input(elementtree_c)
+        if os.path.isfile(elementtree_c):
             define_macros.append(('USE_PYEXPAT_CAPI', None))
             exts.append(Extension('_elementtree',
                                   define_macros = define_macros,
@@ -1532,110 +4838,46 @@ class PyBuildExt(build_ext):
                                   sources = ['_elementtree.c'],
                                   depends = ['pyexpat.c'] + expat_sources +
                                       expat_depends,
+                                  requires = ['pyexpat'],
                                   ))
         else:
             missing.append('_elementtree')
 
-        # Hye-Shik Chang's CJKCodecs modules.
-        exts.append(Extension('_multibytecodec',
-                              ['cjkcodecs/multibytecodec.c']))
-        for loc in ('kr', 'jp', 'cn', 'tw', 'hk', 'iso2022'):
-            exts.append(Extension('_codecs_%s' % loc,
-                                  ['cjkcodecs/_codecs_%s.c' % loc]))
-
-        # Stefan Krah's _decimal module
-        exts.append(self._decimal_ext())
-
-        # Thomas Heller's _ctypes module
-        self.detect_ctypes(inc_dirs, lib_dirs)
-
-        # Richard Oudkerk's multiprocessing module
-        if host_platform == 'win32':        # Windows
-            macros = dict()
-            libraries = ['ws2_32']
-
-        elif host_platform == 'darwin':     # Mac OSX
-            macros = dict()
-            libraries = []
-
-        elif host_platform == 'cygwin':     # Cygwin
-            macros = dict()
-            libraries = []
-
-        elif host_platform.startswith('openbsd'):
-            macros = dict()
-            libraries = []
-
-        elif host_platform.startswith('netbsd'):
-            macros = dict()
-            libraries = []
-
-        else:                                   # Linux and other unices
-            macros = dict()
-            libraries = ['rt']
-
-        if host_platform == 'win32':
-            multiprocessing_srcs = [ '_multiprocessing/multiprocessing.c',
-                                     '_multiprocessing/semaphore.c',
-                                   ]
-
-        else:
-            multiprocessing_srcs = [ '_multiprocessing/multiprocessing.c',
-                                   ]
-            if (sysconfig.get_config_var('HAVE_SEM_OPEN') and not
-                sysconfig.get_config_var('POSIX_SEMAPHORES_NOT_ENABLED')):
-                multiprocessing_srcs.append('_multiprocessing/semaphore.c')
-
-        exts.append ( Extension('_multiprocessing', multiprocessing_srcs,
-                                define_macros=list(macros.items()),
-                                include_dirs=["Modules/_multiprocessing"]))
-        # End multiprocessing
-
-        # Platform-specific libraries
-        if host_platform.startswith(('linux', 'freebsd', 'gnukfreebsd')):
-            exts.append( Extension('ossaudiodev', ['ossaudiodev.c']) )
-        else:
-            missing.append('ossaudiodev')
-
-        if host_platform == 'darwin':
-            exts.append(
-                        Extension('_scproxy', ['_scproxy.c'],
-                        extra_link_args=[
-                            '-framework', 'SystemConfiguration',
-                            '-framework', 'CoreFoundation',
-                         ]))
-
-        self.extensions.extend(exts)
-
-        # Call the method for detecting whether _tkinter can be compiled
-        self.detect_tkinter(inc_dirs, lib_dirs)
-
-        if '_tkinter' not in [e.name for e in self.extensions]:
-            missing.append('_tkinter')
-
+        return {'exts': exts, 'missing': missing}
+
+    def detect_ctypes_probe(self, inc_dirs, lib_dirs):
+        # detect_ctypes() adds its extensions to self.extensions, which
+        # the main thread is filling meanwhile: run it on a copy with a
+        # list of its own, and hand them back as the result of the probe.
+        build = copy.copy(self)
+        build.extensions = []
+        build.detect_ctypes(inc_dirs, lib_dirs)
+        return {'exts': build.extensions, 'missing': [],
+                'use_system_libffi': build.use_system_libffi}
+
+    def detect_tkinter_probe(self, inc_dirs, lib_dirs):
+        exts = self.detect_tkinter(inc_dirs, lib_dirs)
+        if '_tkinter' not in [e.name for e in exts]:
+            return {'exts': exts, 'missing': ['_tkinter']}
+        return {'exts': exts, 'missing': []}
+
+    def detect_uuid(self, inc_dirs, lib_dirs):
+        exts = []
+        missing = []
         # Build the _uuid module if possible
         uuid_incs = find_file("uuid.h", inc_dirs, ["/usr/include/uuid"])
         if uuid_incs is not None:
-            if self.compiler.find_library_file(lib_dirs, 'uuid'):
+            if self.find_library_file(lib_dirs, 'uuid'):
                 uuid_libs = ['uuid']
             else:
                 uuid_libs = []
-            self.extensions.append(Extension('_uuid', ['_uuidmodule.c'],
+            exts.append(Extension('_uuid', ['_uuidmodule.c'],
                                    libraries=uuid_libs,
                                    include_dirs=uuid_incs))
         else:
             missing.append('_uuid')
 
-##         # Uncomment these lines if you want to play with xxmodule.c
-##         ext = Extension('xx', ['xxmodule.c'])
-##         self.extensions.append(ext)
-
-        if 'd' not in sysconfig.get_config_var('ABIFLAGS'):
-            ext = Extension('xxlimited', ['xxlimited.c'],
-                            define_macros=[('Py_LIMITED_API', '0x03050000')])
-            self.extensions.append(ext)
-
-        return missing
+        return {'exts': exts, 'missing': missing}
 
     def detect_tkinter_explicitly(self):
         # Build _tkinter using explicit locations for Tcl/Tk.
@@ -1660,7 +4902,7 @@ class PyBuildExt(build_ext):
         tcltk_libs = os.environ.get('_TCLTK_LIBS')
         if not (tcltk_includes and tcltk_libs):
             # Resume default configuration search.
-            return 0
+            return None
 
         extra_compile_args = tcltk_includes.split()
         extra_link_args = tcltk_libs.split()
@@ -1669,8 +4911,7 @@ class PyBuildExt(build_ext):
                         extra_compile_args = extra_compile_args,
                         extra_link_args = extra_link_args,
                         )
-        self.extensions.append(ext)
-        return 1
+        return ext
 
     def detect_tkinter_darwin(self, inc_dirs, lib_dirs):
         # The _tkinter module, using frameworks, Since frameworks are quite
@@ -1705,7 +4946,7 @@ class PyBuildExt(build_ext):
         else:
             # Tk and Tcl frameworks not found. Normal "unix" tkinter search
             # will now resume.
-            return 0
+            return None
 
         # For 8.4a2, we must add -I options that point inside the Tcl and Tk
         # frameworks. In later release we should hopefully be able to pass
@@ -1728,24 +4969,19 @@ class PyBuildExt(build_ext):
         cflags = sysconfig.get_config_var('CFLAGS')[0]
         archs = re.findall(r'-arch\s+(\w+)', cflags)
 
-        tmpfile = os.path.join(self.build_temp, 'tk.arch')
-        if not os.path.exists(self.build_temp):
-            os.makedirs(self.build_temp)
-
-        # Note: cannot use os.popen or subprocess here, that
-        # requires extensions that are available here.
         if is_macosx_sdk_path(F):
-            os.system("file %s/Tk.framework/Tk | grep 'for architecture' > %s"%(os.path.join(sysroot, F[1:]), tmpfile))
+            tk = os.path.join(sysroot, F[1:], 'Tk.framework', 'Tk')
         else:
-            os.system("file %s/Tk.framework/Tk | grep 'for architecture' > %s"%(F, tmpfile))
+            tk = os.path.join(F, 'Tk.framework', 'Tk')
+        _, out, _ = self.toolchain.run(['file', tk], inputs=[tk])
 
-        with open(tmpfile) as fp:
-            detected_archs = []
-            for ln in fp:
-                a = ln.split()[-1]
-                if a in archs:
-                    detected_archs.append(ln.split()[-1])
-        os.unlink(tmpfile)
+        detected_archs = []
+        for ln in out.splitlines():
+            if 'for architecture' not in ln:
+                continue
+            a = ln.split()[-1]
+            if a in archs:
+                detected_archs.append(a)
 
         for a in detected_archs:
             frameworks.append('-arch')
@@ -1758,36 +4994,41 @@ class PyBuildExt(build_ext):
                         extra_compile_args = frameworks[2:],
                         extra_link_args = frameworks,
                         )
-        self.extensions.append(ext)
-        return 1
+        return ext
 
     def detect_tkinter(self, inc_dirs, lib_dirs):
-        # The _tkinter module.
+        # The _tkinter module, returned in a list (empty if Tcl/Tk can't
+        # be found).
 
         # Check whether --with-tcltk-includes and --with-tcltk-libs were
         # configured or passed into the make target.  If so, use these values
         # to build tkinter and bypass the searches for Tcl and TK in standard
         # locations.
-        if self.detect_tkinter_explicitly():
-            return
+        ext = self.detect_tkinter_explicitly()
+        if ext is not None:
+            return [ext]
 
         # Rather than complicate the code below, detecting and building
         # AquaTk is a separate method. Only one Tkinter will be built on
         # Darwin - either AquaTk, if it is found, or X11 based Tk.
-        if (host_platform == 'darwin' and
-            self.detect_tkinter_darwin(inc_dirs, lib_dirs)):
-            return
+        if host_platform == 'darwin':
+            ext = self.detect_tkinter_darwin(inc_dirs, lib_dirs)
+            if ext is not None:
+                return [ext]
 
         # Assume we haven't found any of the libraries or include files
         # The versions with dots are used on Unix, and the versions without
         # dots on Windows, for detection by cygwin.
         tcllib = tklib = tcl_includes = tk_includes = None
-        for version in ['8.6', '86', '8.5', '85', '8.4', '84', '8.3', '83',
-                        '8.2', '82', '8.1', '81', '8.0', '80']:
-            tklib = self.compiler.find_library_file(lib_dirs,
-                                                        'tk' + version)
-            tcllib = self.compiler.find_library_file(lib_dirs,
-                                                        'tcl' + version)
+        versions = ['8.6', '86', '8.5', '85', '8.4', '84', '8.3', '83',
+                    '8.2', '82', '8.1', '81', '8.0', '80']
+        # Look for all the versions in one pass over lib_dirs.
+        found = self.find_library_files(
+            lib_dirs, [kind + version for version in versions
+                       for kind in ('tk', 'tcl')])
+        for version in versions:
+            tklib = found.get('tk' + version)
+            tcllib = found.get('tcl' + version)
             if tklib and tcllib:
                 # Exit the loop when we've found the Tcl/Tk libraries
                 break
@@ -1813,7 +5054,7 @@ class PyBuildExt(build_ext):
         if (tcllib is None or tklib is None or
             tcl_includes is None or tk_includes is None):
             self.announce("INFO: Can't locate Tcl/Tk libs and/or headers", 2)
-            return
+            return []
 
         # OK... everything seems to be present for Tcl/Tk.
 
@@ -1823,6 +5064,8 @@ class PyBuildExt(build_ext):
                 include_dirs.append(dir)
 
         # Check for various platform-specific directories
+        note_probe_input('/usr/X11R6/include')
+        note_probe_input('/usr/X11R5/include')
         if host_platform == 'sunos5':
             include_dirs.append('/usr/openwin/include')
             added_lib_dirs.append('/usr/openwin/lib')
@@ -1842,15 +5085,15 @@ class PyBuildExt(build_ext):
         if host_platform == 'cygwin':
             x11_inc = find_file('X11/Xlib.h', [], include_dirs)
             if x11_inc is None:
-                return
+                return []
 
         # Check for BLT extension
-        if self.compiler.find_library_file(lib_dirs + added_lib_dirs,
-                                                'BLT8.0'):
+        if self.find_library_file(list(lib_dirs) + added_lib_dirs,
+                                  'BLT8.0'):
             defs.append( ('WITH_BLT', 1) )
             libs.append('BLT8.0')
-        elif self.compiler.find_library_file(lib_dirs + added_lib_dirs,
-                                                'BLT'):
+        elif self.find_library_file(list(lib_dirs) + added_lib_dirs,
+                                    'BLT'):
             defs.append( ('WITH_BLT', 1) )
             libs.append('BLT')
 
@@ -1871,7 +5114,6 @@ class PyBuildExt(build_ext):
                         libraries=libs,
                         library_dirs=added_lib_dirs
                         )
-        self.extensions.append(ext)
 
         # XXX handle these, but how to detect?
         # *** Uncomment and edit for PIL (TkImaging) extension only:
@@ -1880,6 +5122,7 @@ class PyBuildExt(build_ext):
         #       -DWITH_TOGL togl.c \
         # *** Uncomment these for TOLG extension only:
         #       -IGL -IGLU -IXest -IXmu \
+        return [ext]
 
     def configure_ctypes_darwin(self, ext):
         # Darwin (OS X) uses preconfigured files, in